@@ -1,17 +1,30 @@
-import copy
+import bisect
+import concurrent.futures
 import filecmp
+import gzip
+import hashlib
+import heapq
 import datetime
 import math
 
+import numpy as np
 import trueskill
 from trueskill import *
 from dataclasses import dataclass
 from typing import Dict
+from collections.abc import Mapping, MutableMapping
 import csv
 import collections
-import json
-import shutil
 import os
+import pickle
+import sys
+
+if __name__ == '__main__':
+    # run as a script from KQTrueSkill/ (python KQtrueskill.py), put the repo root on the path so the
+    # KQTrueSkill.* imports resolve like they do when this is imported as part of the package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from KQTrueSkill.diagnostics import Diagnostics, options_from_argv
 
 
 @dataclass
@@ -51,6 +64,13 @@ class AggregatedMatchStats:
             f'tournaments {self.tournaments}')
 
 
+class MatchObserver:
+    '''Gets each match's team ratings (bots included) before trueskill updates them.'''
+
+    def before_match(self, match, team1_ratings: [Rating], team2_ratings: [Rating]) -> None:
+        pass
+
+
 class RatingsChangeObserver:
     def __init__(self, teams):
         self.teams = teams
@@ -59,9 +79,13 @@ class RatingsChangeObserver:
         pass
 
 
+# module level (rather than a lambda) so that observer state can be pickled
+def keyed_match_stats():
+    return collections.defaultdict(AggregatedMatchStats)
+
+
 def double_keyed_match_stats():
-    return collections.defaultdict(
-        lambda: collections.defaultdict(AggregatedMatchStats))
+    return collections.defaultdict(keyed_match_stats)
 
     
 class RatingsChangeByOpponent(RatingsChangeObserver):
@@ -89,6 +113,514 @@ class RatingsChangeByTeammate(RatingsChangeObserver):
                     update)
 
         
+class TournamentSnapshots(Mapping):
+    '''Copy on write store of everyone's rating at the end of each tournament.
+
+    Each snapshot only records the players whose rating changed since the previous one, so
+    snapshots[tournament][player] finds that player's latest change at or before the snapshot.'''
+
+    def __init__(self, players=(), default_rating: Rating = None):
+        self.players = set(players)
+        self.default_rating = default_rating if default_rating is not None else Rating()
+        self.versions = {}  # versions[tournament] = position of that tournament's snapshot
+        self.player_versions = {}  # player_versions[player] = [version, ...] the player changed at
+        self.player_ratings = {}  # player_ratings[player] = [Rating, ...] matching player_versions
+        self.version_count = 0
+        self.version_tournaments = []  # version_tournaments[version] = tournament recorded at that version
+
+    def add_players(self, players):
+        # new players sit at the default rating in every earlier snapshot
+        self.players.update(players)
+
+    def record(self, tournament: str, changed_ratings: Dict[str, Rating]) -> None:
+        version = self.version_count
+        self.version_count += 1
+        self.version_tournaments.append(tournament)
+        for player, rating in changed_ratings.items():
+            if player not in self.player_versions:
+                self.player_versions[player] = []
+                self.player_ratings[player] = []
+            self.player_versions[player].append(version)
+            self.player_ratings[player].append(rating)
+        self.versions[tournament] = version
+
+    def rating_at(self, player: str, version: int) -> Rating:
+        if player not in self.players:
+            raise KeyError(player)
+        if player in self.player_versions:
+            i = bisect.bisect_right(self.player_versions[player], version)
+            if i > 0:
+                return self.player_ratings[player][i - 1]
+        return self.default_rating
+
+    # (tournament, Rating) for every tournament player's rating changed in, oldest first.  append_dataset
+    # records the last tournament replayed again, a player who changed in both of its snapshots gets the later one
+    def changes(self, player: str):
+        if player not in self.players:
+            raise KeyError(player)
+        previous = None
+        for version, rating in zip(self.player_versions.get(player, []), self.player_ratings.get(player, [])):
+            tournament = self.version_tournaments[version]
+            if previous is not None and previous[0] != tournament:
+                yield previous
+            previous = (tournament, rating)
+        if previous is not None:
+            yield previous
+
+    def __getitem__(self, tournament):
+        return TournamentSnapshot(self, self.versions[tournament])
+
+    def __iter__(self):
+        return iter(self.versions)
+
+    def __len__(self):
+        return len(self.versions)
+
+
+class TournamentSnapshot(Mapping):
+    '''Read only view of every player's rating as of one TournamentSnapshots version.'''
+
+    def __init__(self, store: TournamentSnapshots, version: int):
+        self.store = store
+        self.version = version
+
+    def __getitem__(self, player):
+        return self.store.rating_at(player, self.version)
+
+    def __iter__(self):
+        return iter(self.store.players)
+
+    def __len__(self):
+        return len(self.store.players)
+
+
+class RatingEventLog:
+    '''Every rating change of the replay, one row per player per match in replay order, stored a numpy
+    column per field.  Columns are preallocated and double in size when they fill up.
+
+    player, tournament, bracket, team and opponent_team are interned ids (see KQTrueSkill.intern_team), team is
+    the player's own team.  time is the match's POSIX timestamp.  wins and losses are from the player's side
+    of the set.'''
+
+    columns = {'player': np.int64, 'tournament': np.int64, 'bracket': np.int64, 'time': np.float64,
+               'team': np.int64, 'opponent_team': np.int64,
+               'old_mu': np.float64, 'old_sigma': np.float64, 'new_mu': np.float64, 'new_sigma': np.float64,
+               'wins': np.int64, 'losses': np.int64}
+
+    def __init__(self, capacity: int = 1024):
+        self.size = 0
+        self.data = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.columns.items()}
+
+    # add rows, every column given as an array of the same length
+    def append(self, **rows):
+        count = len(rows['player'])
+        capacity = len(self.data['player'])
+        if self.size + count > capacity:
+            capacity = max(2 * capacity, self.size + count)
+            for name, column in self.data.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.data[name] = grown
+        for name in self.columns:
+            self.data[name][self.size:self.size + count] = rows[name]
+        self.size += count
+
+    # the filled part of a column
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.data[name][:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+# KO and WC brackets keep their names, everything else (groups, pools, swiss, updown...) is group play
+def bracket_type(bracket: str) -> str:
+    if bracket in ('KO', 'WC'):
+        return bracket
+    return 'Group'
+
+
+class RatingTimeline:
+    '''Every player's rating after each of their matches, for "what was X's rating on date D" questions.
+
+    Built from the event log: each player's events in replay order (which is time order), with their times,
+    so a lookup is a binary search over one player's matches.  Stages of a tournament are found the same
+    way, by the position in the replay of the last match of that bracket.'''
+
+    def __init__(self, history):
+        events = history.events
+        self.player_ids = history.player_ids
+        self.tournament_ids = history.tournament_ids
+        self.tournament_names = history.tournament_names
+        self.bracket_names = history.bracket_names
+        self.default_rating = history.env.create_rating()
+
+        # player p's events are rows[offsets[p]:offsets[p + 1]], oldest first
+        players = events['player']
+        self.rows = np.argsort(players, kind='stable')
+        self.offsets = np.searchsorted(players[self.rows], np.arange(len(history.player_names) + 1))
+        self.times = events['time'][self.rows]
+        self.mu = events['new_mu'][self.rows]
+        self.sigma = events['new_sigma'][self.rows]
+        self.tournaments = events['tournament'][self.rows]
+        self.brackets = events['bracket'][self.rows]
+
+        # stage_ends[(tournament id, stage)] = last row of that stage, where a stage is a bracket name, a
+        # bracket_type or None for the whole tournament.  tournament_starts[tournament id] = its first row
+        self.stage_ends = {}
+        self.tournament_starts = {}
+        for tournament, bracket, row in zip(events['tournament'].tolist(), events['bracket'].tolist(),
+                                            range(len(events))):
+            for stage in (self.bracket_names[bracket], bracket_type(self.bracket_names[bracket]), None):
+                self.stage_ends[(tournament, stage)] = row
+            self.tournament_starts.setdefault(tournament, row)
+
+    def player_range(self, player: str) -> (int, int):
+        player_id = self.player_ids[player]
+        return int(self.offsets[player_id]), int(self.offsets[player_id + 1])
+
+    def rating(self, i: int) -> Rating:
+        return Rating(float(self.mu[i]), float(self.sigma[i]))
+
+    # player's rating after their last match that started at or before when
+    def rating_at(self, player: str, when: datetime.datetime) -> Rating:
+        start, end = self.player_range(player)
+        matches_played = int(np.searchsorted(self.times[start:end], when.timestamp(), side='right'))
+        if matches_played == 0:
+            return self.default_rating
+        return self.rating(start + matches_played - 1)
+
+    # (time, tournament, bracket, Rating after the match) for player's matches that started from start_time up to,
+    # not including, end_time.  either end can be left open
+    def ratings_between(self, player: str, start_time: datetime.datetime = None,
+                        end_time: datetime.datetime = None) -> [tuple]:
+        start, end = self.player_range(player)
+        times = self.times[start:end]
+        first = start + (int(np.searchsorted(times, start_time.timestamp(), side='left')) if start_time else 0)
+        last = start + (int(np.searchsorted(times, end_time.timestamp(), side='left')) if end_time else len(times))
+        return [(datetime.datetime.fromtimestamp(self.times[i], datetime.timezone.utc),
+                 self.tournament_names[self.tournaments[i]], self.bracket_names[self.brackets[i]], self.rating(i))
+                for i in range(first, last)]
+
+    # player's rating once a tournament, or a stage of it, was over.  stage is a bracket name ('KO', 'Group3')
+    # or a bracket_type ('Group' covers all the group brackets), None for the whole tournament
+    def rating_after(self, player: str, tournament: str, stage: str = None) -> Rating:
+        key = (self.tournament_ids[tournament], stage)
+        if key not in self.stage_ends:
+            raise Exception(f"{tournament} has no {stage} bracket")
+        start, end = self.player_range(player)
+        matches_played = int(np.searchsorted(self.rows[start:end], self.stage_ends[key], side='right'))
+        if matches_played == 0:
+            return self.default_rating
+        return self.rating(start + matches_played - 1)
+
+    # player's rating going into a tournament, before its first match
+    def rating_before(self, player: str, tournament: str) -> Rating:
+        start, end = self.player_range(player)
+        first_row = self.tournament_starts[self.tournament_ids[tournament]]
+        matches_played = int(np.searchsorted(self.rows[start:end], first_row, side='left'))
+        if matches_played == 0:
+            return self.default_rating
+        return self.rating(start + matches_played - 1)
+
+
+# every match is a dict with these keys, see ingest_matches_from_file
+match_fields = ['tournament', 'bracket', 'team1name', 'team2name', 'team1wins', 'team2wins', 'time']
+
+
+# how the games of a best of N set are fed to trueskill
+#   wins_first: all of team 1's wins, then all of its losses (the original behaviour)
+#   interleaved: alternate wins and losses, then whatever is left over
+#   moment_matching: score every game against the ratings from before the set and combine the
+#                    per game updates, so the order of games in the set doesn't matter
+SERIES_ORDERINGS = ['wins_first', 'interleaved', 'moment_matching']
+
+
+# True for each game team 1 won, in the order the games get rated
+def series_game_order(wins: int, losses: int, ordering: str) -> [bool]:
+    if ordering == 'wins_first':
+        return [True] * wins + [False] * losses
+    if ordering == 'interleaved':
+        alternating = min(wins, losses)
+        return [True, False] * alternating + [True] * (wins - alternating) + [False] * (losses - alternating)
+    raise Exception(f"no game order for series ordering {ordering}, expected one of {SERIES_ORDERINGS}")
+
+
+# two team updates it takes to rate a set, the 'rate calls' counter on either backend: one per game for the
+# sequential orderings, one per outcome for moment_matching
+def series_rate_calls(wins: int, losses: int, ordering: str) -> int:
+    if ordering == 'moment_matching':
+        return 2 if wins + losses > 0 else 0
+    return wins + losses
+
+
+# probability team1 beats team2 in one game, both lists of ratings objects
+def win_probability(team1: [Rating], team2: [Rating], ts: trueskill.TrueSkill) -> float:
+    delta_mu = sum(r.mu for r in team1) - sum(r.mu for r in team2)
+    sum_sigma = sum(r.sigma ** 2 for r in team1) + sum(r.sigma ** 2 for r in team2)
+    size = len(team1) + len(team2)
+    denom = math.sqrt(size * (ts.beta ** 2) + sum_sigma)
+    return ts.cdf(delta_mu / denom)
+
+
+# standard normal cdf of every entry of x, with the same erfc approximation as trueskill's default backend
+def normal_cdf_array(x: np.ndarray) -> np.ndarray:
+    z = np.abs(x) / math.sqrt(2)
+    t = 1. / (1. + z / 2.)
+    r = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (
+        0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (
+            0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (
+                -0.82215223 + t * 0.17087277
+            )))
+        )))
+    )))
+    return 0.5 * np.where(x > 0, 2. - r, r)
+
+
+# (mu sums, variance sums, sizes) of teams of ratings objects
+def team_rating_sums(teams: [[Rating]]) -> (np.ndarray, np.ndarray, np.ndarray):
+    sizes = np.array([len(team) for team in teams], dtype=np.int64)
+    team_index = np.repeat(np.arange(len(teams)), sizes)
+    ratings = [r for team in teams for r in team]
+    return (np.bincount(team_index, weights=[r.mu for r in ratings], minlength=len(teams)),
+            np.bincount(team_index, weights=[r.sigma ** 2 for r in ratings], minlength=len(teams)),
+            sizes)
+
+
+# win_probability for every pair of teams at once from their team_rating_sums:
+# win_probabilities[i, j] = probability team i beats team j
+def win_probability_matrix(mu_sums: np.ndarray, variance_sums: np.ndarray, sizes: np.ndarray,
+                           ts: trueskill.TrueSkill) -> np.ndarray:
+    delta_mu = mu_sums[:, None] - mu_sums[None, :]
+    sum_sigma = variance_sums[:, None] + variance_sums[None, :]
+    denom = np.sqrt((sizes[:, None] + sizes[None, :]) * (ts.beta ** 2) + sum_sigma)
+    return normal_cdf_array(delta_mu / denom)
+
+
+# teams are padded to this many players with bots
+TEAM_SIZE = 5
+
+# roughly what one rating in a snapshot costs: the Rating, its __dict__ and the snapshot dict's entry for it
+SNAPSHOT_RATING_BYTES = sys.getsizeof(Rating()) + sys.getsizeof(Rating().__dict__) + 16
+
+
+# Rating straight from trueskill's natural parameters (precision, precision adjusted mean), which is how Rating
+# stores itself.  Going through mu and sigma instead would round the last bit differently
+def natural_rating(pi: float, tau: float) -> Rating:
+    rating = Rating.__new__(Rating)
+    rating.pi = pi
+    rating.tau = tau
+    return rating
+
+
+class MatchPlan:
+    '''Matches compiled down to interned player ids, ready for replay_matches.
+
+    Every match's player ids live in one flat slots array, slots[offsets[i]:offsets[i + 1]] for match i: team 1
+    padded with bots up to TEAM_SIZE, then team 2 padded the same way.  Bots are -1, and KQTrueSkill keeps the
+    bot rating in the last entry of its rating arrays, so indexing with a match's slots picks up the bots too.'''
+
+    def __init__(self, history, matches):
+        self.matches = matches
+        self.tournaments = [m['tournament'] for m in matches]
+        self.team1_sizes = np.zeros(len(matches), dtype=np.int64)  # real players, bots not included
+        self.team2_sizes = np.zeros(len(matches), dtype=np.int64)
+        self.team1_lengths = np.zeros(len(matches), dtype=np.int64)  # team 1's slots, bots included
+        self.team1wins = np.array([m['team1wins'] for m in matches], dtype=np.int64)
+        self.team2wins = np.array([m['team2wins'] for m in matches], dtype=np.int64)
+        self.tournament_ids = np.zeros(len(matches), dtype=np.int64)
+        self.bracket_ids = np.array([history.intern_bracket(m['bracket']) for m in matches], dtype=np.int64)
+        self.times = np.array([m['time'].timestamp() for m in matches], dtype=np.float64)
+        self.team1_ids = np.zeros(len(matches), dtype=np.int64)
+        self.team2_ids = np.zeros(len(matches), dtype=np.int64)
+        slots = []
+        for i, m in enumerate(matches):
+            self.team1_ids[i] = history.intern_team(m['tournament'], m['team1name'])
+            self.team2_ids[i] = history.intern_team(m['tournament'], m['team2name'])
+            self.tournament_ids[i] = history.tournament_ids[m['tournament']]
+            teams = history.teams[m['tournament']]
+            team1 = [history.player_ids[player] for player in teams[m['team1name']]]
+            team2 = [history.player_ids[player] for player in teams[m['team2name']]]
+            self.team1_sizes[i] = len(team1)
+            self.team2_sizes[i] = len(team2)
+            team1 += [-1] * (TEAM_SIZE - len(team1))
+            team2 += [-1] * (TEAM_SIZE - len(team2))
+            self.team1_lengths[i] = len(team1)
+            slots.append(team1 + team2)
+        self.offsets = np.zeros(len(matches) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(match_slots) for match_slots in slots])
+        self.slots = np.array([player_id for match_slots in slots for player_id in match_slots], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.matches)
+
+
+def match_stats_from_events(history, teammates: bool):
+    '''Rebuilds what RatingsChangeByTeammate (teammates=True) or RatingsChangeByOpponent would have
+    observed, as group bys over history.events: stats[player][other player] = AggregatedMatchStats.
+
+    Each event is paired with every member of the other team's roster (or the player's own roster, minus
+    themselves), and sums are taken in replay order so they come out exactly as the observers added them.'''
+    events = history.events
+    player_count = len(history.player_names)
+    stats = double_keyed_match_stats()
+    if len(events) == 0:
+        return stats
+
+    # rosters of every interned team, flattened
+    rosters = [history.teams[tournament][team] for tournament, team in history.team_keys]
+    roster_sizes = np.array([len(roster) for roster in rosters], dtype=np.int64)
+    roster_offsets = np.concatenate([[0], np.cumsum(roster_sizes)])
+    roster_players = np.array([history.player_ids[player] for roster in rosters for player in roster],
+                              dtype=np.int64)
+
+    # one row per (event, other player)
+    team = events['team'] if teammates else events['opponent_team']
+    counts = roster_sizes[team]
+    row_event = np.repeat(np.arange(len(events)), counts)
+    row_position = np.arange(len(row_event)) - np.repeat(np.cumsum(counts) - counts, counts)
+    other = roster_players[roster_offsets[team][row_event] + row_position]
+    player = events['player'][row_event]
+    if teammates:
+        keep = other != player
+        row_event, player, other = row_event[keep], player[keep], other[keep]
+
+    pairs, first_row, pair_of_row = np.unique(player * player_count + other, return_index=True,
+                                              return_inverse=True)
+    wins = np.bincount(pair_of_row, weights=events['wins'][row_event], minlength=len(pairs))
+    losses = np.bincount(pair_of_row, weights=events['losses'][row_event], minlength=len(pairs))
+    net_rating_change = np.bincount(pair_of_row, weights=(events['new_mu'] - events['old_mu'])[row_event],
+                                    minlength=len(pairs))
+
+    # the distinct tournaments of each pair, grouped by pair
+    tournament_count = len(history.tournament_names)
+    pair_tournaments = np.unique(pair_of_row * tournament_count + events['tournament'][row_event])
+    tournament_offsets = np.searchsorted(pair_tournaments // tournament_count, np.arange(len(pairs) + 1))
+    tournament_ids = (pair_tournaments % tournament_count).tolist()
+
+    # insert in order of first appearance, the order the observers created the entries in
+    order = np.argsort(first_row, kind='stable')
+    names = history.player_names
+    tournament_names = history.tournament_names
+    tournament_offsets = tournament_offsets.tolist()
+    for j, player_id, other_id, pair_wins, pair_losses, pair_change in zip(
+            order.tolist(), (pairs[order] // player_count).tolist(), (pairs[order] % player_count).tolist(),
+            wins[order].astype(np.int64).tolist(), losses[order].astype(np.int64).tolist(),
+            net_rating_change[order].tolist()):
+        agg_stats = stats[names[player_id]][names[other_id]]
+        agg_stats.wins = pair_wins
+        agg_stats.losses = pair_losses
+        agg_stats.net_rating_change = pair_change
+        agg_stats.tournaments = {tournament_names[t]
+                                 for t in tournament_ids[tournament_offsets[j]:tournament_offsets[j + 1]]}
+    return stats
+
+
+class PlayerRatingsView(MutableMapping):
+    '''playerratings[name] = Rating, backed by the history's rating_pi / rating_tau arrays.'''
+
+    def __init__(self, history):
+        self.history = history
+
+    def __getitem__(self, player):
+        player_id = self.history.player_ids[player]
+        return natural_rating(float(self.history.rating_pi[player_id]), float(self.history.rating_tau[player_id]))
+
+    def __setitem__(self, player, rating):
+        player_id = self.history.player_ids[player]
+        self.history.rating_pi[player_id] = rating.pi
+        self.history.rating_tau[player_id] = rating.tau
+        self.history.ratings_version += 1
+
+    def __delitem__(self, player):
+        raise Exception(f"can't remove {player}, players are interned for the life of the history")
+
+    def __iter__(self):
+        return iter(self.history.player_names)
+
+    def __len__(self):
+        return len(self.history.player_names)
+
+
+class PlayerCounterView(Mapping):
+    '''playergames / playerwins / playerlosses [name] = int, backed by one of the history's count arrays.'''
+
+    def __init__(self, history, counts: str):
+        self.history = history
+        self.counts = counts
+
+    def __getitem__(self, player):
+        return int(getattr(self.history, self.counts)[self.history.player_ids[player]])
+
+    def __iter__(self):
+        return iter(self.history.player_names)
+
+    def __len__(self):
+        return len(self.history.player_names)
+
+
+# a manifest is a csv of (player file, match file) pairs with a header row, ingested top to bottom
+def read_dataset_manifest(filename: str) -> [(str, str)]:
+    with open(filename) as manifest_file:
+        rows = [row for row in list(csv.reader(manifest_file, delimiter=','))[1:] if row]
+    for row in rows:
+        if len(row) != 2:
+            raise Exception(f"{filename}: expected 'player file,match file' but found {row}")
+    return [(row[0], row[1]) for row in rows]
+
+
+# (header, rows) of a player file, one (tournament, team, player, scene) row per player.  a blank team means
+# the same team as the row above
+def read_player_file(filename: str) -> ([str], [tuple]):
+    with open(filename) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        header = next(csv_reader)
+        rows = []
+        last_seen_team = None
+        for row in csv_reader:
+            tournament = row[0]
+            playerteam = row[1]
+            playername = row[2]
+            playerscene = row[3]
+
+            if playerteam is None or playerteam.strip() == '':
+                playerteam = last_seen_team
+            else:
+                last_seen_team = playerteam
+            rows.append((tournament, playerteam, playername, playerscene))
+    return header, rows
+
+
+# every match in a match file, in file order, as dicts with match_fields
+def read_match_file(filename: str) -> [dict]:
+    with open(filename) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        next(csv_reader)
+        return [{"tournament": row[0],
+                 "bracket": row[1],
+                 "team1name": row[2],
+                 "team2name": row[3],
+                 "team1wins": int(row[4]),
+                 "team2wins": int(row[5]),
+                 "time": datetime.datetime.strptime(row[6], KQTrueSkill.datetime_format),
+                 } for row in csv_reader]
+
+
+# both files of a dataset, ready for KQTrueSkill.add_datasets.  run in the parsing processes
+def read_dataset(playerfile: str, matchfile: str) -> ([str], [tuple], [dict]):
+    return read_player_file(playerfile) + (read_match_file(matchfile),)
+
+
+# read_dataset for every dataset, a process per dataset up to one per cpu (processes=1 parses them here)
+def parse_datasets(datasets, processes: int = None) -> [tuple]:
+    if processes is None:
+        processes = min(len(datasets), os.cpu_count() or 1)
+    if processes <= 1:
+        return [read_dataset(playerfile, matchfile) for playerfile, matchfile in datasets]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(read_dataset, *zip(*datasets)))
+
+
 def sort_tournaments_by_date(tournament_list, history):
     return sorted(tournament_list,
                   key=lambda t: history.tournamentdates[t])
@@ -97,39 +629,294 @@ def sort_tournaments_by_date(tournament_list, history):
 class KQTrueSkill:
     datetime_format: str = "%Y-%m-%dT%H:%M:%S%z"
 
-    def __init__(self):
-        trueskill.setup(trueskill.MU, trueskill.SIGMA, trueskill.BETA, trueskill.TAU, draw_probability=0)
-        self.snapshots = {}  # self.snapshots[tournament] = {'playername' = , 'trueskill' = }
+    # known good (player file, match file) pairs, ingested in this order
+    approved_datasets = [('datasets/2019 Players.csv', 'datasets/2019 game results.csv'),
+                         ('datasets/SF-PDX-SEA-LA Players.csv', 'datasets/SF-PDX-SEA-LA game results.csv'),
+                         ('datasets/BB Players.csv', 'datasets/BB game results.csv'),
+                         ('datasets/CC Players.csv', 'datasets/CC game results.csv'),
+                         ('datasets/Midwest players.csv', 'datasets/Midwest game results.csv'),
+                         ('datasets/Coronation players.csv', 'datasets/Coronation game results.csv'),
+                         ]
+
+    # bump when parsing changes, so caches written by older code get rebuilt
+    dataset_cache_version: int = 1
+
+    # most matrices team_win_probabilities keeps around
+    win_probability_cache_size: int = 256
+
+    # the result of parsing the datasets, before any trueskill is run
+    ingested_attributes = ['matches', 'playerscenes', 'playerteams', 'playertournaments', 'incomplete_players',
+                           'tournaments', 'tournamentdates', 'teams']
+
+    # everything needed to pick up where a previous replay left off
+    persisted_attributes = ingested_attributes + [
+        'snapshots', 'player_ids', 'player_names', 'rating_pi', 'rating_tau', 'game_counts', 'win_counts',
+        'loss_counts', 'current_tournament', 'events', 'tournament_ids', 'tournament_names', 'bracket_ids',
+        'bracket_names', 'team_ids', 'team_keys', 'observers', 'bot_rating']
+
+    # parsing and rating state are only built when first used, see __getattr__
+    rating_attributes = ['snapshots', 'changed_players', 'player_ids', 'player_names', 'rating_pi', 'rating_tau',
+                         'game_counts', 'win_counts', 'loss_counts', 'playerratings', 'playergames', 'playerwins',
+                         'playerlosses', 'events', 'tournament_ids', 'tournament_names', 'bracket_ids',
+                         'bracket_names', 'team_ids', 'team_keys', 'current_tournament']
+
+    # reports built from the event log on first use after a replay, see build_match_reports / build_timeline
+    report_attributes = ['ratings_change_by_opponent', 'ratings_change_by_teammate', 'timeline']
+
+    # datasets: (player file, match file) pairs to ingest, in order, or the name of a manifest csv listing them.
+    #           defaults to approved_datasets
+    # players_only: only parse the datasets, never run trueskill. for tools that just need rosters
+    # state_file: load a history saved with save_state instead of replaying the datasets
+    # backend: 'trueskill' runs every game through trueskill.rate, 'numpy' uses the closed form two team update
+    # series_ordering: how the games in a set are rated, one of SERIES_ORDERINGS
+    # env: trueskill environment for this history, defaults to trueskill's MU/SIGMA/BETA/TAU without draws.
+    #      draw_probability is always 0, KQ games can't be drawn
+    # bot_rating: rating used for the missing players on teams with less than 5
+    # ingested: get_ingested_data() from another history, skips parsing the datasets
+    # match_observers: MatchObservers to run during the first replay
+    # diagnostics: where timings, counters and progress messages go, see Diagnostics
+    # store: a store.RatingStore to copy the parsed datasets into, and the rating history as it's replayed
+    #
+    # nothing is parsed or rated here.  the datasets are ingested the first time anything in
+    # ingested_attributes is used, and trueskill is run the first time anything in rating_attributes is used
+    def __init__(self, datasets=None, players_only: bool = False, state_file: str = None,
+                 backend: str = 'trueskill', series_ordering: str = 'wins_first', env: trueskill.TrueSkill = None,
+                 bot_rating: Rating = None, ingested: dict = None, match_observers: [MatchObserver] = None,
+                 diagnostics: Diagnostics = None, store=None):
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self.store = store
+        if env is None:
+            env = trueskill.TrueSkill(trueskill.MU, trueskill.SIGMA, trueskill.BETA, trueskill.TAU)
+        self.env = trueskill.TrueSkill(env.mu, env.sigma, env.beta, env.tau, draw_probability=0)
+        self.bot_rating = bot_rating if bot_rating is not None else Rating(mu=5.000, sigma=2)
+        self.manifest_file = datasets if isinstance(datasets, str) else None
+        if datasets is None:
+            datasets = self.approved_datasets
+        elif isinstance(datasets, str):
+            datasets = read_dataset_manifest(datasets)
+        self.datasets = list(datasets)
+        self.players_only = players_only
+        self.preingested = ingested
+        self.output_file_name: str = '../PlayerSkill.csv'
+        self.long_output_file_name: str = '../PlayerSkillHistory.csv'
+        self.state_file_name: str = 'KQTrueSkill.state'
+        self.dataset_cache_file_name: str = None  # None picks one per list of datasets, see dataset_cache_filename
+        self.observers = []  # RatingsChangeObservers, see notify_observers
+        self.ratings_version = 0  # bumped whenever any rating changes, see team_win_probabilities
+        self.win_probability_cache = {}  # [tuple of teams] = (ratings_version, win probability matrix)
+        self.match_observers = list(match_observers or [])  # see MatchObserver.before_match
+        self.use_backend(backend)
+        if series_ordering not in SERIES_ORDERINGS:
+            raise Exception(f"unknown series ordering {series_ordering}, expected one of {SERIES_ORDERINGS}")
+        self.series_ordering = series_ordering
+        if state_file is not None:
+            self.load_state(state_file)
+
+    # only called for attributes that don't exist yet, builds whichever stage they belong to
+    def __getattr__(self, name):
+        # check the name before touching self, this also runs on half built objects (e.g. while unpickling)
+        if name in KQTrueSkill.ingested_attributes:
+            self.ensure_ingested()
+        elif name in KQTrueSkill.rating_attributes:
+            self.ensure_rated()
+        elif name == 'timeline':
+            self.build_timeline()
+        elif name in KQTrueSkill.report_attributes:
+            self.build_match_reports()
+        else:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        return self.__dict__[name]
+
+    # parse the datasets, unless that already happened
+    def ensure_ingested(self):
+        if all(attribute in self.__dict__ for attribute in self.ingested_attributes):
+            return
         self.matches: [] = []
         self.playerscenes = {}
         self.playerteams = {}
-        self.playerratings = {}
         self.playertournaments = {}  # playertournaments[playername] = ["BB4","KQ30",...]
-        self.playergames = {}
-        self.playerwins = {}
-        self.playerlosses = {}
         self.incomplete_players = []  # list of playernames w/0 scenes
         self.tournaments = []
         self.tournamentdates = {}  # source data only ties matches directly to a date.
         self.teams = {}  # [tournament][team name] = {p1, p2, p3...}
-        self.output_file_name: str = '../PlayerSkill.csv'
+        if self.preingested is not None:
+            for attribute in self.ingested_attributes:
+                setattr(self, attribute, self.preingested[attribute])
+        else:
+            self.ingest_datasets(self.datasets)
+        self.write_ingested_to_store()
+
+    # parse the datasets if needed and run trueskill on them, unless that already happened
+    def ensure_rated(self):
+        if all(attribute in self.__dict__ for attribute in self.rating_attributes):
+            return
+        self.ensure_ingested()
+        self.calculate_trueskills()
+
+    def reset_rating_state(self):
+        if self.players_only:
+            # an AttributeError, so hasattr, getattr with a default, copy and pickle see the rating attributes
+            # as missing instead of failing
+            raise AttributeError("this history was created with players_only=True and has no ratings")
+        # rating state lives in arrays indexed by interned player id, with the bot in the last entry.
+        # ratings are kept as trueskill's natural parameters, pi = 1 / sigma^2 and tau = pi * mu.
+        # playerratings / playergames / playerwins / playerlosses are dict views onto them
+        self.player_ids = {}  # player_ids[playername] = id
+        self.player_names = []  # player_names[id] = playername
+        self.rating_pi = np.array([self.bot_rating.pi])
+        self.rating_tau = np.array([self.bot_rating.tau])
+        self.game_counts = np.zeros(0, dtype=np.int64)
+        self.win_counts = np.zeros(0, dtype=np.int64)
+        self.loss_counts = np.zeros(0, dtype=np.int64)
+        self.playerratings = PlayerRatingsView(self)
+        self.playergames = PlayerCounterView(self, 'game_counts')
+        self.playerwins = PlayerCounterView(self, 'win_counts')
+        self.playerlosses = PlayerCounterView(self, 'loss_counts')
+        self.snapshots = TournamentSnapshots(default_rating=self.env.create_rating())  # [tournament][playername] = Rating
+        self.changed_players = set()  # ids of players whose rating changed since the last snapshot
+        self.events = RatingEventLog()
+        self.tournament_ids = {}  # tournament_ids[tournament] = id
+        self.tournament_names = []  # tournament_names[id] = tournament
+        self.bracket_ids = {}  # bracket_ids[bracket] = id
+        self.bracket_names = []  # bracket_names[id] = bracket
+        self.team_ids = {}  # team_ids[(tournament, team name)] = id
+        self.team_keys = []  # team_keys[id] = (tournament, team name)
+        self.clear_match_reports()
+        self.ratings_version += 1
+        self.current_tournament: str = ''  # last tournament replayed, snapshots are taken when this changes
+        if self.store is not None:
+            self.store.clear_ratings()
+
+    # ratings_change_by_opponent / ratings_change_by_teammate, the stats of every pair of players that met
+    # as opponents or teammates, grouped from the event log
+    def build_match_reports(self):
+        self.ensure_rated()
         self.ratings_change_by_opponent = RatingsChangeByOpponent(self.teams)
+        self.ratings_change_by_opponent.ratings_change_by_opp = match_stats_from_events(self, teammates=False)
         self.ratings_change_by_teammate = RatingsChangeByTeammate(self.teams)
-        self.observers = [self.ratings_change_by_opponent, self.ratings_change_by_teammate]
-        self.process_approved_datasets()
+        self.ratings_change_by_teammate.ratings_change_by_teammate = match_stats_from_events(self, teammates=True)
+
+    # self.timeline, see RatingTimeline
+    def build_timeline(self):
+        self.ensure_rated()
+        self.timeline = RatingTimeline(self)
+
+    # reports are rebuilt the next time they're used
+    def clear_match_reports(self):
+        for attribute in self.report_attributes:
+            self.__dict__.pop(attribute, None)
+
+    def use_backend(self, backend: str):
+        if backend == 'trueskill':
+            self.engine = None
+        elif backend == 'numpy':
+            # imported here since twoteam imports this module, not to keep numpy optional (it's required)
+            from KQTrueSkill.twoteam import TwoTeamEngine
+            self.engine = TwoTeamEngine(self.env)
+        else:
+            raise Exception(f"unknown backend {backend}, expected 'trueskill' or 'numpy'")
+        self.backend = backend
 
-    # ingest the known good datasets automatically
+    # ingest the known good datasets and run trueskill on them straight away
     def process_approved_datasets(self):
-        self.ingest_dataset('datasets/2019 Players.csv', 'datasets/2019 game results.csv')
-        self.ingest_dataset('datasets/SF-PDX-SEA-LA Players.csv', 'datasets/SF-PDX-SEA-LA game results.csv')
-        self.ingest_dataset('datasets/BB Players.csv', 'datasets/BB game results.csv')
-        self.ingest_dataset('datasets/CC Players.csv', 'datasets/CC game results.csv')
-        self.ingest_dataset('datasets/Midwest players.csv', 'datasets/Midwest game results.csv')
-        self.ingest_dataset('datasets/Coronation players.csv', 'datasets/Coronation game results.csv')
-
-        # run trueskill on the matches
+        self.datasets = list(self.approved_datasets)
+        self.ensure_ingested()
         self.calculate_trueskills()
 
+    # ingest datasets in order, from the parsed dataset cache when none of the csvs changed
+    def ingest_datasets(self, datasets):
+        cache_file = self.dataset_cache_filename(datasets)
+        cache_key = self.dataset_cache_key(datasets)
+        if not self.load_dataset_cache(cache_file, cache_key):
+            with self.diagnostics.timer('parse'):
+                parsed = parse_datasets(datasets)
+            self.add_datasets(datasets, parsed)
+            self.write_dataset_cache(cache_file, cache_key)
+
+    # adds datasets parsed by read_dataset, in order.  each dataset's players are added before its matches are
+    # checked, so a match file can only use teams from its own and earlier player files.  every match file is
+    # sorted on its own, then merged with the matches already known, which are sorted too
+    def add_datasets(self, datasets, parsed):
+        streams = [self.matches]
+        tracking = len(self.matches)
+        for (playerfile, matchfile), (header, player_rows, matches) in zip(datasets, parsed):
+            with self.diagnostics.timer('parse'):
+                self.add_players(playerfile, header, player_rows)
+            with self.diagnostics.timer('validate'):
+                errors = self.check_matches(matches)
+            tracking += len(matches)
+            self.diagnostics.info(f"Processed {len(matches)} matches, now tracking {tracking} matches.",
+                                  file=matchfile, matches=len(matches))
+            if errors != '':
+                raise Exception(errors)
+            self.add_tournament_dates(matches)
+            with self.diagnostics.timer('sort'):
+                streams.append(sorted(matches, key=lambda match: match["time"]))
+        # ensure matches will always process in historical order.  heapq.merge keeps ties in stream order, so this
+        # is the same order as sorting everything at once
+        with self.diagnostics.timer('sort'):
+            self.matches = list(heapq.merge(*streams, key=lambda match: match["time"]))
+
+    # content hash of the dataset files, any edit (or a different set or order of files) changes it
+    def dataset_cache_key(self, datasets) -> str:
+        digest = hashlib.sha256(f"v{self.dataset_cache_version}".encode())
+        for playerfile, matchfile in datasets:
+            for filename in (playerfile, matchfile):
+                with open(filename, mode='rb') as dataset_file:
+                    contents = dataset_file.read()
+                digest.update(f"{filename}:{len(contents)}:".encode())
+                digest.update(contents)
+        return digest.hexdigest()
+
+    # dataset_cache_file_name if set.  otherwise next to the manifest (or the first player file), named by a hash
+    # of the list of files, so histories built from different manifests don't overwrite each other's cache
+    def dataset_cache_filename(self, datasets) -> str:
+        if self.dataset_cache_file_name is not None:
+            return self.dataset_cache_file_name
+        files_hash = hashlib.sha256(repr([tuple(dataset) for dataset in datasets]).encode()).hexdigest()[:16]
+        if self.manifest_file is not None:
+            directory = os.path.dirname(self.manifest_file)
+        else:
+            directory = os.path.dirname(datasets[0][0]) if datasets else ''
+        return os.path.join(directory, f"parsed-{files_hash}.cache")
+
+    # matches are stored a column per field rather than a dict per match.  the cache is only a speedup, a
+    # directory that can't be written to is reported and otherwise ignored
+    def write_dataset_cache(self, filename: str, cache_key: str):
+        ingested = self.get_ingested_data()
+        ingested['matches'] = {field: [m[field] for m in self.matches] for field in match_fields}
+        try:
+            with open(filename, mode='wb') as cache_file:
+                pickle.dump({'key': cache_key, 'ingested': ingested}, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            self.diagnostics.warning(f"Couldn't write dataset cache {filename} ({e})", file=filename)
+
+    # returns False, leaving everything untouched, if filename has no cache for cache_key
+    def load_dataset_cache(self, filename: str, cache_key: str) -> bool:
+        # anything that isn't a cache this version wrote for these datasets (unreadable, truncated, another
+        # pickle, an older layout) is a miss and the datasets get parsed
+        try:
+            with self.diagnostics.timer('load dataset cache'):
+                with open(filename, mode='rb') as cache_file:
+                    cache = pickle.load(cache_file)
+            if cache.get('key') != cache_key:
+                self.diagnostics.info(f"Datasets changed since {filename} was written, parsing datasets")
+                return False
+            ingested = cache['ingested']
+            columns = ingested['matches']
+            loaded = {attribute: ingested[attribute] for attribute in self.ingested_attributes}
+            loaded['matches'] = [dict(zip(match_fields, values))
+                                 for values in zip(*(columns[f] for f in match_fields))]
+        except (OSError, EOFError, ImportError, pickle.UnpicklingError, AttributeError, TypeError, KeyError) as e:
+            self.diagnostics.info(f"No usable dataset cache at {filename} ({e!r}), parsing datasets")
+            return False
+
+        for attribute in self.ingested_attributes:
+            setattr(self, attribute, loaded[attribute])
+        self.diagnostics.info(f"Loaded {len(self.matches)} matches and {len(self.playerteams)} players from "
+                              f"{filename}.")
+        return True
+
     def test_dataset(self, player_file, results_file):
         self.ingest_dataset(player_file, results_file)
         # todo report teams with no matches
@@ -139,110 +926,328 @@ class KQTrueSkill:
     def ingest_dataset(self, playerfile: str, matchfile: str):
         # must ingest players first
         # reports new players found in this file
-        self.ingest_players_from_file(playerfile)
-
         # expect Exceptions if your team names don't match
-        self.ingest_matches_from_file(matchfile)
+        self.add_datasets([(playerfile, matchfile)], [read_dataset(playerfile, matchfile)])
+        self.write_ingested_to_store()
+
+    # add a new tournament on top of the current history, only running trueskill on its matches.
+    # the new matches have to come after everything already replayed, otherwise use ingest_dataset and
+    # calculate_trueskills to rebuild the whole history
+    def append_dataset(self, playerfile: str, matchfile: str):
+        self.ensure_rated()
+        known_matches = len(self.matches)
+        header, player_rows, matches = read_dataset(playerfile, matchfile)
+
+        # check both files before touching any state, so a bad dataset leaves the history usable
+        if known_matches > 0:
+            last_time = self.matches[-1]["time"]
+            for match in matches:
+                if match["time"] < last_time:
+                    raise Exception(f"{matchfile} has a match at {match['time']}, before the last match already "
+                                    f"processed ({last_time}). Use ingest_dataset and calculate_trueskills instead.")
+        errors = self.check_matches(matches, self.teams_with_players(player_rows))
+        if errors != '':
+            raise Exception(errors)
+
+        self.add_players(playerfile, header, player_rows)
+        self.add_matches(matchfile, matches)
+        new_matches = sorted(self.matches[known_matches:], key=lambda match: match["time"])
+        self.matches[known_matches:] = new_matches
+        self.write_ingested_to_store()
+
+        new_players = [player for player in self.playerteams.keys() if player not in self.player_ids]
+        self.intern_players(new_players)
+        self.snapshots.add_players(new_players)
 
-        # ensure matches will always process in historical order
-        self.matches = sorted(self.matches, key=lambda match: match["time"])
+        with self.diagnostics.timer('replay'):
+            self.replay_matches(new_matches)
 
-    # wipe old ratings objects and recalculate trueskill, compare new result with old ratings
+    # saves everything append_dataset needs to continue this history later, see KQTrueSkill(state_file=...)
+    def save_state(self, filename: str = None):
+        if filename is None:
+            filename = self.state_file_name
+        state = {attribute: getattr(self, attribute) for attribute in self.persisted_attributes}
+        # trueskill environments don't pickle, keep their settings instead
+        state['env'] = [self.env.mu, self.env.sigma, self.env.beta, self.env.tau]
+        with open(filename, mode='wb') as state_file:
+            pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get_ingested_data(self) -> dict:
+        return {attribute: getattr(self, attribute) for attribute in self.ingested_attributes}
+
+    def load_state(self, filename: str = None):
+        if filename is None:
+            filename = self.state_file_name
+        with open(filename, mode='rb') as state_file:
+            state = pickle.load(state_file)
+        for attribute in self.persisted_attributes:
+            setattr(self, attribute, state[attribute])
+        self.env = trueskill.TrueSkill(*state['env'], draw_probability=0)
+        self.use_backend(self.backend)
+        self.changed_players = set()
+        self.playerratings = PlayerRatingsView(self)
+        self.playergames = PlayerCounterView(self, 'game_counts')
+        self.playerwins = PlayerCounterView(self, 'win_counts')
+        self.playerlosses = PlayerCounterView(self, 'loss_counts')
+        self.clear_match_reports()
+        self.ratings_version += 1
+        self.diagnostics.info(f"Loaded {len(self.matches)} matches and {len(self.playerratings)} players from {filename}.")
+        self.write_ingested_to_store()
+
+    # copies the parsed datasets into the store, if there is one
+    def write_ingested_to_store(self):
+        if self.store is not None:
+            with self.diagnostics.timer('store write'):
+                self.store.load_ingested(self)
+
+    # wipe old ratings objects and recalculate trueskill.  compare_ratings can diff the result against a copy of
+    # the old playerratings taken beforehand
     # side effect: update player games & w/l counts
     def calculate_trueskills(self):
-        # save old ratings for later comparison
-        old_playerratings = self.playerratings
-
-        # make clean ratings objects
-        self.playerratings = {}
-        for player in self.playerteams.keys():
-            self.playerratings[player] = Rating()
+        # make clean ratings, counters and observers
+        self.reset_rating_state()
+        self.intern_players(self.playerteams.keys())
+        self.snapshots.add_players(self.player_names)
 
         # calculate complete history
-        current_tournament: str = ''
-        for m in self.matches:
-            t1ratings = []
-            t2ratings = []
-            tournament: str = m['tournament']
-            team1name: str = m['team1name']
-            team2name: str = m['team2name']
-            team1wins: int = m['team1wins']
-            team2wins: int = m['team2wins']
+        with self.diagnostics.timer('replay'):
+            self.replay_matches(self.matches)
+
+    # give new players the next ids, a starting rating and zeroed counters, keeping the bot in the last entry
+    def intern_players(self, players):
+        new_players = [player for player in players if player not in self.player_ids]
+        for player in new_players:
+            self.player_ids[player] = len(self.player_names)
+            self.player_names.append(player)
+        start = self.env.create_rating()
+        self.rating_pi = np.concatenate([self.rating_pi[:-1], np.full(len(new_players), start.pi),
+                                         [self.bot_rating.pi]])
+        self.rating_tau = np.concatenate([self.rating_tau[:-1], np.full(len(new_players), start.tau),
+                                          [self.bot_rating.tau]])
+        self.game_counts = np.concatenate([self.game_counts, np.zeros(len(new_players), dtype=np.int64)])
+        self.win_counts = np.concatenate([self.win_counts, np.zeros(len(new_players), dtype=np.int64)])
+        self.loss_counts = np.concatenate([self.loss_counts, np.zeros(len(new_players), dtype=np.int64)])
+
+    # id of a team, and of its tournament, for the event log
+    def intern_team(self, tournament: str, team: str) -> int:
+        if tournament not in self.tournament_ids:
+            self.tournament_ids[tournament] = len(self.tournament_names)
+            self.tournament_names.append(tournament)
+        key = (tournament, team)
+        if key not in self.team_ids:
+            self.team_ids[key] = len(self.team_keys)
+            self.team_keys.append(key)
+        return self.team_ids[key]
+
+    def intern_bracket(self, bracket: str) -> int:
+        if bracket not in self.bracket_ids:
+            self.bracket_ids[bracket] = len(self.bracket_names)
+            self.bracket_names.append(bracket)
+        return self.bracket_ids[bracket]
+
+    def compile_match_plan(self, matches) -> MatchPlan:
+        return MatchPlan(self, matches)
+
+    # run trueskill over matches, in order, on top of the current ratings
+    def replay_matches(self, matches):
+        plan = self.compile_match_plan(matches)
+
+        # games and w/l counts don't depend on ratings, so count them for the whole plan at once
+        slot_counts = np.diff(plan.offsets)
+        slot_match = np.repeat(np.arange(len(plan)), slot_counts)
+        slot_on_team1 = (np.arange(len(plan.slots)) - plan.offsets[slot_match]) < plan.team1_lengths[slot_match]
+        players = plan.slots >= 0
+        slot_team1wins, slot_team2wins = plan.team1wins[slot_match], plan.team2wins[slot_match]
+        slot_wins = np.where(slot_on_team1, slot_team1wins, slot_team2wins)
+        slot_losses = np.where(slot_on_team1, slot_team2wins, slot_team1wins)
+        np.add.at(self.game_counts, plan.slots[players], (slot_team1wins + slot_team2wins)[players])
+        np.add.at(self.win_counts, plan.slots[players], slot_wins[players])
+        np.add.at(self.loss_counts, plan.slots[players], slot_losses[players])
+        self.diagnostics.count('series rated', len(plan))
+        self.diagnostics.count('games rated', int((plan.team1wins + plan.team2wins).sum()))
+
+        # teams with < 5 players are assumed to have played with bots.
+        # we include bots as very low skill players, and don't track the results of their games
+        self.diagnostics.count('bot fills', int((plan.slots == -1).sum()))
+        short_teams = collections.Counter()
+        for i in np.flatnonzero(plan.team1_sizes < TEAM_SIZE).tolist():
+            short_teams[(plan.tournaments[i], plan.matches[i]['team1name'])] += 1
+        for i in np.flatnonzero(plan.team2_sizes < TEAM_SIZE).tolist():
+            short_teams[(plan.tournaments[i], plan.matches[i]['team2name'])] += 1
+        for (tournament, team), count in short_teams.items():
+            self.diagnostics.info(f"found team with <5 players: {team} ({count} matches)",
+                                  tournament=tournament, team=team, matches=count)
+
+        # every slot's rating before and after its match, for the event log
+        slot_old_pi = np.empty(len(plan.slots))
+        slot_old_tau = np.empty(len(plan.slots))
+        slot_new_pi = np.empty(len(plan.slots))
+        slot_new_tau = np.empty(len(plan.slots))
+
+        current_tournament: str = self.current_tournament
+        offsets = plan.offsets.tolist()
+        team1_sizes = plan.team1_sizes.tolist()
+        team2_sizes = plan.team2_sizes.tolist()
+        team1_lengths = plan.team1_lengths.tolist()
+        all_team1wins = plan.team1wins.tolist()
+        all_team2wins = plan.team2wins.tolist()
+        for i in range(len(plan)):
+            m = plan.matches[i]
+            tournament: str = plan.tournaments[i]
+            slots = plan.slots[offsets[i]:offsets[i + 1]]
+            team1_size: int = team1_sizes[i]
+            team2_size: int = team2_sizes[i]
+            team1_length: int = team1_lengths[i]
+            team1wins: int = all_team1wins[i]
+            team2wins: int = all_team2wins[i]
 
             if current_tournament != tournament:
                 self.record_trueskill_snapshot(current_tournament)
                 current_tournament = tournament
-                print(f"processing {tournament}")
-
-            # Trueskill wants arrays of ratings objects for each player
-            # Order doesn't matter to trueskill, but it does matter to us, so preserve order as found in
-            # the teams collection
-            for player in self.teams[tournament][team1name]:
-                t1ratings.append(self.playerratings[player])
-                self.playergames[player] += team1wins + team2wins
-                self.playerwins[player] += team1wins
-                self.playerlosses[player] += team2wins
-
-
-            for player in self.teams[tournament][team2name]:
-                t2ratings.append(self.playerratings[player])
-                self.playergames[player] += team1wins + team2wins
-                self.playerwins[player] += team2wins
-                self.playerlosses[player] += team1wins
-
-            # teams with < 5 players are assumed to have played with bots.
-            # we include bots as very low skill players, and don't track the results of their games
-            if len(self.teams[tournament][team1name]) < 5:
-                print(f"found team with <5 players: {team1name}")
-                for _ in range(len(self.teams[tournament][team1name]), 5):
-                    t1ratings.append(self.create_bot())
-            if len(self.teams[tournament][team2name]) < 5:
-                print(f"found team with <5 players: {team2name}")
-                for _ in range(len(self.teams[tournament][team2name]), 5):
-                    t2ratings.append(self.create_bot())
-
-            # update ratings for each game win
-            for x in range(team1wins):
-                t1ratings, t2ratings = rate([t1ratings, t2ratings], ranks=[0, 1])
-
-            for x in range(team2wins):
-                t1ratings, t2ratings = rate([t1ratings, t2ratings], ranks=[1, 0])
-
-
-            # Prepare a list of RatingsUpdate to send to observers
-            all_updates = []
-            for i in range(len(self.teams[tournament][team1name])):
-                all_updates.append(RatingsUpdate(
-                    tournament=tournament,
-                    my_team_name=team1name,
-                    their_team_name=team2name,
-                    my_player_name=self.teams[tournament][team1name][i],
-                    my_old_rating=self.playerratings[self.teams[tournament][team1name][i]],
-                    my_new_rating=t1ratings[i],
-                    wins=team1wins,
-                    losses=team2wins))
-            for i in range(len(self.teams[tournament][team2name])):
-                all_updates.append(RatingsUpdate(
-                    tournament=tournament,
-                    my_team_name=team2name,
-                    their_team_name=team1name,
-                    my_player_name=self.teams[tournament][team2name][i],
-                    my_old_rating=self.playerratings[self.teams[tournament][team2name][i]],
-                    my_new_rating=t2ratings[i],
-                    wins=team2wins,
-                    losses=team1wins))
-
-            for update in all_updates:
-                for observer in self.observers:
-                    observer.observe(update)
-
-            # now put the ratings back into the main dict
-            for i in range(len(self.teams[tournament][team1name])):
-                self.playerratings[self.teams[tournament][team1name][i]] = t1ratings[i]
-            for i in range(len(self.teams[tournament][team2name])):
-                self.playerratings[self.teams[tournament][team2name][i]] = t2ratings[i]
+                self.diagnostics.info(f"processing {tournament}", tournament=tournament)
+
+            # bots pick up the bot rating from the end of the arrays
+            old_pi = self.rating_pi[slots]
+            old_tau = self.rating_tau[slots]
+
+            if len(self.match_observers) > 0:
+                with self.diagnostics.timer('observers'):
+                    ratings = [natural_rating(pi, tau) for pi, tau in zip(old_pi.tolist(), old_tau.tolist())]
+                    for observer in self.match_observers:
+                        observer.before_match(m, ratings[:team1_length], ratings[team1_length:])
+
+            # update ratings for the whole set
+            new_pi, new_tau = self.rate_series_natural(old_pi, old_tau, team1_length, team1wins, team2wins)
+
+            if len(self.observers) > 0:
+                with self.diagnostics.timer('observers'):
+                    self.notify_observers(m, slots, team1_size, team1_length, team2_size,
+                                          old_pi, old_tau, new_pi, new_tau)
+
+            slot_old_pi[offsets[i]:offsets[i + 1]] = old_pi
+            slot_old_tau[offsets[i]:offsets[i + 1]] = old_tau
+            slot_new_pi[offsets[i]:offsets[i + 1]] = new_pi
+            slot_new_tau[offsets[i]:offsets[i + 1]] = new_tau
+
+            # now put the ratings back, then restore the bot rating that the bots' slots wrote over
+            self.rating_pi[slots] = new_pi
+            self.rating_tau[slots] = new_tau
+            self.rating_pi[-1] = self.bot_rating.pi
+            self.rating_tau[-1] = self.bot_rating.tau
+            self.changed_players.update(slots[:team1_size].tolist())
+            self.changed_players.update(slots[team1_length:team1_length + team2_size].tolist())
         self.record_trueskill_snapshot(current_tournament)
-
+        self.current_tournament = current_tournament
+
+        # bots don't get events
+        first_event = len(self.events)
+        slot_team = np.where(slot_on_team1, plan.team1_ids[slot_match], plan.team2_ids[slot_match])
+        slot_opponent_team = np.where(slot_on_team1, plan.team2_ids[slot_match], plan.team1_ids[slot_match])
+        self.events.append(player=plan.slots[players],
+                           tournament=plan.tournament_ids[slot_match][players],
+                           bracket=plan.bracket_ids[slot_match][players],
+                           time=plan.times[slot_match][players],
+                           team=slot_team[players],
+                           opponent_team=slot_opponent_team[players],
+                           old_mu=(slot_old_tau / slot_old_pi)[players],
+                           old_sigma=np.sqrt(1 / slot_old_pi)[players],
+                           new_mu=(slot_new_tau / slot_new_pi)[players],
+                           new_sigma=np.sqrt(1 / slot_new_pi)[players],
+                           wins=slot_wins[players],
+                           losses=slot_losses[players])
+        if self.store is not None:
+            with self.diagnostics.timer('store write'):
+                self.store.write_rating_events(self, first_event)
+        self.clear_match_reports()
+        self.ratings_version += 1
+
+    # Prepare a list of RatingsUpdate to send to observers
+    def notify_observers(self, m, slots, team1_size, team1_length, team2_size, old_pi, old_tau, new_pi, new_tau):
+        old_ratings = [natural_rating(pi, tau) for pi, tau in zip(old_pi.tolist(), old_tau.tolist())]
+        new_ratings = [natural_rating(pi, tau) for pi, tau in zip(new_pi.tolist(), new_tau.tolist())]
+        all_updates = []
+        for i in range(team1_size):
+            all_updates.append(RatingsUpdate(
+                tournament=m['tournament'],
+                my_team_name=m['team1name'],
+                their_team_name=m['team2name'],
+                my_player_name=self.player_names[slots[i]],
+                my_old_rating=old_ratings[i],
+                my_new_rating=new_ratings[i],
+                wins=m['team1wins'],
+                losses=m['team2wins']))
+        for i in range(team1_length, team1_length + team2_size):
+            all_updates.append(RatingsUpdate(
+                tournament=m['tournament'],
+                my_team_name=m['team2name'],
+                their_team_name=m['team1name'],
+                my_player_name=self.player_names[slots[i]],
+                my_old_rating=old_ratings[i],
+                my_new_rating=new_ratings[i],
+                wins=m['team2wins'],
+                losses=m['team1wins']))
+
+        for update in all_updates:
+            for observer in self.observers:
+                observer.observe(update)
+
+    # rates a best of N set where team1 won wins games and lost losses games, returns the new ratings of both teams.
+    # one call per set, but only the numpy backend and moment_matching take the cost per set: on the trueskill
+    # backend wins_first and interleaved still run trueskill.rate once per game, see rate_series_trueskill
+    def rate_series(self, team1: [Rating], team2: [Rating], wins: int, losses: int, ordering: str = None):
+        if ordering is None:
+            ordering = self.series_ordering
+        if self.engine is not None:
+            self.diagnostics.count('rate calls', series_rate_calls(wins, losses, ordering))
+            return self.engine.rate_series(team1, team2, wins, losses, ordering)
+        return self.rate_series_trueskill(team1, team2, wins, losses, ordering)
+
+    # rate_series on arrays of natural parameters (see rating_pi / rating_tau), team 1 in the first team1_size entries
+    def rate_series_natural(self, pi: np.ndarray, tau: np.ndarray, team1_size: int, wins: int, losses: int,
+                            ordering: str = None):
+        if ordering is None:
+            ordering = self.series_ordering
+        if self.engine is not None:
+            self.diagnostics.count('rate calls', series_rate_calls(wins, losses, ordering))
+            mu, sigma = self.engine.rate_series_arrays(tau / pi, np.sqrt(1 / pi), team1_size, wins, losses, ordering)
+            pi = 1 / (sigma * sigma)
+            return pi, pi * mu
+        ratings = [natural_rating(p, t) for p, t in zip(pi.tolist(), tau.tolist())]
+        team1, team2 = self.rate_series_trueskill(ratings[:team1_size], ratings[team1_size:], wins, losses, ordering)
+        return np.array([r.pi for r in team1 + team2]), np.array([r.tau for r in team1 + team2])
+
+    # the reference implementation the numpy backend is checked against, so the sequential orderings deliberately
+    # keep trueskill's own factor graph and its per game cost (a rate call per game).  use backend='numpy' or
+    # moment_matching (two rate calls per set) when speed matters
+    def rate_series_trueskill(self, team1: [Rating], team2: [Rating], wins: int, losses: int, ordering: str):
+        if ordering == 'moment_matching':
+            return self.rate_series_moment_matching(team1, team2, wins, losses)
+        for team1_won in series_game_order(wins, losses, ordering):
+            team1, team2 = self.env.rate([team1, team2], ranks=[0, 1] if team1_won else [1, 0])
+        self.diagnostics.count('rate calls', series_rate_calls(wins, losses, ordering))
+        return team1, team2
+
+    # trueskill.rate version of TwoTeamEngine.rate_series moment matching
+    def rate_series_moment_matching(self, team1: [Rating], team2: [Rating], wins: int, losses: int):
+        games = wins + losses
+        if games == 0:
+            return team1, team2
+        tau = self.env.tau
+        # rate adds tau^2 itself, so leave one game's worth of dynamics out of the prior we hand it
+        prior = [Rating(r.mu, math.sqrt(r.sigma ** 2 + (games - 1) * tau ** 2)) for r in team1 + team2]
+        won1, won2 = self.env.rate([prior[:len(team1)], prior[len(team1):]], ranks=[0, 1])
+        lost1, lost2 = self.env.rate([prior[:len(team1)], prior[len(team1):]], ranks=[1, 0])
+        self.diagnostics.count('rate calls', series_rate_calls(wins, losses, 'moment_matching'))
+
+        # multiply each game's update into the prior, in natural parameters (precision, precision adjusted mean)
+        new_ratings = []
+        for r, won, lost in zip(prior, list(won1) + list(won2), list(lost1) + list(lost2)):
+            prior_pi = 1 / (r.sigma ** 2 + tau ** 2)
+            prior_tau = r.mu * prior_pi
+            pi = prior_pi + wins * (won.pi - prior_pi) + losses * (lost.pi - prior_pi)
+            pi_mu = prior_tau + wins * (won.tau - prior_tau) + losses * (lost.tau - prior_tau)
+            new_ratings.append(Rating(pi_mu / pi, math.sqrt(1 / pi)))
+        return new_ratings[:len(team1)], new_ratings[len(team1):]
 
     def compare_ratings(self, old_playerratings, playerratings):
         new_players = []
@@ -260,34 +1265,21 @@ class KQTrueSkill:
             if p not in old_playerratings.keys():
                 new_players.append(p)
 
-        print(f"New Players: {new_players}")
-        print(f"Removed players: {removed_players}")
-        print(f"Changed players: {shared_player_deltas}")
+        self.diagnostics.info(f"New Players: {new_players}")
+        self.diagnostics.info(f"Removed players: {removed_players}")
+        self.diagnostics.info(f"Changed players: {shared_player_deltas}")
 
     def ingest_players_from_file(self, filename: str):
-        with open(filename) as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            line_count = 0
-            last_seen_team = None
-            for row in csv_reader:
-                if line_count == 0:
-                    print(f'Player List Column names are {", ".join(row)}')
-                    line_count += 1
-                else:
-                    line_count += 1
-                    tournament = row[0]
-                    playerteam = row[1]
-                    playername = row[2]
-                    playerscene = row[3]
-
-                    if playerteam is None or playerteam.strip() == '':
-                        playerteam = last_seen_team
-                    else:
-                        last_seen_team = playerteam
-                    self.add_player(playername, playerscene, playerteam, tournament)
-            print(f'Processed {line_count} players from {filename}.')
-            # print(f'Player Scenes: {self.playerscenes}')
-            # print(f'****TEAMS: {self.teams}')
+        self.add_players(filename, *read_player_file(filename))
+
+    # add_player for every row read_player_file found in filename
+    def add_players(self, filename: str, header: [str], rows: [tuple]):
+        self.diagnostics.info(f'Player List Column names are {", ".join(header)}')
+        for tournament, playerteam, playername, playerscene in rows:
+            self.add_player(playername, playerscene, playerteam, tournament)
+        self.diagnostics.info(f'Processed {len(rows)} players from {filename}.', file=filename, players=len(rows))
+        # print(f'Player Scenes: {self.playerscenes}')
+        # print(f'****TEAMS: {self.teams}')
 
     def add_player(self, playername, playerscene, playerteam, tournament):
         if tournament not in self.tournaments:
@@ -322,59 +1314,60 @@ class KQTrueSkill:
         else:
             self.playertournaments[playername] = [tournament]
 
-        self.playergames[playername] = 0
-        self.playerwins[playername] = 0
-        self.playerlosses[playername] = 0
-
         # elif playerscene is None or playerscene.strip() == '':
         #     self.incomplete_players.append(f"{tournament}: {playerteam}, {playername}, {playerscene}")
 
     # side effect: updates tournament dates with dates found here
     def ingest_matches_from_file(self, filename: str):
-        with open(filename) as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            line_count = 0
-            errors = ''
-            for row in csv_reader:
-                if line_count == 0:
-                    # print(f' Game Results Column names are {", ".join(row)}')
-                    line_count += 1
-                else:
-                    # print(f'\t{row[0]}, {row[1]}, {row[2]}, {row[3]}, {row[4]}, {row[5]}, {row[6]}.')
-                    tournament = row[0]
-                    bracket = row[1]
-                    team1name = row[2]
-                    team2name = row[3]
-                    team1wins = int(row[4])
-                    team2wins = int(row[5])
-                    time = datetime.datetime.strptime(row[6], self.datetime_format)
-
-                    # we should not be adding any new members to our tourney/team lists here
-                    if tournament not in self.tournaments:
-                        errors += f"{tournament} not found in self.tournaments. tournaments found = {self.tournaments}\n"
-                    if team1name not in self.teams[tournament].keys():
-                        errors += f"{team1name} not found in teams[{tournament}]. team 2 was {team2name}. teams found = {self.teams[tournament].keys()}\n"
-                    if team2name not in self.teams[tournament].keys():
-                        errors += f"{team2name} not found in teams[{tournament}]. team 1 was {team1name}. teams found = {self.teams[tournament].keys()}\n"
-
-                    # track the date for this tournament, if not already tracked
-                    if tournament not in self.tournamentdates.keys():
-                        self.tournamentdates[tournament] = time.date()
-                        print(f"sat {tournament} date to {time.strftime(KQTrueSkill.datetime_format)}")
-
-                    self.matches.append(
-                        {"tournament": tournament,
-                         "bracket": bracket,
-                         "team1name": team1name,
-                         "team2name": team2name,
-                         "team1wins": team1wins,
-                         "team2wins": team2wins,
-                         "time": time,
-                         })
-                    line_count += 1
-        print(f"Processed {line_count - 1} matches, now tracking {len(self.matches)} matches.")
+        self.add_matches(filename, read_match_file(filename))
+
+    # adds matches read from filename once they all check out, nothing is added if any of them don't
+    # side effect: updates tournament dates with dates found here
+    def add_matches(self, filename: str, matches: [dict]):
+        errors = self.check_matches(matches)
         if errors != '':
             raise Exception(errors)
+        self.matches.extend(matches)
+        self.add_tournament_dates(matches)
+        self.diagnostics.info(f"Processed {len(matches)} matches, now tracking {len(self.matches)} matches.",
+                              file=filename, matches=len(matches))
+
+    # self.teams with the teams in player_rows (from read_player_file) added, without changing the history.
+    # raises for the rows add_player would reject
+    def teams_with_players(self, player_rows: [tuple]) -> {str: dict}:
+        teams = {tournament: dict(tournament_teams) for tournament, tournament_teams in self.teams.items()}
+        for tournament, playerteam, playername, playerscene in player_rows:
+            if playerteam is None or playerteam.strip() == '':
+                raise Exception(f"{tournament}.add_player: empty team")
+            teams.setdefault(tournament, {}).setdefault(playerteam, [])
+        return teams
+
+    # errors for matches (in file order) that refer to tournaments or teams the player files didn't have.
+    # checks against self.teams unless given teams in the same shape
+    def check_matches(self, matches: [dict], teams_by_tournament: {str: dict} = None) -> str:
+        if teams_by_tournament is None:
+            teams_by_tournament = self.teams
+        errors = ''
+        for m in matches:
+            tournament, team1name, team2name = m['tournament'], m['team1name'], m['team2name']
+            # we should not be adding any new members to our tourney/team lists here
+            if tournament not in teams_by_tournament:
+                errors += f"{tournament} not found in self.tournaments. tournaments found = {list(teams_by_tournament)}\n"
+            teams = teams_by_tournament.get(tournament, {})
+            if team1name not in teams.keys():
+                errors += f"{team1name} not found in teams[{tournament}]. team 2 was {team2name}. teams found = {teams.keys()}\n"
+            if team2name not in teams.keys():
+                errors += f"{team2name} not found in teams[{tournament}]. team 1 was {team1name}. teams found = {teams.keys()}\n"
+        return errors
+
+    # tracks the first date each tournament is seen at in matches (in file order), if not already tracked
+    def add_tournament_dates(self, matches: [dict]):
+        for m in matches:
+            tournament = m['tournament']
+            if tournament not in self.tournamentdates.keys():
+                self.tournamentdates[tournament] = m['time'].date()
+                self.diagnostics.info(f"sat {tournament} date to {m['time'].strftime(KQTrueSkill.datetime_format)}",
+                                      tournament=tournament)
 
     def write_player_ratings(self, filename: str = None):
         if filename is None:
@@ -401,39 +1394,106 @@ class KQTrueSkill:
                            self.playerlosses[player],
                            "%.2f" % (self.playerwins[player] / self.playergames[player]),
                            ]
+                    player_tourneys = set(self.playertournaments[player])
                     for t in tourneylist:
-                        if t in self.playertournaments[player]:
+                        if t in player_tourneys:
                             row.append(t + " / " + self.playerteams[player][t])
                         else:
                             row.append('')
                     for t in tourneylist:
-                        if self.snapshots[t][player].mu == trueskill.MU and self.snapshots[t][
-                            player].sigma == trueskill.SIGMA:
+                        rating = self.snapshots[t][player]
+                        if rating.mu == self.env.mu and rating.sigma == self.env.sigma:
                             row.append('')
                         else:
-                            row.append(self.snapshots[t][player].mu - 3 * self.snapshots[t][player].sigma)
+                            row.append(rating.mu - 3 * rating.sigma)
                     playerskill_writer.writerow(row)
                 except ZeroDivisionError as e:
-                    print(
-                        f"{player}, {self.playerscenes[player]}, {self.playergames[player]}, {self.playerteams[player]}: {e}; probably a player with zero games")
+                    self.diagnostics.error(
+                        f"{player}, {self.playerscenes[player]}, {self.playergames[player]}, {self.playerteams[player]}: {e}; probably a player with zero games",
+                        player=player)
                     raise e
                 except Exception as e:
-                    print(
-                        f"{player}, {self.playerscenes[player]}, {self.playergames[player]}, {self.playerteams[player]}: {e}")
+                    self.diagnostics.error(
+                        f"{player}, {self.playerscenes[player]}, {self.playergames[player]}, {self.playerteams[player]}: {e}",
+                        player=player)
                     raise Exception(e)
 
+    # one row per player per tournament their rating changed in, instead of write_player_ratings' cell for
+    # every tournament.  a generator, so the rows are never all in memory at once
+    def player_rating_history_rows(self):
+        for player in sorted(self.playerratings.keys()):
+            for tournament, rating in self.snapshots.changes(player):
+                yield [player, tournament, self.playerteams[player].get(tournament, ''),
+                       rating.mu, rating.sigma, rating.mu - 3 * rating.sigma]
+
+    # long format companion to write_player_ratings, gzipped if compress is set or filename ends in .gz
+    def write_player_ratings_long(self, filename: str = None, compress: bool = False):
+        if filename is None:
+            filename = self.long_output_file_name
+        if compress and not filename.endswith('.gz'):
+            filename += '.gz'
+
+        if filename.endswith('.gz'):
+            history_file = gzip.open(filename, mode='wt', newline='')
+        else:
+            history_file = open(filename, mode='w', newline='')
+        with history_file:
+            history_writer = csv.writer(history_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            history_writer.writerow(['Player Name', 'tournament', 'team', 'mu', 'sigma', 'trueskill'])
+            history_writer.writerows(self.player_rating_history_rows())
+        return filename
+
     # returns win probability of 5 p1s vs 5 p2s
     def win_probability_players(self, p1, p2):
         return self.win_probability_teams(5 * [self.playerratings[p1]], 5 * [self.playerratings[p2]])
 
     # expects list of ratings objects for the 2 teams
     def win_probability_teams(self, team1, team2):
-        delta_mu = sum(r.mu for r in team1) - sum(r.mu for r in team2)
-        sum_sigma = sum(r.sigma ** 2 for r in team1) + sum(r.sigma ** 2 for r in team2)
-        size = len(team1) + len(team2)
-        ts: trueskill = trueskill.global_env()
-        denom = math.sqrt(size * (ts.beta ** 2) + sum_sigma)
-        return ts.cdf(delta_mu / denom)
+        return win_probability(team1, team2, self.env)
+
+    # win_probabilities[i, j] = probability teams[i] beats teams[j] in one game, for every pair of teams of player
+    # names at once.  teams are padded with bots like replay_matches does.  the matrix is cached, so asking
+    # again for the same teams is free until any rating changes (see ratings_version).  don't modify it
+    def team_win_probabilities(self, teams: [[str]]) -> np.ndarray:
+        key = tuple(tuple(team) for team in teams)
+        cached = self.win_probability_cache.get(key)
+        if cached is not None and cached[0] == self.ratings_version:
+            return cached[1]
+        if len(self.win_probability_cache) >= self.win_probability_cache_size or \
+                (cached is not None and cached[0] != self.ratings_version):
+            # anything from an older version is stale, and one big clear is cheaper than tracking which is which
+            self.win_probability_cache.clear()
+
+        # player ids, with every team padded to TEAM_SIZE with the bot's id, -1
+        ids = np.array([self.player_ids[player] for team in teams for player in team] +
+                       [-1] * sum(max(TEAM_SIZE - len(team), 0) for team in teams), dtype=np.int64)
+        sizes = np.array([max(len(team), TEAM_SIZE) for team in teams], dtype=np.int64)
+        team_index = np.concatenate([np.repeat(np.arange(len(teams)), [len(team) for team in teams]),
+                                     np.repeat(np.arange(len(teams)), sizes - [len(team) for team in teams])])
+        pi, tau = self.rating_pi[ids], self.rating_tau[ids]
+        mu_sums = np.bincount(team_index, weights=tau / pi, minlength=len(teams))
+        variance_sums = np.bincount(team_index, weights=1 / pi, minlength=len(teams))
+        win_probabilities = win_probability_matrix(mu_sums, variance_sums, sizes, self.env)
+        win_probabilities.setflags(write=False)
+        self.win_probability_cache[key] = (self.ratings_version, win_probabilities)
+        return win_probabilities
+
+    # (team names, team_win_probabilities) for every registered team of a tournament, with current ratings
+    def tournament_win_probabilities(self, tournament: str) -> ([str], np.ndarray):
+        team_names = list(self.teams[tournament].keys())
+        return team_names, self.team_win_probabilities([self.teams[tournament][team] for team in team_names])
+
+    # player's rating as of a moment in time, see RatingTimeline
+    def rating_at(self, player: str, when: datetime.datetime) -> Rating:
+        return self.timeline.rating_at(player, when)
+
+    # player's rating at the end of a tournament or one of its stages ('KO', 'Group', 'Group3'...)
+    def rating_after(self, player: str, tournament: str, stage: str = None) -> Rating:
+        return self.timeline.rating_after(player, tournament, stage)
+
+    # player's rating going into a tournament
+    def rating_before(self, player: str, tournament: str) -> Rating:
+        return self.timeline.rating_before(player, tournament)
 
     def get_player_scene_list(self):
         playerlist = []
@@ -463,95 +1523,28 @@ class KQTrueSkill:
             print(p)
 
     def record_trueskill_snapshot(self, tournament):
-        self.snapshots[tournament] = copy.deepcopy(self.playerratings)
+        with self.diagnostics.timer('snapshot'):
+            changed_ratings = {self.player_names[player_id]: natural_rating(float(self.rating_pi[player_id]),
+                                                                            float(self.rating_tau[player_id]))
+                               for player_id in self.changed_players}
+            self.snapshots.record(tournament, changed_ratings)
+        if self.store is not None:
+            with self.diagnostics.timer('store write'):
+                self.store.write_snapshot(tournament, changed_ratings)
+        self.diagnostics.count('snapshot ratings', len(self.changed_players))
+        self.diagnostics.count('snapshot bytes', len(self.changed_players) * SNAPSHOT_RATING_BYTES)
+        self.changed_players.clear()
 
     def create_bot(self):
-        return Rating(mu=5.000, sigma=2)
-
-
-def render_player_match_stats(match_stats: Dict[str, AggregatedMatchStats],
-                              table_type: str,
-                              history) -> str:
-    output = f"""
-<table class="sortable-theme-light" data-sortable>
-  <thead>
-   <tr>
-    <th>{table_type}</th>
-    <th>net rating change</th>
-    <th>wins</th>
-    <th>losses</th>
-    <th>win %</th>
-    <th>tournaments</th>
-   </tr>
-  </thead></tbody>
-"""
-    # TODO(rob): Figure out why columns don't sort when clicked.
-    for other_player, agg_stats in match_stats.items():
-        tournaments_list_str = ' '.join(
-            sort_tournaments_by_date(agg_stats.tournaments, history))
-                                     
-        win_percentage = 100 * agg_stats.wins / (
-            agg_stats.wins + agg_stats.losses)
-        output += f"""<tr><td>{other_player}</td>
-                          <td>{agg_stats.net_rating_change:.3f}</td>
-                          <td>{agg_stats.wins}</td>
-                          <td>{agg_stats.losses}</td>
-                          <td>{win_percentage:.3f}</td>
-                          <td>{tournaments_list_str}</td>
-                       </tr>
-"""
-    output += '</tbody></table>'
-    return output
-
-
-def render_trueskill_graph(player_name, history):
-    # https://plotly.com/javascript/error-bars/
-    tournaments = sort_tournaments_by_date(
-        history.playertournaments[player_name], history)
-
-    rating_means, rating_error  = [], []
-    
-    for t in tournaments:
-        rating_at_t = history.snapshots[t][player_name]
-        rating_means.append(rating_at_t.mu)
-        rating_error.append(rating_at_t.sigma * 3)
-
-    json_trace_data = json.dumps([{'x': tournaments,
-                                   'y': rating_means,
-                                   'error_y': {
-                                       'type': 'data',
-                                       'array': rating_error,
-                                       'visible': 'true'}}])
-    # Everyones's initial error bars are stupidly wide and blow out the graph.
-    # It will look better if we truncated the y range to something like
-    # [min(mu) - X, max(mu) + X] for suitable X (5?)
-    return (f'<div id="trueskill_graph"></div> \n'
-            f'<script>Plotly.newPlot("trueskill_graph", {json_trace_data})</script> \n')
-    
-
-def render_player_summary(player_name, history):
-    output = f"""<html><head><title>{player_name}'s KQ player page</title>
-                    <meta name="robots" content="noindex" />
-                    <script src="sortable.min.js"></script>
-                    <script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
-                    <link rel="stylesheet" href="sortable-theme-light.css" />
-              </head>
-              <body>"""
-    output += render_trueskill_graph(player_name, history)
-    output += render_player_match_stats(
-        history.ratings_change_by_teammate.ratings_change_by_teammate[player_name],
-        'teammate',
-        history)
-    output += render_player_match_stats(
-        history.ratings_change_by_opponent.ratings_change_by_opp[player_name],
-        'opponent',
-        history)
-    output += '</body>'
-    return output
+        return self.bot_rating
 
 
 def main():
-    history: KQTrueSkill = KQTrueSkill()
+    # usage: KQtrueskill.py [--profile[=file]] [--log-level=debug|info|warning|error]
+    level, profile_file = options_from_argv(sys.argv[1:])
+    history: KQTrueSkill = KQTrueSkill(diagnostics=Diagnostics(level))
+    # parsing and the replay are lazy, run them now so their time isn't counted in whichever phase comes first
+    history.ensure_rated()
 
     # stuff to copy into README
     history.print_known_tournaments()
@@ -559,35 +1552,35 @@ def main():
     history.print_data_errors()
 
     # print your player ratings
-    history.write_player_ratings()
+    with history.diagnostics.timer('csv write'):
+        history.write_player_ratings()
+        history.write_player_ratings_long()
 
     print(f"win probablity, 5 Dans vs 5 Wilks {history.win_probability_players('Dan Shupp', 'Andrew Wilkening')}")
 
-    ni_howdy = [history.snapshots['BB4']['Woody Stanfield'],
-                history.snapshots['BB4']['Helen Lau'],
-                history.snapshots['BB4']['Dan Barron'],
-                history.snapshots['BB4']['Nick Davis'],
-                history.snapshots['BB4']['Andrew Quang'],
-                ]
+    ni_howdy = [history.rating_after(player, 'BB4')
+                for player in ['Woody Stanfield', 'Helen Lau', 'Dan Barron', 'Nick Davis', 'Andrew Quang']]
 
-    clean = [history.snapshots['BB3']['Sam Beckman'],
-             history.snapshots['BB3']['Prashant Sridhar'],
-             history.snapshots['BB3']['Brian Wong'],
-             history.snapshots['BB3']['Andrew Kelley'],
-             history.snapshots['BB3']['Carissa Phong'],
-             ]
+    clean = [history.rating_after(player, 'BB3')
+             for player in ['Sam Beckman', 'Prashant Sridhar', 'Brian Wong', 'Andrew Kelley', 'Carissa Phong']]
 
     print(f"win probability, BB4 Ni Howdy vs BB3 CLEAN = {history.win_probability_teams(ni_howdy, clean)}")
+
+    # ratings between tournaments, or part way through one
+    clean_after_groups = [history.rating_after(player, 'BB3', 'Group')
+                          for player in ['Sam Beckman', 'Prashant Sridhar', 'Brian Wong', 'Andrew Kelley',
+                                         'Carissa Phong']]
+    print(f"win probability, BB4 Ni Howdy vs BB3 CLEAN after groups = "
+          f"{history.win_probability_teams(ni_howdy, clean_after_groups)}")
+    print(f"Dan Shupp on 2020-01-01: {history.rating_at('Dan Shupp', datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))}")
     # print(f'Player Ratings: {history.playerratings}')
 
 
-    if not os.path.exists('output'):
-        os.mkdir('output')
-    shutil.copyfile('js/sortable.min.js', 'output/sortable.min.js')
-    shutil.copyfile('css/sortable-theme-light.css', 'output/sortable-theme-light.css')
-    for player in sorted(history.playerratings.keys()):
-        # TODO(rob): Use first name, last initial, scene as public player identifier.
-        open(f'output/{player}.html', 'w').write(render_player_summary(player, history))
+    # player pages, imported here since sitegen imports this module.  it resolves through the repo root put on
+    # sys.path above when this runs as a script
+    from KQTrueSkill.sitegen import generate_site
+    with history.diagnostics.timer('html render'):
+        generate_site(history, 'output')
     
 
     # test whether processing changed values
@@ -596,6 +1589,10 @@ def main():
     else:
         print("Files are different")
 
+    if profile_file:
+        history.diagnostics.write_report(profile_file)
+        print(f"wrote profile to {profile_file}")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,88 @@
+import collections
+import contextlib
+import json
+import time
+
+# event levels, lowest first
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+
+class Diagnostics:
+    '''Timers, counters and a levelled event channel for the replay pipeline, instead of prints and wall clock.
+
+    with diagnostics.timer('replay'): adds the time spent in the block to that phase.  Phases can nest, a parent's
+    time includes its children's.
+    diagnostics.count('rate calls', n): adds to a counter.
+    diagnostics.info('message', field=value...): an event.  Events at level or above are printed (when echo is on)
+    and kept for report(), up to max_events of them.'''
+
+    def __init__(self, level: str = 'info', echo: bool = True, max_events: int = 10000):
+        if level not in LEVELS:
+            raise Exception(f"unknown level {level}, expected one of {list(LEVELS.keys())}")
+        self.level = level
+        self.echo = echo
+        self.max_events = max_events
+        self.start = time.perf_counter()
+        self.timers = collections.defaultdict(float)  # timers[phase] = seconds
+        self.timer_calls = collections.Counter()  # timer_calls[phase] = how many times it was timed
+        self.counters = collections.Counter()
+        self.events = []
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[phase] += time.perf_counter() - start
+            self.timer_calls[phase] += 1
+
+    def count(self, counter: str, n: int = 1):
+        self.counters[counter] += n
+
+    def event(self, level: str, message: str, **fields):
+        if LEVELS[level] < LEVELS[self.level]:
+            return
+        if self.echo:
+            print(message)
+        if len(self.events) < self.max_events:
+            self.events.append({'seconds': round(time.perf_counter() - self.start, 6), 'level': level,
+                                'message': message, **fields})
+        else:
+            self.counters['dropped events'] += 1
+
+    def debug(self, message: str, **fields):
+        self.event('debug', message, **fields)
+
+    def info(self, message: str, **fields):
+        self.event('info', message, **fields)
+
+    def warning(self, message: str, **fields):
+        self.event('warning', message, **fields)
+
+    def error(self, message: str, **fields):
+        self.event('error', message, **fields)
+
+    def report(self) -> dict:
+        return {'seconds': time.perf_counter() - self.start,
+                'timers': {phase: {'seconds': seconds, 'calls': self.timer_calls[phase]}
+                           for phase, seconds in sorted(self.timers.items(), key=lambda item: -item[1])},
+                'counters': dict(sorted(self.counters.items())),
+                'events': self.events}
+
+    def write_report(self, filename: str):
+        with open(filename, mode='w') as report_file:
+            json.dump(self.report(), report_file, indent=1, default=str)
+
+
+# --profile[=file] and --log-level=level from a command line, returns (level, profile file or None)
+def options_from_argv(argv: [str], default_profile_file: str = 'profile.json') -> (str, str):
+    level, profile_file = 'info', None
+    for arg in argv:
+        if arg == '--profile':
+            profile_file = default_profile_file
+        elif arg.startswith('--profile='):
+            profile_file = arg[len('--profile='):]
+        elif arg.startswith('--log-level='):
+            level = arg[len('--log-level='):]
+    return level, profile_file
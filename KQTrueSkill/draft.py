@@ -0,0 +1,250 @@
+import sys
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from trueskill import Rating
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, TEAM_SIZE
+
+
+@dataclass
+class Draft:
+    '''Teams picked by draft_teams, and how lopsided their most lopsided matchup is.'''
+    teams: [[str]]
+    worst_matchup: (int, int)  # indexes into teams, the favorite first
+    worst_win_probability: float  # the favorite's chance of winning a game in the worst matchup
+
+
+class DraftSolver:
+    '''Splits a pool of players into teams so the most lopsided matchup between any two of them is as close
+    to 50/50 as possible.
+
+    With team rating sums M and variance sums V, win_probability between teams i and j is
+    cdf((M_i - M_j) / sqrt(2 * team_size * beta^2 + V_i + V_j)), so the solver minimizes the largest
+    |z_ij| of that ratio.  It starts from a snake draft and then repeatedly makes the best swap of two players,
+    scoring every candidate swap at once with numpy.  Only swaps that move a player on one of the two teams
+    in the worst matchup can improve it, so those are the only ones tried, and a swap only changes the
+    matchups of the two teams involved, so only those are rescored.  Random restarts use up the rest
+    of the time limit.'''
+
+    def __init__(self, ratings: [Rating], beta: float, team_size: int = TEAM_SIZE, captains: [int] = (),
+                 apart: np.ndarray = None, seed: int = 0):
+        self.count = len(ratings)
+        if self.count % team_size != 0 or self.count == 0:
+            raise Exception(f"can't split {self.count} players into teams of {team_size}")
+        self.team_size = team_size
+        self.team_count = self.count // team_size
+        if len(captains) > self.team_count:
+            raise Exception(f"{len(captains)} captains for {self.team_count} teams")
+        self.mu = np.array([r.mu for r in ratings])
+        self.variance = np.array([r.sigma ** 2 for r in ratings])
+        self.beta_term = 2 * team_size * beta ** 2
+        self.captains = list(captains)
+        # apart[a, b]: a and b can't be on the same team
+        self.apart = apart if apart is not None else np.zeros((self.count, self.count), dtype=bool)
+        self.movable = np.ones(self.count, dtype=bool)
+        self.movable[self.captains] = False
+        self.rng = np.random.default_rng(seed)
+
+    # team of each player for picks made in order, snake style, skipping teams that are full or would
+    # break a keep apart constraint.  captains are placed first, one per team, then players with keep apart
+    # constraints so they still have a choice of teams
+    def fill(self, order: [int]) -> np.ndarray:
+        constrained = self.apart.any(axis=1)
+        order = [p for p in order if constrained[p]] + [p for p in order if not constrained[p]]
+        team = np.full(self.count, -1)
+        sizes = np.zeros(self.team_count, dtype=np.int64)
+        for t, captain in enumerate(self.captains):
+            team[captain] = t
+            sizes[t] += 1
+        pick = 0
+        for player in order:
+            if team[player] >= 0:
+                continue
+            draft_round, position = divmod(pick, self.team_count)
+            first_choice = position if draft_round % 2 == 0 else self.team_count - 1 - position
+            for t in [(first_choice + offset) % self.team_count for offset in range(self.team_count)]:
+                if sizes[t] < self.team_size and not self.apart[player, team == t].any():
+                    team[player] = t
+                    sizes[t] += 1
+                    break
+            else:
+                raise Exception(f"no team left for player {player} that keeps the players to keep apart apart")
+            pick += 1
+        return team
+
+    def team_sums(self, team: np.ndarray) -> (np.ndarray, np.ndarray):
+        return (np.bincount(team, weights=self.mu, minlength=self.team_count),
+                np.bincount(team, weights=self.variance, minlength=self.team_count))
+
+    # |z| of every matchup, for any number of candidate team sums at once: mu_sums and variance_sums are
+    # (..., teams), the result is (..., teams, teams)
+    def matchup_z(self, mu_sums: np.ndarray, variance_sums: np.ndarray) -> np.ndarray:
+        difference = mu_sums[..., :, None] - mu_sums[..., None, :]
+        spread = np.sqrt(self.beta_term + variance_sums[..., :, None] + variance_sums[..., None, :])
+        return np.abs(difference) / spread
+
+    # |z| of candidate teams (mu and variance sums of shape (candidates,)) against every team, (candidates, teams)
+    def matchup_z_against(self, mu: np.ndarray, variance: np.ndarray, mu_sums: np.ndarray,
+                          variance_sums: np.ndarray) -> np.ndarray:
+        return np.abs(mu[:, None] - mu_sums[None, :]) / np.sqrt(self.beta_term + variance[:, None] +
+                                                                variance_sums[None, :])
+
+    # for every team u, the largest |z| among matchups involving neither team t nor u
+    def unaffected_max(self, z: np.ndarray, t: int) -> np.ndarray:
+        others = z.copy()
+        others[t, :] = 0
+        others[:, t] = 0
+        # each row's best and second best column, so a row's max without any one column is a lookup
+        top = np.argsort(-others, axis=1)[:, :2]
+        rows = np.arange(self.team_count)
+        first, second = others[rows, top[:, 0]], others[rows, top[:, 1]]
+        row_max = np.where(top[:, :1] == rows[None, :], second[:, None], first[:, None])  # [row, u]
+        row_max[rows, rows] = 0
+        return row_max.max(axis=0)
+
+    # worst |z|, then the sum of squares of every matchup's |z| to break ties so the search keeps moving on
+    # plateaus
+    def score(self, team: np.ndarray) -> (float, float):
+        z = self.matchup_z(*self.team_sums(team))
+        return float(z.max()), float((z * z).sum() / 2)
+
+    def improve(self, team: np.ndarray) -> np.ndarray:
+        team = team.copy()
+        if self.team_count < 2:
+            return team
+        best = self.score(team)
+        while True:
+            mu_sums, variance_sums = self.team_sums(team)
+            z = self.matchup_z(mu_sums, variance_sums)
+            worst_i, worst_j = np.unravel_index(np.argmax(z), z.shape)
+
+            # every movable player on the two worst teams, swapped with every movable player on another team
+            a, b = np.meshgrid(np.flatnonzero(self.movable & ((team == worst_i) | (team == worst_j))),
+                               np.flatnonzero(self.movable), indexing='ij')
+            a, b = a.ravel(), b.ravel()
+            a_team, b_team = team[a], team[b]
+            # swapping a and b mustn't put either of them with someone they're kept apart from
+            # (b is leaving the team a joins, and the other way around)
+            a_conflicts = self.apart[a] & (team[None, :] == b_team[:, None])
+            b_conflicts = self.apart[b] & (team[None, :] == a_team[:, None])
+            a_conflicts[np.arange(len(a)), b] = False
+            b_conflicts[np.arange(len(b)), a] = False
+            valid = (a_team != b_team) & ~a_conflicts.any(axis=1) & ~b_conflicts.any(axis=1)
+            a, b, a_team, b_team = a[valid], b[valid], a_team[valid], b_team[valid]
+            if len(a) == 0:
+                return team
+
+            # only the two swapped teams' matchups change: score them against everyone else's current sums
+            mu_change = self.mu[b] - self.mu[a]
+            variance_change = self.variance[b] - self.variance[a]
+            a_mu, a_variance = mu_sums[a_team] + mu_change, variance_sums[a_team] + variance_change
+            b_mu, b_variance = mu_sums[b_team] - mu_change, variance_sums[b_team] - variance_change
+            a_z = self.matchup_z_against(a_mu, a_variance, mu_sums, variance_sums)
+            b_z = self.matchup_z_against(b_mu, b_variance, mu_sums, variance_sums)
+            stale = (np.arange(self.team_count)[None, :] == a_team[:, None]) | \
+                    (np.arange(self.team_count)[None, :] == b_team[:, None])
+            a_z[stale] = 0
+            b_z[stale] = 0
+            ab_z = np.abs(a_mu - b_mu) / np.sqrt(self.beta_term + a_variance + b_variance)
+
+            # ...and everything else keeps its current z
+            unaffected = np.zeros((self.team_count, self.team_count))
+            for t in (worst_i, worst_j):
+                unaffected[t] = self.unaffected_max(z, t)
+            worst = np.maximum.reduce([a_z.max(axis=1), b_z.max(axis=1), ab_z, unaffected[a_team, b_team]])
+            squares = (z * z).sum(axis=1)
+            spread = (best[1] - squares[a_team] - squares[b_team] + z[a_team, b_team] ** 2 +
+                      (a_z * a_z).sum(axis=1) + (b_z * b_z).sum(axis=1) + ab_z * ab_z)
+
+            k = np.lexsort((spread, worst))[0]
+            improved = worst[k] < best[0] - 1e-12 or (worst[k] <= best[0] + 1e-12 and spread[k] < best[1] - 1e-12)
+            if not improved:
+                return team
+            team[a[k]], team[b[k]] = b_team[k], a_team[k]
+            best = (float(worst[k]), float(spread[k]))
+
+    # best teams found within time_limit seconds, at least one full local search from a snake draft
+    def solve(self, time_limit: float = 0.5) -> np.ndarray:
+        start = time.perf_counter()
+        best_team = self.improve(self.fill(list(np.argsort(-self.mu, kind='stable'))))
+        best = self.score(best_team)
+        while time.perf_counter() - start < time_limit:
+            try:
+                team = self.improve(self.fill(list(self.rng.permutation(self.count))))
+            except Exception:
+                # a random pick order can paint itself into a corner with keep apart constraints
+                continue
+            score = self.score(team)
+            if score < best:
+                best_team, best = team, score
+        return best_team
+
+
+def draft_teams(history: KQTrueSkill, players: [str], captains: [str] = (), keep_apart: [[str]] = (),
+                team_size: int = TEAM_SIZE, time_limit: float = 0.5, seed: int = 0) -> Draft:
+    '''Splits players into teams of team_size with each player's current rating, see DraftSolver.
+
+    captains: each goes on their own team
+    keep_apart: groups of players, no two players in a group end up on the same team
+    Players history doesn't know start at the default rating.'''
+    if len(set(players)) != len(players):
+        raise Exception("players are listed more than once")
+    index = {player: i for i, player in enumerate(players)}
+    for player in list(captains) + [p for group in keep_apart for p in group]:
+        if player not in index:
+            raise Exception(f"{player} isn't one of the players being drafted")
+
+    ratings = []
+    for player in players:
+        if player in history.playerratings:
+            ratings.append(history.playerratings[player])
+        else:
+            print(f"{player} has no rating, using the default")
+            ratings.append(history.env.create_rating())
+
+    apart = np.zeros((len(players), len(players)), dtype=bool)
+    for group in keep_apart:
+        if len(group) > len(players) // team_size:
+            raise Exception(f"can't keep {len(group)} players apart with only {len(players) // team_size} teams")
+        ids = [index[player] for player in group]
+        apart[np.ix_(ids, ids)] = True
+    np.fill_diagonal(apart, False)
+    solver = DraftSolver(ratings, history.env.beta, team_size, [index[c] for c in captains], apart, seed)
+    team = solver.solve(time_limit)
+
+    teams = [[players[i] for i in np.flatnonzero(team == t)] for t in range(solver.team_count)]
+    mu_sums, variance_sums = solver.team_sums(team)
+    z = solver.matchup_z(mu_sums, variance_sums)
+    worst_i, worst_j = np.unravel_index(np.argmax(z), z.shape)
+    if mu_sums[worst_i] < mu_sums[worst_j]:
+        worst_i, worst_j = worst_j, worst_i
+    return Draft(teams=teams,
+                 worst_matchup=(int(worst_i), int(worst_j)),
+                 worst_win_probability=history.win_probability_teams(
+                     [ratings[index[p]] for p in teams[worst_i]], [ratings[index[p]] for p in teams[worst_j]]))
+
+
+def main():
+    # usage: draft.py [player file], one player per line
+    filename = sys.argv[1] if len(sys.argv) > 1 else None
+    history = KQTrueSkill(backend='numpy')
+    if filename is not None:
+        with open(filename) as player_file:
+            players = [line.strip() for line in player_file if line.strip()]
+    else:
+        # the 50 best rated players with at least 20 games, as an example
+        rated = [p for p in history.playerratings.keys() if history.playergames[p] >= 20]
+        players = sorted(rated, key=lambda p: -history.playerratings[p].mu)[:50]
+
+    draft = draft_teams(history, players)
+    for i, team in enumerate(draft.teams):
+        total = sum(history.playerratings[p].mu if p in history.playerratings else history.env.mu for p in team)
+        print(f"team {i + 1} ({total:.1f}): {', '.join(team)}")
+    i, j = draft.worst_matchup
+    print(f"most lopsided matchup: team {i + 1} vs team {j + 1}, {draft.worst_win_probability:.3f}")
+
+
+if __name__ == '__main__':
+    main()
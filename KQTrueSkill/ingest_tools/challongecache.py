@@ -0,0 +1,82 @@
+import json
+import os
+
+
+class ChallongeCache:
+    '''Challonge responses saved on disk, one json file per endpoint under a directory per tournament,
+    e.g. challonge_cache/tournaments/kqxx/matches.json.
+
+    Responses fetched after a tournament's state is "complete" never change, so they are used without asking
+    challonge again.  Anything else (tournaments still running, the tournament index) is revalidated on every
+    fetch, with If-None-Match / If-Modified-Since when challonge sent an ETag or Last-Modified.
+
+    offline: never touch the network, everything has to come from the cache'''
+
+    def __init__(self, directory: str = 'challonge_cache', offline: bool = False):
+        self.directory = directory
+        self.offline = offline
+
+    def entry_file(self, key: str) -> str:
+        return os.path.join(self.directory, *key.split('/'))
+
+    # returns None if key isn't cached
+    def load(self, key: str) -> dict:
+        try:
+            with open(self.entry_file(key)) as entry_file:
+                return json.load(entry_file)
+        except FileNotFoundError:
+            return None
+
+    def store(self, key: str, entry: dict):
+        filename = self.entry_file(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # brackets are fetched from several threads, never leave a half written entry behind
+        temp_filename = f"{filename}.{os.getpid()}.{id(entry)}.tmp"
+        with open(temp_filename, mode='w') as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(temp_filename, filename)
+
+    # tournament_key is the cache key of the tournament's own GET tournaments/{tournament}.json
+    def is_complete(self, tournament_key: str) -> bool:
+        entry = self.load(tournament_key)
+        return entry is not None and entry['body']['tournament']['state'] == 'complete'
+
+    # GET url through the cache, returning the decoded json.
+    # get: does the actual request, get(url, headers) -> requests.Response
+    # key: where the response is cached, the endpoint's path, e.g. tournaments/kqxx/matches.json
+    # tournament_key: key of the tournament this endpoint belongs to, None for anything that isn't per tournament
+    # label: names the endpoint in errors, the same way the uncached requests do
+    def fetch(self, get, url: str, key: str, tournament_key: str = None, label: str = '') -> object:
+        entry = self.load(key)
+        if self.offline:
+            if entry is None:
+                raise Exception(f"{key} isn't in the cache at {self.directory}, can't fetch it offline")
+            return entry['body']
+        if entry is not None and entry['complete']:
+            return entry['body']
+
+        headers = {}
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        resp = get(url, headers=headers)
+        if resp.status_code == 304 and entry is not None:
+            return entry['body']
+        if resp.status_code != 200:
+            # This means something went wrong.
+            raise Exception('GET /{}/ {}'.format(label, resp.status_code))
+
+        body = resp.json()
+        if tournament_key is None:
+            complete = False
+        elif tournament_key == key:
+            complete = body['tournament']['state'] == 'complete'
+        else:
+            # only trust a response that was fetched after its tournament finished
+            complete = self.is_complete(tournament_key)
+        self.store(key, {'etag': resp.headers.get('ETag'),
+                         'last_modified': resp.headers.get('Last-Modified'),
+                         'complete': complete,
+                         'body': body})
+        return body
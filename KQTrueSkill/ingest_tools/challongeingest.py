@@ -1,43 +1,87 @@
+import concurrent.futures
 import csv
 import datetime
 import configparser
 import requests
 import json
+import sys
+import time
 
 from KQTrueSkill.KQtrueskill import KQTrueSkill
+from KQTrueSkill.ingest_tools.challongecache import ChallongeCache
 
 
 class ChallongeAccount:
 
     DATETIME_FORMAT: str = "%Y-%m-%dT%H:%M:%S.%f%z"
     API_URL: str = "https://api.challonge.com/v1/"
-
-    def __init__(self, api_key: str, subdomain: str):
+    # challonge rate limits with 429s and has the odd 5xx, those get retried
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    # api_url: point at something other than challonge, e.g. a local stub server
+    # max_workers: brackets fetched at once by get_match_results_from_challonge, also the connection pool size
+    # retries / backoff: a retried request waits backoff, 2 * backoff, 4 * backoff... seconds between attempts,
+    #                    or as long as the server's Retry-After says
+    # cache: keep responses on disk, see ChallongeCache
+    def __init__(self, api_key: str, subdomain: str, api_url: str = None, max_workers: int = 8, retries: int = 4,
+                 backoff: float = 0.5, cache: ChallongeCache = None):
         self.subdomain = subdomain
         if subdomain is None:
             self.subdomain_inject = ''
         else: 
             self.subdomain_inject = f"{self.subdomain}-"
         self.api_key = api_key
-
-    # GET https://api.challonge.com/v1/tournaments/{tournament}.{json|xml}
-    def print_tournament(self, id):
-        url: str = f"{self.API_URL}tournaments/{id}.json?api_key={self.api_key}"
+        self.API_URL = api_url if api_url is not None else ChallongeAccount.API_URL
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        # one keep-alive session shared by every request and thread, sized so no worker waits on a connection
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # GET url on the shared session, retrying rate limits, server errors and dropped connections.
+    # returns the last response, callers check the status
+    def get(self, url: str, headers: dict = None) -> requests.Response:
+        attempt = 0
+        while True:
+            try:
+                resp = self.session.get(url, headers=headers)
+            except requests.ConnectionError:
+                if attempt >= self.retries:
+                    raise
+                resp = None
+            if resp is not None and (resp.status_code not in self.RETRY_STATUSES or attempt >= self.retries):
+                return resp
+            delay = self.backoff * 2 ** attempt
+            if resp is not None and resp.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, int(resp.headers['Retry-After']))
+            print(f"retrying {url} in {delay:.1f}s ({resp.status_code if resp is not None else 'connection error'})")
+            time.sleep(delay)
+            attempt += 1
+
+    # GET {API_URL}{path}, through the cache if there is one, and decode the json.
+    # label names the endpoint in errors, tournament_path is the tournament's own path for per tournament endpoints
+    def get_json(self, path: str, label: str, tournament_path: str = None):
+        url: str = f"{self.API_URL}{path}?api_key={self.api_key}"
         print(url)
-        resp = requests.get(url)
+        if self.cache is not None:
+            return self.cache.fetch(self.get, url, path, tournament_path, label)
+        resp = self.get(url)
         if resp.status_code != 200:
             # This means something went wrong.
-            raise Exception('GET /show/ {}'.format(resp.status_code))
-        print(json.dumps(resp.json()['tournament'], indent=1))
+            raise Exception('GET /{}/ {}'.format(label, resp.status_code))
+        return resp.json()
+
+    # GET https://api.challonge.com/v1/tournaments/{tournament}.{json|xml}
+    def print_tournament(self, id):
+        path: str = f"tournaments/{id}.json"
+        print(json.dumps(self.get_json(path, 'show', path)['tournament'], indent=1))
 
     def get_tourney_list(self) -> {}:
-        url: str = f"{self.API_URL}tournaments.json?api_key={self.api_key}"
-        print(url)
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            # This means something went wrong.
-            raise Exception('GET /index/ {}'.format(resp.status_code))
-        return resp.json()
+        return self.get_json("tournaments.json", 'index')
 
     def get_tournament(self, parent_tourney_name, tourney_id, bracket_name):
         return ChallongeTournament(parent_tourney_name, tourney_id, bracket_name, self)
@@ -64,6 +108,10 @@ class ChallongeTournament:
         self.teams = {}
         self.team_ids: {} = {}
         self.teamnames: [] = []
+        # every other endpoint is cached as immutable once this says the tournament is complete
+        self.tournament_path: str = f"tournaments/{self.account.subdomain_inject}{self.tourney_id}.json"
+        if self.account.cache is not None:
+            self.get_tournament_info()
         self.build_participants_list()
         self.match_results = []
         self.build_match_results()
@@ -71,44 +119,51 @@ class ChallongeTournament:
 
     # GET https://api.challonge.com/v1/tournaments/{tournament}/matches.{json|xml}
     def get_matches(self):
-        url: str = f"{self.account.API_URL}tournaments/{self.account.subdomain_inject}{self.tourney_id}/matches.json?api_key={self.account.api_key}"
-        print(url)
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            # This means something went wrong.
-            raise Exception('GET /matches/ {}'.format(resp.status_code))
+        path: str = f"tournaments/{self.account.subdomain_inject}{self.tourney_id}/matches.json"
         # print(json.dumps(resp.json(),indent=1))
-        return resp.json()
+        return self.account.get_json(path, 'matches', self.tournament_path)
 
     # GET https://api.challonge.com/v1/tournaments/{tournament}.{json|xml}
+    def get_tournament_info(self):
+        return self.account.get_json(self.tournament_path, 'show', self.tournament_path)['tournament']
+
     def get_tournament_time(self):
-        url: str = f"{self.account.API_URL}tournaments/{self.account.subdomain_inject}{self.tourney_id}.json?api_key={self.account.api_key}"
-        print(url)
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            # This means something went wrong.
-            raise Exception('GET /show/ {}'.format(resp.status_code))
-        p = resp.json()['tournament']['started_at']
+        p = self.get_tournament_info()['started_at']
         return datetime.datetime.strptime(p, ChallongeAccount.DATETIME_FORMAT)
 
     # GET https://api.challonge.com/v1/tournaments/{tournament}/participants.{json|xml}
     def build_participants_list(self):
-        url: str = f"{self.account.API_URL}tournaments/{self.account.subdomain_inject}{self.tourney_id}/participants.json?api_key={self.account.api_key}"
-        print(url)
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            # This means something went wrong.
-            raise Exception('GET /index/ {}'.format(resp.status_code))
-        for participant in resp.json():
+        path: str = f"tournaments/{self.account.subdomain_inject}{self.tourney_id}/participants.json"
+        for participant in self.account.get_json(path, 'index', self.tournament_path):
             team_id = participant['participant']['id']
             team_name = participant['participant']['name']
             self.teams[team_id] = team_name
             self.team_ids[team_name] = team_id
             self.teamnames.append(team_name)
+            # group stage matches refer to teams by their per group ids, which come along with the participant
+            for group_player_id in participant['participant'].get('group_player_ids') or []:
+                self.teams[group_player_id] = team_name
             # print(f"{team_id}, {team_name}")
 
+    # look up every team id the participants list didn't cover (e.g. removed participants), each id once.
+    # ids that can't be found are left out of self.teams.  one at a time: this already runs in one of
+    # get_match_results_from_challonge's workers, and the session only has connections for those
+    def resolve_team_ids(self, team_ids):
+        unknown_ids = sorted({i for i in team_ids if isinstance(i, int) and i not in self.teams})
+        if len(unknown_ids) == 0:
+            return
+        print(f"looking up {len(unknown_ids)} team ids missing from the participants list")
+        for team_id in unknown_ids:
+            try:
+                self.get_team_name_from_id(team_id)
+            except Exception as e:
+                print(f"ERROR - couldn't find team id {team_id}: {e}")
+                self.processing_errors += 1
+
     def build_match_results(self):
-        for m in self.get_matches():
+        matches = self.get_matches()
+        self.resolve_team_ids([m["match"][side] for m in matches for side in ('player1_id', 'player2_id')])
+        for m in matches:
             match = m["match"]
 
             scores_csv: str = match["scores_csv"]
@@ -127,10 +182,8 @@ class ChallongeTournament:
                 print(f"ERROR - Empty player1_id in match {match}")
                 self.processing_errors += 1
             elif isinstance(match['player1_id'], int):
-                try:
-                    team1name = self.get_team_name_from_id(match['player1_id'])
-                except:
-                    team1name = str(match['player1_id'])
+                # resolve_team_ids already looked up everything it could
+                team1name = self.teams.get(match['player1_id'], str(match['player1_id']))
             else:
                 team1name: str = self.teams[match['player1_id']]
 
@@ -139,10 +192,8 @@ class ChallongeTournament:
                 print(f"ERROR - Empty player2_id in match {match}")
                 self.processing_errors += 1
             elif isinstance(match['player2_id'], int):
-                try:
-                    team2name = self.get_team_name_from_id(match['player2_id'])
-                except:
-                    team2name = str(match['player2_id'])
+                # resolve_team_ids already looked up everything it could
+                team2name = self.teams.get(match['player2_id'], str(match['player2_id']))
             else:
                 team2name: str = self.teams[match['player2_id']]
 
@@ -158,13 +209,7 @@ class ChallongeTournament:
         print(f"{self.processing_errors} processing errors")
 
     def get_bracket_name(self):
-        url: str = f"{self.account.API_URL}tournaments/{self.account.subdomain_inject}{self.tourney_id}.json?api_key={self.account.api_key}"
-        print(url)
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            # This means something went wrong.
-            raise Exception('GET /index/ {}'.format(resp.status_code))
-        return resp.json()['tournament']['name']
+        return self.get_tournament_info()['name']
 
     def write_matchfile(self, filename: str = None, append=False):
         if filename is None:
@@ -196,15 +241,11 @@ class ChallongeTournament:
     def get_team_name_from_id(self, team_id):
         if team_id in self.teams.keys():
             return self.teams[team_id]
-        url: str = f"{self.account.API_URL}tournaments/{self.account.subdomain_inject}{self.tourney_id}/participants/{team_id}.json?api_key={self.account.api_key}"
-        print(url)
-        resp = requests.get(url)
-        # print(json.dumps(resp.json(),indent=1))
-        if resp.status_code != 200:
-            # This means something went wrong.
-            raise Exception('GET /participants/ {}'.format(resp.status_code))
-        self.teams[team_id] = resp.json()['participant']['name']
-        return resp.json()['participant']['name']
+        path: str = f"tournaments/{self.account.subdomain_inject}{self.tourney_id}/participants/{team_id}.json"
+        participant = self.account.get_json(path, 'participants', self.tournament_path)
+        # print(json.dumps(participant,indent=1))
+        self.teams[team_id] = participant['participant']['name']
+        return participant['participant']['name']
 
 
 BB3: [] = ['BB3', [{'id': 5057256, 'bracket': 'KO'},
@@ -420,10 +461,15 @@ TEMPLATE: [] = ["", [{'id': '', 'bracket': 'KO'},
 # Coro 17s/f groups?
 
 
+# fetches every bracket of the tourney at once, then writes them to filename in subtourney_list order
 def get_match_results_from_challonge(account, tourney_name, subtourney_list, filename, append=False):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=account.max_workers) as pool:
+        futures = [pool.submit(account.get_tournament, tourney_name, subtourney['id'], subtourney['bracket'])
+                   for subtourney in subtourney_list]
+        tournaments: [ChallongeTournament] = [future.result() for future in futures]
+
     first_write = True
-    for subtourney in subtourney_list:
-        ct: ChallongeTournament = account.get_tournament(tourney_name, subtourney['id'], subtourney['bracket'])
+    for ct in tournaments:
         ct.write_matchfile(filename, append or not first_write)
         first_write = False
 
@@ -439,11 +485,15 @@ def main():
     # cp.read('properties/api_keys.cfg')
     # api_key = cp.get('APIKeys', '')
 
-    account: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd', None)
-    account_kqsf: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd','kq-sf')
-    account_sfl: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd', 'hybridhypegaming')
-    account_stl: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd', 'killerqueenstl')
-    account_cha: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd','killer-queen-chattanooga')
+    # finished tournaments come from challonge_cache/ after the first run.
+    # --offline rebuilds the match files from the cache alone
+    cache: ChallongeCache = ChallongeCache(offline='--offline' in sys.argv[1:])
+
+    account: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd', None, cache=cache)
+    account_kqsf: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd','kq-sf', cache=cache)
+    account_sfl: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd', 'hybridhypegaming', cache=cache)
+    account_stl: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd', 'killerqueenstl', cache=cache)
+    account_cha: ChallongeAccount = ChallongeAccount('OJxf8wmFKHb5afldGJ1HzTn5Omg4s7BcuevuQXCd','killer-queen-chattanooga', cache=cache)
 
     # account.print_tournament('BKCRN2017')
 
@@ -1,19 +1,29 @@
+import sys
+
 import requests
 
+from KQTrueSkill.ingest_tools.challongecache import ChallongeCache
+
 
 class ChallongeAccount:
     DATETIME_FORMAT: str = "%Y-%m-%dT%H:%M:%S.%f%z"
     API_URL: str = "https://api.challonge.com/v1/"
 
-    def __init__(self, api_key: str, subdomain: str):
+    # cache: keep the index on disk, see ChallongeCache.  it's revalidated on every run, or used as is offline
+    def __init__(self, api_key: str, subdomain: str, cache: ChallongeCache = None):
         self.subdomain = subdomain
         self.api_key = api_key
+        self.cache = cache
 
     def get_tourney_list(self) -> {}:
         url: str = f"{self.API_URL}tournaments.json?api_key={self.api_key}"
+        key: str = "tournaments.json"
         if self.subdomain is not None:
             url += f"&subdomain={self.subdomain}"
+            key = f"tournaments.{self.subdomain}.json"
         print(url)
+        if self.cache is not None:
+            return self.cache.fetch(requests.get, url, key, label='index')
         resp = requests.get(url)
         if resp.status_code != 200:
             # This means something went wrong.
@@ -34,7 +44,8 @@ def main():
 
     subdomain = None  # get the tourneys from a larger challonge org that your account is part of
 
-    account: ChallongeAccount = ChallongeAccount(api_key, subdomain)
+    account: ChallongeAccount = ChallongeAccount(api_key, subdomain,
+                                                 cache=ChallongeCache(offline='--offline' in sys.argv[1:]))
     account.print_tourney_list()
 
 
@@ -0,0 +1,135 @@
+import re
+import sys
+import time
+import unicodedata
+from dataclasses import dataclass
+from typing import Dict
+
+import numpy as np
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill
+
+# how much a candidate from the same scene moves up the ranking
+SAME_SCENE_BONUS = 0.15
+
+
+@dataclass
+class NameMatch:
+    '''A known player that might be the same person as the name looked up.'''
+    name: str
+    scene: str
+    score: float  # trigram similarity, 1 for names that only differ in case, accents or punctuation
+    same_scene: bool
+
+
+# lower case, no accents, anything that isn't a letter or digit is a single space
+def normalize_name(name: str) -> str:
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.split(r'[\W_]+', name)).strip()
+
+
+# distinct character trigrams of a normalized name, padded so the first and last letters count as much as the rest
+def trigrams(normalized: str) -> {str}:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    '''Inverted index from character trigrams to known player names, for finding who a new roster's names
+    probably are.
+
+    A lookup counts, for every name sharing a trigram with the one looked up, how many trigrams they share (a
+    bincount over the posting lists), scores them with the Dice coefficient 2 * shared / (trigrams + trigrams) and
+    keeps the best few.  Only names sharing a trigram are ever looked at, so lookups stay in the milliseconds with
+    tens of thousands of players.'''
+
+    def __init__(self, scenes: Dict[str, str] = None):
+        self.names = []  # names[id] = name as written
+        self.scenes = []  # scenes[id] = scene, or None
+        self.ids = {}  # ids[name] = id
+        self.normalized_ids = {}  # normalized_ids[normalized name] = [id...]
+        self.trigram_counts = np.zeros(0, dtype=np.int64)  # trigram_counts[id] = how many distinct trigrams the name has
+        self.postings = {}  # postings[trigram] = [id...]
+        self.posting_arrays = {}  # numpy copies of postings, dropped when a posting list grows
+        for name, scene in (scenes or {}).items():
+            self.add(name, scene)
+
+    # every player history knows, with their scene
+    @classmethod
+    def from_history(cls, history: KQTrueSkill) -> 'NameIndex':
+        return cls(history.playerscenes)
+
+    def add(self, name: str, scene: str = None):
+        if name in self.ids:
+            self.scenes[self.ids[name]] = scene
+            return
+        name_id = len(self.names)
+        self.ids[name] = name_id
+        self.names.append(name)
+        self.scenes.append(scene)
+        normalized = normalize_name(name)
+        self.normalized_ids.setdefault(normalized, []).append(name_id)
+        grams = trigrams(normalized)
+        if name_id == len(self.trigram_counts):
+            # grow by doubling, so adding players one at a time isn't quadratic
+            self.trigram_counts = np.concatenate([self.trigram_counts, np.zeros(max(name_id, 16), dtype=np.int64)])
+        self.trigram_counts[name_id] = len(grams)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(name_id)
+            self.posting_arrays.pop(gram, None)
+
+    def posting_array(self, gram: str) -> np.ndarray:
+        if gram not in self.posting_arrays:
+            self.posting_arrays[gram] = np.array(self.postings.get(gram, []), dtype=np.int64)
+        return self.posting_arrays[gram]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.names)
+
+    # known players that could be name, best first.  scene: the scene the name was listed with, candidates from
+    # the same scene rank higher
+    def matches(self, name: str, scene: str = None, limit: int = 5, min_score: float = 0.4) -> [NameMatch]:
+        normalized = normalize_name(name)
+        grams = trigrams(normalized)
+        postings = [self.posting_array(gram) for gram in grams if gram in self.postings]
+        if not postings:
+            return []
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.names))
+        candidates = np.flatnonzero(shared)
+        score = 2 * shared[candidates] / (len(grams) + self.trigram_counts[candidates])
+        # same name apart from case, accents and punctuation
+        for name_id in self.normalized_ids.get(normalized, []):
+            score[np.searchsorted(candidates, name_id)] = 1.0
+        keep = score >= min_score
+        candidates, score = candidates[keep], score[keep]
+
+        scene_key = scene.strip().casefold() if scene else None
+        same_scene = np.array([scene_key is not None and (self.scenes[c] or '').strip().casefold() == scene_key
+                               for c in candidates.tolist()], dtype=bool)
+        rank = score + SAME_SCENE_BONUS * same_scene
+        best = np.argsort(-rank, kind='stable')[:limit]
+        return [NameMatch(name=self.names[c], scene=self.scenes[c], score=float(s), same_scene=bool(same))
+                for c, s, same in zip(candidates[best].tolist(), score[best].tolist(), same_scene[best].tolist())]
+
+
+def main():
+    # usage: namematch.py name [scene]
+    name = sys.argv[1] if len(sys.argv) > 1 else 'Rob Renaud'
+    scene = sys.argv[2] if len(sys.argv) > 2 else None
+    history = KQTrueSkill(players_only=True)
+    start = time.perf_counter()
+    index = NameIndex.from_history(history)
+    print(f"indexed {len(index)} players in {time.perf_counter() - start:.3f}s")
+    start = time.perf_counter()
+    found = index.matches(name, scene)
+    print(f"looked up {name} in {1000 * (time.perf_counter() - start):.2f}ms")
+    for match in found:
+        print(f"{match.name} / {match.scene}: {match.score:.2f}{' (same scene)' if match.same_scene else ''}")
+
+
+if __name__ == '__main__':
+    main()
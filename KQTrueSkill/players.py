@@ -1,45 +1,34 @@
-import csv
+from KQTrueSkill.KQtrueskill import KQTrueSkill, read_player_file
+from KQTrueSkill.namematch import NameIndex
 
-from KQTrueSkill.KQtrueskill import KQTrueSkill
 
 
 
-
-def compare_players_to_history(history: KQTrueSkill, filename: str = None):
+# prints every player in a roster file history doesn't know, with the known players they most likely are
+def compare_players_to_history(history: KQTrueSkill, filename: str = None, index: NameIndex = None):
     if filename is None:
         filename = 'datasets/BB Players.csv'
+    if index is None:
+        index = NameIndex.from_history(history)
 
-    not_found = []
-    with open(filename) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        line_count = 0
-        for row in csv_reader:
-            if line_count == 0:
-                line_count += 1
-            else:
-                line_count +=1
-                print(line_count)
-                tournament = row[0]
-                playerteam = row[1]
-                playername = row[2]
-                playerscene = row[3]
-
-                if playername not in history.playerteams.keys():
-                    p = f"{playername} / {playerscene} not found. {tournament}/{playerteam} *************************"
-                    # print(p)
-                    not_found.append(p)
-    all_players_sorted = sorted(history.get_player_scene_list() + not_found)
-    for p in all_players_sorted:
-        print(p)
-    for p in not_found:
-        print(p)
+    header, rows = read_player_file(filename)
+    not_found = 0
+    for tournament, playerteam, playername, playerscene in rows:
+        if playername and playername not in index:
+            not_found += 1
+            print(f"{playername} / {playerscene} not found. {tournament}/{playerteam} *************************")
+            for match in index.matches(playername, playerscene):
+                same_scene = ', same scene' if match.same_scene else ''
+                print(f"    {match.name} / {match.scene} ({match.score:.2f}{same_scene})")
+    print(f"{not_found} of {len(rows)} players in {filename} not found")
 
 
     # history.write_player_ratings('2018 KQ - HH1 game results.csv')
 
 
 def main():
-    history: KQTrueSkill = KQTrueSkill()
+    # only the rosters are needed, skip running trueskill
+    history: KQTrueSkill = KQTrueSkill(players_only=True)
     print(history.tournaments)
 
     compare_players_to_history(history, 'datasets/2019 misc players.csv')
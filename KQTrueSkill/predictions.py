@@ -0,0 +1,121 @@
+import json
+import math
+import sys
+
+import trueskill
+from trueskill import Rating
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, MatchObserver, bracket_type, win_probability
+
+# calibration buckets are over the favorite's win probability, [0.5, 0.6) ... [0.9, 1.0]
+CALIBRATION_BUCKETS = 5
+
+
+class PredictionScores:
+    '''Log loss, Brier score, accuracy and calibration of a set of per game win probabilities.'''
+
+    def __init__(self):
+        self.games = 0
+        self.correct = 0.0
+        self.log_loss = 0.0
+        self.brier = 0.0
+        self.bucket_games = [0] * CALIBRATION_BUCKETS
+        self.bucket_predicted = [0.0] * CALIBRATION_BUCKETS
+        self.bucket_favorite_wins = [0] * CALIBRATION_BUCKETS
+
+    # p is the probability team 1 wins a game, scored against every game of the set
+    def add(self, p: float, team1wins: int, team2wins: int) -> None:
+        # keep log(0) out of the loss when trueskill is very sure of itself
+        clipped = min(max(p, 1e-12), 1 - 1e-12)
+        self.games += team1wins + team2wins
+        self.log_loss -= team1wins * math.log(clipped) + team2wins * math.log(1 - clipped)
+        self.brier += team1wins * (1 - p) ** 2 + team2wins * p ** 2
+
+        if p >= 0.5:
+            favorite_p, favorite_wins = p, team1wins
+        else:
+            favorite_p, favorite_wins = 1 - p, team2wins
+        if favorite_p == 0.5:
+            self.correct += (team1wins + team2wins) / 2
+        else:
+            self.correct += favorite_wins
+        bucket = min(int((favorite_p - 0.5) * 2 * CALIBRATION_BUCKETS), CALIBRATION_BUCKETS - 1)
+        self.bucket_games[bucket] += team1wins + team2wins
+        self.bucket_predicted[bucket] += favorite_p * (team1wins + team2wins)
+        self.bucket_favorite_wins[bucket] += favorite_wins
+
+    def report(self) -> dict:
+        if self.games == 0:
+            return {'games': 0}
+        calibration = []
+        for i in range(CALIBRATION_BUCKETS):
+            games = self.bucket_games[i]
+            calibration.append({'favorite_p_min': 0.5 + i / (2 * CALIBRATION_BUCKETS),
+                                'favorite_p_max': 0.5 + (i + 1) / (2 * CALIBRATION_BUCKETS),
+                                'games': games,
+                                'predicted': self.bucket_predicted[i] / games if games else None,
+                                'observed': self.bucket_favorite_wins[i] / games if games else None})
+        return {'games': self.games,
+                'log_loss': self.log_loss / self.games,
+                'brier': self.brier / self.games,
+                'accuracy': self.correct / self.games,
+                'calibration': calibration}
+
+
+class PredictivePowerHarness(MatchObserver):
+    '''Scores trueskill's pre-match win probability against every game while the history is replayed,
+    overall, per tournament and per bracket type (KO/WC/Group).
+
+    It is a MatchObserver, so it rides along with the rating update instead of needing a replay of its own.'''
+
+    def __init__(self, env: trueskill.TrueSkill):
+        self.env = env
+        self.overall = PredictionScores()
+        self.by_tournament = {}  # by_tournament[tournament] = PredictionScores
+        self.by_bracket = {}  # by_bracket['KO'|'WC'|'Group'] = PredictionScores
+
+    def before_match(self, match, team1_ratings: [Rating], team2_ratings: [Rating]) -> None:
+        p = win_probability(team1_ratings, team2_ratings, self.env)
+        team1wins: int = match['team1wins']
+        team2wins: int = match['team2wins']
+        tournament: str = match['tournament']
+        bracket: str = bracket_type(match['bracket'])
+
+        if tournament not in self.by_tournament:
+            self.by_tournament[tournament] = PredictionScores()
+        if bracket not in self.by_bracket:
+            self.by_bracket[bracket] = PredictionScores()
+        self.overall.add(p, team1wins, team2wins)
+        self.by_tournament[tournament].add(p, team1wins, team2wins)
+        self.by_bracket[bracket].add(p, team1wins, team2wins)
+
+    def report(self) -> dict:
+        return {'env': {'mu': self.env.mu, 'sigma': self.env.sigma, 'beta': self.env.beta, 'tau': self.env.tau},
+                'overall': self.overall.report(),
+                'by_bracket': {b: scores.report() for b, scores in self.by_bracket.items()},
+                'by_tournament': {t: scores.report() for t, scores in self.by_tournament.items()}}
+
+    def write_report(self, filename: str = 'predictions.json'):
+        with open(filename, mode='w') as report_file:
+            json.dump(self.report(), report_file, indent=1)
+
+
+def main():
+    # usage: predictions.py [report file], compare reports between model changes
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'predictions.json'
+    env = trueskill.TrueSkill(draw_probability=0)
+    harness = PredictivePowerHarness(env)
+    KQTrueSkill(env=env, match_observers=[harness]).ensure_rated()
+    harness.write_report(filename)
+
+    overall = harness.overall.report()
+    print(f"{overall['games']} games: log loss {overall['log_loss']:.4f}, brier {overall['brier']:.4f}, "
+          f"accuracy {overall['accuracy']:.3f}")
+    for bracket, scores in sorted(harness.by_bracket.items()):
+        report = scores.report()
+        print(f"  {bracket}: {report['games']} games, log loss {report['log_loss']:.4f}, "
+              f"accuracy {report['accuracy']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
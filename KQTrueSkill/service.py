@@ -0,0 +1,272 @@
+import asyncio
+import json
+import sys
+import urllib.parse
+from typing import Callable
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, sort_tournaments_by_date
+from KQTrueSkill.diagnostics import Diagnostics, options_from_argv
+
+# biggest request body accepted, win probability batches are well under this
+MAX_BODY_BYTES = 1 << 20
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+class ServiceError(Exception):
+    '''A request the service can't answer, sent back as {"error": message} with status.'''
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def rating_fields(rating) -> dict:
+    return {'mu': rating.mu, 'sigma': rating.sigma, 'trueskill': rating.mu - 3 * rating.sigma}
+
+
+def stats_fields(stats) -> dict:
+    return {'wins': stats.wins, 'losses': stats.losses, 'net_rating_change': stats.net_rating_change,
+            'tournaments': sorted(stats.tournaments)}
+
+
+class RatingService:
+    '''Answers rating questions over HTTP from a history built once and kept in memory, instead of every tool
+    reading PlayerSkill.csv or the generated pages.
+
+    GET  /leaderboard?page=1&per_page=50&scene=   players by trueskill (mu - 3 sigma), a page at a time
+    GET  /players/<name>?matches=1                a player's rating after every tournament (and every match)
+    GET  /head-to-head?a=<name>&b=<name>          their record against each other and as teammates
+    POST /win-probability {"teams": [[names]...]}  team_win_probabilities for every pair of teams
+    POST /reload                                  rebuilds the history from the datasets
+    GET  /version                                 what's loaded, the request counters and the last load's
+                                                  counters and timers
+
+    Responses are JSON.  Everything is answered from memory and the encoded responses are cached, so repeated
+    questions only cost parsing the request.  /reload builds the new history in a worker thread while the old
+    one keeps answering, then swaps it in and bumps version, which drops every cached response.'''
+
+    # most responses kept around, the cache is cleared when it fills up
+    response_cache_size: int = 4096
+
+    # build_history(diagnostics=...) returns the history to serve, KQTrueSkill() by default
+    def __init__(self, build_history: Callable[..., KQTrueSkill] = KQTrueSkill, diagnostics: Diagnostics = None):
+        self.build_history = build_history
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self.version = 0
+        self.response_cache = {}  # [(method, target, body)] = (version, status, encoded body)
+        self.reload_lock = asyncio.Lock()
+        self.install(self.load_history())
+
+    # the new history, rated and with the reports requests use already built.  runs in a worker thread on /reload.
+    # every load gets its own diagnostics (history.diagnostics), so its counters and timers don't pile up on top
+    # of earlier loads; self.diagnostics keeps the request counters
+    def load_history(self) -> KQTrueSkill:
+        diagnostics = Diagnostics(level=self.diagnostics.level, echo=self.diagnostics.echo,
+                                  max_events=self.diagnostics.max_events)
+        with diagnostics.timer('service load'):
+            history = self.build_history(diagnostics=diagnostics)
+            history.ensure_rated()
+            history.timeline
+            history.ratings_change_by_opponent
+            history.ratings_change_by_teammate
+        return history
+
+    def install(self, history: KQTrueSkill):
+        self.history = history
+        # (rank, player, scene, rating) by trueskill, best first
+        ranked = sorted(((player, history.playerscenes.get(player), rating)
+                         for player, rating in history.playerratings.items()),
+                        key=lambda row: (-(row[2].mu - 3 * row[2].sigma), row[0]))
+        self.leaderboard = [(rank, *row) for rank, row in enumerate(ranked, start=1)]
+        self.version += 1
+        self.response_cache.clear()
+        self.diagnostics.info(f"serving version {self.version}: {len(self.leaderboard)} players, "
+                              f"{len(history.matches)} matches", version=self.version)
+
+    async def reload(self) -> dict:
+        async with self.reload_lock:
+            history = await asyncio.get_running_loop().run_in_executor(None, self.load_history)
+            self.install(history)
+        return self.version_info()
+
+    def version_info(self) -> dict:
+        load = self.history.diagnostics
+        return {'version': self.version, 'players': len(self.leaderboard), 'matches': len(self.history.matches),
+                'tournaments': len(self.history.tournaments), 'counters': dict(self.diagnostics.counters),
+                'load': {'counters': dict(load.counters), 'timers': dict(load.timers)}}
+
+    def player(self, name: str) -> str:
+        if name not in self.history.player_ids:
+            raise ServiceError(404, f"unknown player {name}")
+        return name
+
+    def leaderboard_page(self, query: dict) -> dict:
+        try:
+            page = int(query.get('page', 1))
+            per_page = int(query.get('per_page', 50))
+        except ValueError:
+            raise ServiceError(400, "page and per_page have to be numbers")
+        if page < 1 or not 1 <= per_page <= 1000:
+            raise ServiceError(400, "page starts at 1 and per_page is 1 to 1000")
+        rows = self.leaderboard
+        scene = query.get('scene')
+        if scene is not None:
+            # ranks stay overall ranks
+            rows = [row for row in rows if (row[2] or '').casefold() == scene.casefold()]
+        first = (page - 1) * per_page
+        history = self.history
+        return {'version': self.version, 'page': page, 'per_page': per_page, 'total': len(rows),
+                'players': [{'rank': rank, 'name': player, 'scene': player_scene, **rating_fields(rating),
+                             'games': history.playergames[player], 'wins': history.playerwins[player],
+                             'losses': history.playerlosses[player]}
+                            for rank, player, player_scene, rating in rows[first:first + per_page]]}
+
+    def player_timeline(self, name: str, query: dict) -> dict:
+        history = self.history
+        player = self.player(name)
+        tournaments = sort_tournaments_by_date(history.playertournaments[player], history)
+        response = {'version': self.version, 'name': player, 'scene': history.playerscenes.get(player),
+                    **rating_fields(history.playerratings[player]), 'games': history.playergames[player],
+                    'wins': history.playerwins[player], 'losses': history.playerlosses[player],
+                    'tournaments': [{'tournament': tournament, 'date': str(history.tournamentdates.get(tournament)),
+                                     'team': history.playerteams[player].get(tournament),
+                                     **rating_fields(history.snapshots[tournament][player])}
+                                    for tournament in tournaments]}
+        if query.get('matches', '0') not in ('', '0'):
+            response['matches'] = [{'time': time.isoformat(), 'tournament': tournament, 'bracket': bracket,
+                                    **rating_fields(rating)}
+                                   for time, tournament, bracket, rating in history.timeline.ratings_between(player)]
+        return response
+
+    def head_to_head(self, query: dict) -> dict:
+        if 'a' not in query or 'b' not in query:
+            raise ServiceError(400, "head-to-head needs players a and b")
+        a, b = self.player(query['a']), self.player(query['b'])
+        opponents = self.history.ratings_change_by_opponent.ratings_change_by_opp.get(a, {})
+        teammates = self.history.ratings_change_by_teammate.ratings_change_by_teammate.get(a, {})
+        return {'version': self.version, 'a': a, 'b': b,
+                'against': stats_fields(opponents[b]) if b in opponents else None,
+                'together': stats_fields(teammates[b]) if b in teammates else None}
+
+    def win_probabilities(self, body: bytes) -> dict:
+        try:
+            teams = json.loads(body)['teams']
+        except (ValueError, KeyError, TypeError):
+            raise ServiceError(400, 'expected {"teams": [[player names]...]}')
+        if not isinstance(teams, list) or not all(isinstance(team, list) and
+                                                   all(isinstance(player, str) for player in team)
+                                                   for team in teams):
+            raise ServiceError(400, 'expected {"teams": [[player names]...]}')
+        unknown = sorted({player for team in teams for player in team if player not in self.history.player_ids})
+        if unknown:
+            raise ServiceError(404, f"unknown players {unknown}")
+        return {'version': self.version, 'teams': teams,
+                'win_probabilities': self.history.team_win_probabilities(teams).tolist()}
+
+    # (status, response) for one request
+    def route(self, method: str, path: str, query: dict, body: bytes) -> (int, dict):
+        if path == '/leaderboard' and method == 'GET':
+            return 200, self.leaderboard_page(query)
+        if path.startswith('/players/') and method == 'GET':
+            return 200, self.player_timeline(urllib.parse.unquote(path[len('/players/'):]), query)
+        if path == '/head-to-head' and method == 'GET':
+            return 200, self.head_to_head(query)
+        if path == '/win-probability' and method == 'POST':
+            return 200, self.win_probabilities(body)
+        if path == '/version' and method == 'GET':
+            return 200, self.version_info()
+        if path in ('/leaderboard', '/head-to-head', '/win-probability', '/version') or path.startswith('/players/'):
+            raise ServiceError(405, f"{method} not supported on {path}")
+        raise ServiceError(404, f"nothing at {path}")
+
+    # (status, encoded body) for a request, from the response cache when the same request was answered by this
+    # version already.  /version and /reload are never cached
+    async def respond(self, method: str, target: str, body: bytes) -> (int, bytes):
+        self.diagnostics.count('requests')
+        split = urllib.parse.urlsplit(target)
+        if split.path == '/reload':
+            if method != 'POST':
+                return 405, json.dumps({'error': "POST to /reload"}).encode()
+            return 200, json.dumps(await self.reload()).encode()
+
+        key = (method, target, body)
+        cached = self.response_cache.get(key)
+        if cached is not None and cached[0] == self.version:
+            self.diagnostics.count('response cache hits')
+            return cached[1], cached[2]
+        query = dict(urllib.parse.parse_qsl(split.query, keep_blank_values=True))
+        try:
+            status, response = self.route(method, split.path, query, body)
+        except ServiceError as e:
+            status, response = e.status, {'error': str(e)}
+        except Exception as e:
+            self.diagnostics.error(f"{method} {target} failed: {e!r}", target=target)
+            return 500, json.dumps({'error': repr(e)}).encode()
+        encoded = json.dumps(response, separators=(',', ':')).encode()
+        if split.path != '/version':
+            if len(self.response_cache) >= self.response_cache_size:
+                self.response_cache.clear()
+            self.response_cache[key] = (self.version, status, encoded)
+        return status, encoded
+
+    # HTTP/1.1 with keep-alive, one request at a time per connection
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode('latin-1').split()
+                keep_alive = len(parts) == 3 and (headers.get('connection', '').lower() != 'close'
+                                                  if parts[2] == 'HTTP/1.1'
+                                                  else headers.get('connection', '').lower() == 'keep-alive')
+                content_length = headers.get('content-length', '0')
+                length = int(content_length) if content_length.isdigit() else -1
+                if len(parts) != 3 or length < 0:
+                    status, body, keep_alive = 400, json.dumps({'error': "malformed request"}).encode(), False
+                elif length > MAX_BODY_BYTES:
+                    status, body, keep_alive = 413, json.dumps({'error': "request body too big"}).encode(), False
+                else:
+                    status, body = await self.respond(parts[0], parts[1], await reader.readexactly(length))
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        self.diagnostics.info(f"listening on http://{host}:{port}", host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    # usage: service.py [port] [--log-level=warning]
+    level, _ = options_from_argv(sys.argv[1:])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    port = int(args[0]) if args else 8080
+
+    async def run():
+        # the service has to be built inside the running loop, its reload lock belongs to it
+        await RatingService(diagnostics=Diagnostics(level=level)).serve(port=port)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+import collections
+import concurrent.futures
+import math
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict
+
+import numpy as np
+from trueskill import Rating
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, TEAM_SIZE, bracket_type, team_rating_sums, win_probability_matrix
+
+# simulations per batch of numpy draws, and per task when running in a process pool
+CHUNK_SIZE = 10000
+
+
+@dataclass
+class TournamentFormat:
+    '''How a tournament is played: round robin groups, then a single elimination wildcard (WC) bracket for the
+    teams that just missed out, then a double elimination KO bracket.  Every stage is optional.
+
+    Teams qualify from each group by set wins, then game difference, then a coin flip.  Qualifiers are seeded
+    into the next stage by where they finished in their group, and by their record between groups that finished
+    in the same place.  Teams that skip a stage are seeded above the teams that played their way in.'''
+    groups: [[str]] = field(default_factory=list)  # teams in each group
+    group_advance: [int] = field(default_factory=list)  # how many of each group's top finishers go straight to KO
+    group_wildcard: [int] = field(default_factory=list)  # how many of the next finishers in each group go to WC
+    wildcard_teams: [str] = field(default_factory=list)  # teams that start in WC, best seed first
+    wildcard_advance: int = 0  # WC winners that join KO
+    ko_teams: [str] = field(default_factory=list)  # teams that start in KO, best seed first
+    group_best_of: int = 3
+    wildcard_best_of: int = 5
+    ko_best_of: int = 5
+    grand_final_reset: bool = True  # the losers bracket champion has to beat the winners bracket champion twice
+
+    def teams(self) -> [str]:
+        return [t for group in self.groups for t in group] + list(self.wildcard_teams) + list(self.ko_teams)
+
+
+@dataclass
+class PlacementForecast:
+    '''How often each team finished in each place over simulations simulated tournaments.  Teams knocked out
+    in the same round share the best place of that round, e.g. 5th for both teams out in the round of 5th-6th.'''
+    teams: [str]
+    places: [int]  # every place any team finished in, ascending
+    probabilities: np.ndarray  # [team, place index]
+    simulations: int
+
+    def distribution(self, team: str) -> Dict[int, float]:
+        row = self.probabilities[self.teams.index(team)]
+        return {place: float(p) for place, p in zip(self.places, row) if p > 0}
+
+    def expected_place(self, team: str) -> float:
+        return float(self.probabilities[self.teams.index(team)] @ np.array(self.places))
+
+
+# seed indexes in bracket order, so the first round is 1 vs n, n/2 vs n/2 + 1, ... with 1 and 2 on opposite
+# sides.  n is a power of 2
+def bracket_order(n: int) -> [int]:
+    order = [0]
+    while len(order) < n:
+        size = 2 * len(order)
+        order = [x for seed in order for x in (seed, size - 1 - seed)]
+    return order
+
+
+# every way a best of N set can end, as (team 1 games, team 2 games): team 1's wins first, then team 2's
+def set_scores(best_of: int) -> [(int, int)]:
+    to_win = best_of // 2 + 1
+    return [(to_win, games) for games in range(to_win)] + [(games, to_win) for games in reversed(range(to_win))]
+
+
+# chance of each of set_scores(best_of) when team 1 wins each game with probability p, stacked on a new last axis
+def set_score_probabilities(p: np.ndarray, best_of: int) -> np.ndarray:
+    return np.stack([math.comb(team1_games + team2_games - 1, min(team1_games, team2_games)) *
+                     p ** team1_games * (1 - p) ** team2_games
+                     for team1_games, team2_games in set_scores(best_of)], axis=-1)
+
+
+class TournamentSimulator:
+    '''Plays a TournamentFormat out many times at once.  Every stage works on (simulations, teams) arrays of
+    team indexes, so each round of every simulated tournament is one batch of numpy draws.
+
+    win_probabilities[i, j] is team i's chance of beating team j in one game.  Brackets that aren't a power of 2
+    are filled out with a bye team, index len(teams), that loses every game.'''
+
+    def __init__(self, tournament_format: TournamentFormat, teams: [str], win_probabilities: np.ndarray):
+        for best_of in (tournament_format.group_best_of, tournament_format.wildcard_best_of,
+                        tournament_format.ko_best_of):
+            if best_of % 2 == 0:
+                raise Exception(f"sets have to be best of an odd number of games, not {best_of}")
+        if sorted(tournament_format.teams()) != sorted(teams):
+            raise Exception("every team has to start in exactly one group or bracket")
+        self.format = tournament_format
+        self.teams = teams
+        self.bye = len(teams)
+        index = {team: i for i, team in enumerate(teams)}
+
+        win_probabilities = np.pad(win_probabilities, (0, 1))
+        win_probabilities[:, self.bye] = 1
+        win_probabilities[self.bye, self.bye] = 0.5
+        # set_win_probabilities[best of][i, j]: team i's chance of winning a set against team j
+        self.set_win_probabilities = {
+            best_of: set_score_probabilities(win_probabilities, best_of)[..., :best_of // 2 + 1].sum(axis=-1)
+            for best_of in (tournament_format.wildcard_best_of, tournament_format.ko_best_of)}
+
+        self.groups = [np.array([index[t] for t in group], dtype=np.int64) for group in tournament_format.groups]
+        pairs = [(a, b) for group in self.groups for i, a in enumerate(group) for b in group[i + 1:]]
+        self.group_home = np.array([a for a, b in pairs], dtype=np.int64)
+        self.group_away = np.array([b for a, b in pairs], dtype=np.int64)
+        # each set is worth 1000 to its winner, plus its game difference to either team, so a team's standing
+        # sorts by set wins and then game difference.  group_points[score] is what each of set_scores is worth
+        # to the home and the away team
+        scores = np.array(set_scores(tournament_format.group_best_of))
+        home_won = scores[:, 0] > scores[:, 1]
+        self.group_points = np.stack([1000.0 * home_won + scores[:, 0] - scores[:, 1],
+                                      1000.0 * ~home_won + scores[:, 1] - scores[:, 0]])
+        # group_teams[set, team]: one hot team of the home sides of every group set, then the away sides
+        self.group_teams = np.eye(self.bye + 1)[np.concatenate([self.group_home, self.group_away])]
+        self.group_score_thresholds = np.cumsum(set_score_probabilities(
+            win_probabilities[self.group_home, self.group_away], tournament_format.group_best_of), axis=-1)[:, :-1]
+        self.wildcard_seeds = np.array([index[t] for t in tournament_format.wildcard_teams], dtype=np.int64)
+        self.ko_seeds = np.array([index[t] for t in tournament_format.ko_teams], dtype=np.int64)
+        self.group_qualifiers = sum(tournament_format.group_advance) + sum(tournament_format.group_wildcard)
+        self.ko_size = len(self.ko_seeds) + sum(tournament_format.group_advance) + tournament_format.wildcard_advance
+        if self.ko_size == 0:
+            raise Exception("nobody makes it to KO")
+
+    # one set for every column of team1 and team2, returns the (winners, losers)
+    def play_round(self, rng: np.random.Generator, team1: np.ndarray, team2: np.ndarray, best_of: int):
+        team1_won = rng.random(team1.shape) < self.set_win_probabilities[best_of][team1, team2]
+        return np.where(team1_won, team1, team2), np.where(team1_won, team2, team1)
+
+    def real_teams(self, bracket: np.ndarray) -> np.ndarray:
+        return (bracket != self.bye).sum(axis=1)
+
+    # losers[s, :] were knocked out with still_alive[s] teams left in simulation s
+    def knock_out(self, places: np.ndarray, losers: np.ndarray, still_alive: np.ndarray):
+        places[np.arange(len(places))[:, None], losers] = (still_alive + 1)[:, None]
+
+    # every group's round robin.  returns (straight to KO, to WC), each (simulations, teams) best seed first
+    def play_groups(self, rng: np.random.Generator, places: np.ndarray):
+        simulations = len(places)
+        if len(self.groups) == 0:
+            empty = np.zeros((simulations, 0), dtype=np.int64)
+            return empty, empty
+        # every group set's score is drawn with one uniform against the cumulative chance of each score
+        draws = rng.random((simulations, len(self.group_home)))
+        score = np.zeros(draws.shape, dtype=np.int64)
+        for threshold in self.group_score_thresholds.T:
+            score += draws > threshold
+        standing = self.group_points[:, score].transpose(1, 0, 2).reshape(simulations, -1) @ self.group_teams
+        standing += rng.random(standing.shape)
+
+        advance, wildcard, out = [], [], []
+        for group, group_advance, group_wildcard in zip(self.groups, self.format.group_advance,
+                                                        self.format.group_wildcard):
+            finish = group[np.argsort(-standing[:, group], axis=1)]
+            advance.append(finish[:, :group_advance])
+            wildcard.append(finish[:, group_advance:group_advance + group_wildcard])
+            out.append(finish[:, group_advance + group_wildcard:])
+        self.knock_out(places, np.concatenate(out, axis=1),
+                       np.full(simulations, self.group_qualifiers + len(self.wildcard_seeds) + len(self.ko_seeds)))
+        return self.seed_qualifiers(advance, standing), self.seed_qualifiers(wildcard, standing)
+
+    # qualifiers from every group, [group][simulation, place in group], in seed order: by place in their
+    # group, then by standing
+    def seed_qualifiers(self, qualifiers: [np.ndarray], standing: np.ndarray) -> np.ndarray:
+        teams = np.concatenate(qualifiers, axis=1)
+        group_place = np.concatenate([np.arange(q.shape[1]) for q in qualifiers])
+        team_standing = np.take_along_axis(standing, teams, axis=1)
+        return np.take_along_axis(teams, np.argsort(group_place * 1e9 - team_standing, axis=1), axis=1)
+
+    # single elimination until advance teams are left, returned in seed order.  seeds[simulation, seed]
+    def play_wildcard(self, rng: np.random.Generator, places: np.ndarray, seeds: np.ndarray,
+                      elsewhere: int) -> np.ndarray:
+        simulations, count = seeds.shape
+        advance = self.format.wildcard_advance
+        if advance == 0 or count <= advance:
+            if advance == 0:
+                self.knock_out(places, seeds, np.full(simulations, elsewhere))
+            return seeds
+        # one sub bracket per spot in KO, each with a top seed
+        rounds = math.ceil(math.log2(count / advance))
+        seeds = np.concatenate([seeds, np.full((simulations, advance * 2 ** rounds - count), self.bye)], axis=1)
+        columns = [block + advance * seed for block in range(advance) for seed in bracket_order(2 ** rounds)]
+        bracket = seeds[:, columns]
+        while bracket.shape[1] > advance:
+            bracket, losers = self.play_round(rng, bracket[:, 0::2], bracket[:, 1::2], self.format.wildcard_best_of)
+            self.knock_out(places, losers, elsewhere + self.real_teams(bracket))
+        return bracket
+
+    # double elimination, seeds[simulation, seed]
+    def play_ko(self, rng: np.random.Generator, places: np.ndarray, seeds: np.ndarray):
+        simulations, count = seeds.shape
+        size = 2 ** math.ceil(math.log2(count))
+        seeds = np.concatenate([seeds, np.full((simulations, size - count), self.bye)], axis=1)
+        winners = seeds[:, bracket_order(size)]
+        losers_bracket = None
+        best_of = self.format.ko_best_of
+        while winners.shape[1] > 1:
+            winners, dropped = self.play_round(rng, winners[:, 0::2], winners[:, 1::2], best_of)
+            if losers_bracket is None:
+                losers_bracket = dropped
+            else:
+                # teams dropping down play the losers bracket in reverse order, so they don't get a rematch
+                losers_bracket, out = self.play_round(rng, losers_bracket, dropped[:, ::-1], best_of)
+                self.knock_out(places, out, self.real_teams(winners) + self.real_teams(losers_bracket))
+            if losers_bracket.shape[1] > 1:
+                losers_bracket, out = self.play_round(rng, losers_bracket[:, 0::2], losers_bracket[:, 1::2],
+                                                      best_of)
+                self.knock_out(places, out, self.real_teams(winners) + self.real_teams(losers_bracket))
+        if losers_bracket is None:
+            places[np.arange(simulations), winners[:, 0]] = 1
+            return
+
+        champion, runner_up = self.play_round(rng, winners[:, 0], losers_bracket[:, 0], best_of)
+        if self.format.grand_final_reset:
+            reset = champion == losers_bracket[:, 0]
+            rematch_champion, rematch_runner_up = self.play_round(rng, champion, runner_up, best_of)
+            champion = np.where(reset, rematch_champion, champion)
+            runner_up = np.where(reset, rematch_runner_up, runner_up)
+        places[np.arange(simulations), runner_up] = 2
+        places[np.arange(simulations), champion] = 1
+
+    # places[simulation, team] for simulations tournaments
+    def run(self, simulations: int, rng: np.random.Generator) -> np.ndarray:
+        places = np.zeros((simulations, self.bye + 1), dtype=np.int64)
+        advance, wildcard = self.play_groups(rng, places)
+        wildcard = np.concatenate([np.broadcast_to(self.wildcard_seeds, (simulations, len(self.wildcard_seeds))),
+                                   wildcard], axis=1)
+        ko_direct = np.concatenate([np.broadcast_to(self.ko_seeds, (simulations, len(self.ko_seeds))), advance],
+                                   axis=1)
+        wildcard_winners = self.play_wildcard(rng, places, wildcard, ko_direct.shape[1])
+        self.play_ko(rng, places, np.concatenate([ko_direct, wildcard_winners], axis=1))
+        return places[:, :self.bye]
+
+    # place_counts[team, place] over simulations tournaments
+    def place_counts(self, simulations: int, seed: np.random.SeedSequence) -> np.ndarray:
+        rng = np.random.default_rng(seed)
+        counts = np.zeros((self.bye, self.bye + 1), dtype=np.int64)
+        teams = np.arange(self.bye)
+        for start in range(0, simulations, CHUNK_SIZE):
+            places = self.run(min(CHUNK_SIZE, simulations - start), rng)
+            counts += np.bincount((teams * (self.bye + 1) + places).ravel(),
+                                  minlength=counts.size).reshape(counts.shape)
+        return counts
+
+
+# run in the worker processes
+def simulator_place_counts(simulator: TournamentSimulator, simulations: int,
+                           seed: np.random.SeedSequence) -> np.ndarray:
+    return simulator.place_counts(simulations, seed)
+
+
+# team ratings padded with bots to TEAM_SIZE, the way replay_matches pads them
+def padded_team(history: KQTrueSkill, ratings: [Rating]) -> [Rating]:
+    return list(ratings) + [history.create_bot()] * (TEAM_SIZE - len(ratings))
+
+
+def simulate_tournament(history: KQTrueSkill, tournament_format: TournamentFormat,
+                        team_ratings: Dict[str, list], simulations: int = 100000, processes: int = 1,
+                        seed: int = 0) -> PlacementForecast:
+    '''Placement distribution of every team, from simulations runs of tournament_format.
+    team_ratings: each team's player Ratings.  processes other than 1 splits the simulations over a process pool
+    (None for one per cpu), with the same results for the same seed however many processes there are.'''
+    teams = tournament_format.teams()
+    rosters = [padded_team(history, team_ratings[team]) for team in teams]
+    win_probabilities = win_probability_matrix(*team_rating_sums(rosters), history.env)
+    simulator = TournamentSimulator(tournament_format, teams, win_probabilities)
+
+    chunks = [min(CHUNK_SIZE, simulations - start) for start in range(0, simulations, CHUNK_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    if processes == 1:
+        results = [simulator.place_counts(chunk, chunk_seed) for chunk, chunk_seed in zip(chunks, seeds)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(simulator_place_counts, [simulator] * len(chunks), chunks, seeds))
+    counts = sum(results)
+    if counts[:, 0].any():
+        raise Exception("some simulated teams never got a place")
+    places = [int(place) for place in np.flatnonzero(counts.sum(axis=0))]
+    return PlacementForecast(teams=teams, places=places, probabilities=counts[:, places] / simulations,
+                             simulations=simulations)
+
+
+# most common winning score of a stage's sets, as the N of best of N
+def stage_best_of(matches: [dict], default: int) -> int:
+    winning_scores = collections.Counter(max(m['team1wins'], m['team2wins']) for m in matches)
+    if not winning_scores:
+        return default
+    return 2 * winning_scores.most_common(1)[0][0] - 1
+
+
+# a best guess at how a tournament in history was played, from which teams played in which brackets.
+# Swiss, up-down and other group formats are treated as round robins, and teams that skip a stage are seeded
+# by their rating, best first
+def tournament_format(history: KQTrueSkill, tournament: str, team_strength: Dict[str, float]) -> TournamentFormat:
+    matches = [m for m in history.matches if m['tournament'] == tournament]
+    stage_matches = collections.defaultdict(list)
+    group_brackets = collections.OrderedDict()
+    for m in matches:
+        stage = bracket_type(m['bracket'])
+        stage_matches[stage].append(m)
+        if stage == 'Group':
+            group_brackets.setdefault(m['bracket'], [])
+
+    def stage_teams(stage: str) -> [str]:
+        return list(dict.fromkeys(t for m in stage_matches[stage] for t in (m['team1name'], m['team2name'])))
+
+    ko, wildcard = stage_teams('KO'), stage_teams('WC')
+    if not ko:
+        raise Exception(f"{tournament} has no KO bracket to simulate")
+    grouped = set()
+    for m in stage_matches['Group']:
+        for team in (m['team1name'], m['team2name']):
+            # a team that played in more than one group is counted in the first
+            if team not in grouped:
+                grouped.add(team)
+                group_brackets[m['bracket']].append(team)
+    groups = [teams for teams in group_brackets.values() if teams]
+
+    def by_strength(teams) -> [str]:
+        return sorted(teams, key=lambda team: -team_strength[team])
+
+    return TournamentFormat(
+        groups=groups,
+        group_advance=[sum(t in ko and t not in wildcard for t in group) for group in groups],
+        group_wildcard=[sum(t in wildcard for t in group) for group in groups],
+        wildcard_teams=by_strength(t for t in wildcard if t not in grouped),
+        wildcard_advance=sum(t in ko for t in wildcard),
+        ko_teams=by_strength(t for t in ko if t not in grouped and t not in wildcard),
+        group_best_of=stage_best_of(stage_matches['Group'], 3),
+        wildcard_best_of=stage_best_of(stage_matches['WC'], 5),
+        ko_best_of=stage_best_of(stage_matches['KO'], 5))
+
+
+def forecast_tournament(history: KQTrueSkill, tournament: str, simulations: int = 100000, processes: int = 1,
+                        seed: int = 0) -> PlacementForecast:
+    '''Placement distribution for a tournament in history, played the way tournament_format guesses it was,
+    by its registered teams with everyone's rating from before the tournament.  Teams that never played a match
+    aren't included.'''
+    team_ratings = {team: [history.rating_before(player, tournament) if player in history.player_ids
+                           else history.env.create_rating() for player in players]
+                    for team, players in history.teams[tournament].items()}
+    team_strength = {team: sum(r.mu for r in padded_team(history, ratings))
+                     for team, ratings in team_ratings.items()}
+    return simulate_tournament(history, tournament_format(history, tournament, team_strength), team_ratings,
+                               simulations, processes, seed)
+
+
+def main():
+    # usage: simulate.py [tournament]
+    tournament = sys.argv[1] if len(sys.argv) > 1 else 'BB4'
+    history = KQTrueSkill(backend='numpy')
+    start = time.perf_counter()
+    forecast = forecast_tournament(history, tournament, processes=None)
+    print(f"{forecast.simulations} simulations of {tournament} in {time.perf_counter() - start:.2f}s")
+    for team in sorted(forecast.teams, key=forecast.expected_place):
+        top_places = sorted(forecast.distribution(team).items(), key=lambda item: -item[1])[:3]
+        print(f"{team}: expected place {forecast.expected_place(team):.1f}, "
+              + ', '.join(f"{place}: {p:.3f}" for place, p in top_places))
+
+
+if __name__ == '__main__':
+    main()
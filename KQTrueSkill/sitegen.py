@@ -0,0 +1,190 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Dict
+
+if __name__ == '__main__':
+    # run as a script from KQTrueSkill/ (python sitegen.py), put the repo root on the path for the package imports
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, AggregatedMatchStats
+
+# source file -> name in the site directory
+SITE_ASSETS = {'js/sortable.min.js': 'sortable.min.js',
+               'css/sortable-theme-light.css': 'sortable-theme-light.css'}
+
+# every player's rating graph, loaded once by the browser instead of being inlined into each page.
+# it's json assigned to a global rather than a .json file, so the pages still work when opened from disk
+TRUESKILL_DATA_FILE = 'trueskill_data.js'
+
+# manifest[filename] = sha256 of what was last written there
+MANIFEST_FILE = '.manifest.json'
+
+
+# position of each tournament when sorted by date, so tables can sort with a dict lookup
+def tournament_order(history: KQTrueSkill) -> Dict[str, int]:
+    by_date = sorted(history.tournamentdates.keys(), key=lambda t: history.tournamentdates[t])
+    return {t: i for i, t in enumerate(by_date)}
+
+
+# plotly traces for each player's rating after every tournament they played, with 3 sigma error bars
+def trueskill_graph_data(history: KQTrueSkill, order: Dict[str, int]) -> dict:
+    graph_data = {}
+    for player in sorted(history.playerratings.keys()):
+        tournaments = sorted(history.playertournaments[player], key=order.__getitem__)
+        ratings = [history.snapshots[t][player] for t in tournaments]
+        graph_data[player] = [{'x': tournaments,
+                               'y': [r.mu for r in ratings],
+                               'error_y': {
+                                   'type': 'data',
+                                   'array': [r.sigma * 3 for r in ratings],
+                                   'visible': 'true'}}]
+    return graph_data
+
+
+# (other player, net rating change, wins, losses, tournaments) for each row of a player's table.
+# plain tuples, so they're cheap to send to the rendering processes
+def match_stats_rows(match_stats: Dict[str, AggregatedMatchStats], order: Dict[str, int]) -> [tuple]:
+    return [(other_player, agg_stats.net_rating_change, agg_stats.wins, agg_stats.losses,
+             ' '.join(sorted(agg_stats.tournaments, key=order.__getitem__)))
+            for other_player, agg_stats in match_stats.items()]
+
+
+def render_match_stats_table(rows: [tuple], table_type: str) -> str:
+    parts = [f"""
+<table class="sortable-theme-light" data-sortable>
+  <thead>
+   <tr>
+    <th>{table_type}</th>
+    <th>net rating change</th>
+    <th>wins</th>
+    <th>losses</th>
+    <th>win %</th>
+    <th>tournaments</th>
+   </tr>
+  </thead></tbody>
+"""]
+    for other_player, net_rating_change, wins, losses, tournaments in rows:
+        win_percentage = 100 * wins / (wins + losses)
+        parts.append(f"""<tr><td>{other_player}</td>
+                          <td>{net_rating_change:.3f}</td>
+                          <td>{wins}</td>
+                          <td>{losses}</td>
+                          <td>{win_percentage:.3f}</td>
+                          <td>{tournaments}</td>
+                       </tr>
+""")
+    parts.append('</tbody></table>')
+    return ''.join(parts)
+
+
+def render_player_page(player_name: str, teammate_rows: [tuple], opponent_rows: [tuple]) -> str:
+    return ''.join([
+        f"""<html><head><title>{player_name}'s KQ player page</title>
+                    <meta name="robots" content="noindex" />
+                    <script src="sortable.min.js"></script>
+                    <script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
+                    <script src="{TRUESKILL_DATA_FILE}"></script>
+                    <link rel="stylesheet" href="sortable-theme-light.css" />
+              </head>
+              <body>""",
+        f'<div id="trueskill_graph"></div> \n'
+        f'<script>Plotly.newPlot("trueskill_graph", TRUESKILL_DATA[{json.dumps(player_name)}])</script> \n',
+        render_match_stats_table(teammate_rows, 'teammate'),
+        render_match_stats_table(opponent_rows, 'opponent'),
+        '</body>'])
+
+
+def content_hash(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+# writes contents to directory/filename unless the manifest says it's already there, returns the new hash
+# and whether the file was written
+def write_if_changed(directory: str, filename: str, contents: bytes, old_hash: str) -> (str, bool):
+    new_hash = content_hash(contents)
+    path = os.path.join(directory, filename)
+    if new_hash == old_hash and os.path.exists(path):
+        return new_hash, False
+    with open(path, mode='wb') as output_file:
+        output_file.write(contents)
+    return new_hash, True
+
+
+# one page, run in the worker processes
+def write_player_page(directory: str, player_name: str, teammate_rows: [tuple], opponent_rows: [tuple],
+                      old_hash: str) -> (str, str, bool):
+    # TODO(rob): Use first name, last initial, scene as public player identifier.
+    filename = f'{player_name}.html'
+    page = render_player_page(player_name, teammate_rows, opponent_rows).encode()
+    return (filename,) + write_if_changed(directory, filename, page, old_hash)
+
+
+def load_manifest(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def generate_site(history: KQTrueSkill, directory: str = 'output', processes: int = None) -> int:
+    '''Writes a page per player, the shared graph data and the static assets to directory.
+    Only files whose contents changed since the last run are rewritten.  Pages are rendered in a pool
+    of processes, one per cpu by default (processes=1 renders them here), returns how many files were written.'''
+    start = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory)
+    new_manifest = {}
+    written = 0
+
+    for source, filename in SITE_ASSETS.items():
+        with open(source, mode='rb') as source_file:
+            new_manifest[filename], changed = write_if_changed(directory, filename, source_file.read(),
+                                                               manifest.get(filename))
+        written += changed
+
+    order = tournament_order(history)
+    graph_data = json.dumps(trueskill_graph_data(history, order))
+    new_manifest[TRUESKILL_DATA_FILE], changed = write_if_changed(
+        directory, TRUESKILL_DATA_FILE, f"var TRUESKILL_DATA = {graph_data};\n".encode(),
+        manifest.get(TRUESKILL_DATA_FILE))
+    written += changed
+
+    teammate_stats = history.ratings_change_by_teammate.ratings_change_by_teammate
+    opponent_stats = history.ratings_change_by_opponent.ratings_change_by_opp
+    players = sorted(history.playerratings.keys())
+    pages = [(directory, player,
+              match_stats_rows(teammate_stats.get(player, {}), order),
+              match_stats_rows(opponent_stats.get(player, {}), order),
+              manifest.get(f'{player}.html'))
+             for player in players]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1:
+        results = [write_player_page(*page) for page in pages]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(write_player_page, *zip(*pages), chunksize=64))
+    for filename, page_hash, changed in results:
+        new_manifest[filename] = page_hash
+        written += changed
+
+    with open(os.path.join(directory, MANIFEST_FILE), mode='w') as manifest_file:
+        json.dump(new_manifest, manifest_file, indent=1, sort_keys=True)
+    history.diagnostics.count('site files written', written)
+    history.diagnostics.info(f"{directory}: wrote {written} of {len(new_manifest)} files in "
+                             f"{time.perf_counter() - start:.2f}s", directory=directory, written=written,
+                             files=len(new_manifest))
+    return written
+
+
+def main():
+    generate_site(KQTrueSkill())
+
+
+if __name__ == '__main__':
+    main()
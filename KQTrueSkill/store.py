@@ -0,0 +1,244 @@
+import datetime
+import sqlite3
+import sys
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS players (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    scene TEXT
+);
+CREATE TABLE IF NOT EXISTS tournaments (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    date TEXT
+);
+CREATE TABLE IF NOT EXISTS teams (
+    id INTEGER PRIMARY KEY,
+    tournament_id INTEGER NOT NULL REFERENCES tournaments (id),
+    name TEXT NOT NULL,
+    UNIQUE (tournament_id, name)
+);
+CREATE TABLE IF NOT EXISTS rosters (
+    team_id INTEGER NOT NULL REFERENCES teams (id),
+    player_id INTEGER NOT NULL REFERENCES players (id),
+    PRIMARY KEY (team_id, player_id)
+);
+CREATE INDEX IF NOT EXISTS rosters_player ON rosters (player_id);
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    tournament_id INTEGER NOT NULL REFERENCES tournaments (id),
+    bracket TEXT NOT NULL,
+    team1_id INTEGER NOT NULL REFERENCES teams (id),
+    team2_id INTEGER NOT NULL REFERENCES teams (id),
+    team1wins INTEGER NOT NULL,
+    team2wins INTEGER NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS matches_tournament ON matches (tournament_id, time);
+CREATE INDEX IF NOT EXISTS matches_team1 ON matches (team1_id);
+CREATE INDEX IF NOT EXISTS matches_team2 ON matches (team2_id);
+CREATE INDEX IF NOT EXISTS matches_time ON matches (time);
+CREATE TABLE IF NOT EXISTS rating_events (
+    id INTEGER PRIMARY KEY,
+    player_id INTEGER NOT NULL REFERENCES players (id),
+    tournament_id INTEGER NOT NULL REFERENCES tournaments (id),
+    bracket TEXT NOT NULL,
+    time REAL NOT NULL,
+    team_id INTEGER NOT NULL REFERENCES teams (id),
+    opponent_team_id INTEGER NOT NULL REFERENCES teams (id),
+    old_mu REAL NOT NULL,
+    old_sigma REAL NOT NULL,
+    new_mu REAL NOT NULL,
+    new_sigma REAL NOT NULL,
+    wins INTEGER NOT NULL,
+    losses INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rating_events_player ON rating_events (player_id, time);
+CREATE INDEX IF NOT EXISTS rating_events_tournament ON rating_events (tournament_id, time);
+CREATE INDEX IF NOT EXISTS rating_events_team ON rating_events (team_id);
+CREATE INDEX IF NOT EXISTS rating_events_time ON rating_events (time);
+CREATE TABLE IF NOT EXISTS snapshots (
+    tournament_id INTEGER NOT NULL REFERENCES tournaments (id),
+    player_id INTEGER NOT NULL REFERENCES players (id),
+    mu REAL NOT NULL,
+    sigma REAL NOT NULL,
+    PRIMARY KEY (tournament_id, player_id)
+);
+CREATE INDEX IF NOT EXISTS snapshots_player ON snapshots (player_id);
+'''
+
+
+class RatingStore:
+    '''SQLite copy of a history's players, rosters, matches and rating history, so analysis can ask about one
+    player or one tournament without loading and replaying everything.
+
+    players, tournaments, teams (per tournament), rosters and matches come from the parsed datasets, see
+    load_ingested.  rating_events has a row per player per match like history.events, and snapshots a row per
+    player whose rating changed in a tournament, with their rating at its end.  Both are written while the
+    history replays when it's given the store, KQTrueSkill(store=RatingStore('ratings.db')).  Times are POSIX
+    timestamps.
+
+    Every load is one transaction.  Ids are the store's own, names are what's looked up by.'''
+
+    def __init__(self, filename: str = ':memory:'):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        # loads are committed as a whole, a crash mid load leaves the previous contents
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    # the store's connection can't be pickled, histories that get pickled (e.g. sent to a process pool) leave
+    # it behind and reopen the file
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def ids(self, table: str) -> {str: int}:
+        return dict(self.connection.execute(f'SELECT name, id FROM {table}'))
+
+    def team_ids(self) -> {(str, str): int}:
+        return {(tournament, team): team_id for tournament, team, team_id in self.connection.execute(
+            'SELECT tournaments.name, teams.name, teams.id FROM teams JOIN tournaments ON tournament_id = tournaments.id')}
+
+    # players, tournaments, teams, rosters and matches from history's parsed datasets, in one transaction.
+    # players, tournaments and teams keep their ids across loads, so rating history already written stays
+    # valid.  matches are replaced
+    def load_ingested(self, history: KQTrueSkill):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO players (name, scene) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET scene = excluded.scene',
+                ((player, history.playerscenes.get(player)) for player in history.playerteams))
+            self.connection.executemany(
+                'INSERT INTO tournaments (name, date) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET date = excluded.date',
+                ((tournament, str(history.tournamentdates[tournament]) if tournament in history.tournamentdates
+                  else None) for tournament in history.teams))
+            tournament_ids = self.ids('tournaments')
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO teams (tournament_id, name) VALUES (?, ?)',
+                ((tournament_ids[tournament], team) for tournament, teams in history.teams.items() for team in teams))
+            player_ids = self.ids('players')
+            team_ids = self.team_ids()
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO rosters (team_id, player_id) VALUES (?, ?)',
+                ((team_ids[(tournament, team)], player_ids[player])
+                 for tournament, teams in history.teams.items() for team, roster in teams.items()
+                 for player in roster))
+            self.connection.execute('DELETE FROM matches')
+            self.connection.executemany(
+                'INSERT INTO matches (tournament_id, bracket, team1_id, team2_id, team1wins, team2wins, time) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((tournament_ids[m['tournament']], m['bracket'], team_ids[(m['tournament'], m['team1name'])],
+                  team_ids[(m['tournament'], m['team2name'])], m['team1wins'], m['team2wins'],
+                  m['time'].timestamp()) for m in history.matches))
+
+    # rating history is rewritten from scratch when a history replays everything
+    def clear_ratings(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM rating_events')
+            self.connection.execute('DELETE FROM snapshots')
+
+    # history.events from row first on, in one transaction
+    def write_rating_events(self, history: KQTrueSkill, first: int = 0):
+        events = history.events
+        player_ids = self.ids('players')
+        tournament_ids = self.ids('tournaments')
+        team_ids = self.team_ids()
+        # interned ids to store ids
+        players = [player_ids[player] for player in history.player_names]
+        tournaments = [tournament_ids[tournament] for tournament in history.tournament_names]
+        teams = [team_ids[key] for key in history.team_keys]
+        columns = [events[name][first:].tolist() for name in
+                   ['player', 'tournament', 'bracket', 'time', 'team', 'opponent_team', 'old_mu', 'old_sigma',
+                    'new_mu', 'new_sigma', 'wins', 'losses']]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO rating_events (player_id, tournament_id, bracket, time, team_id, opponent_team_id, '
+                'old_mu, old_sigma, new_mu, new_sigma, wins, losses) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((players[player], tournaments[tournament], history.bracket_names[bracket], time, teams[team],
+                  teams[opponent_team], *rest)
+                 for player, tournament, bracket, time, team, opponent_team, *rest in zip(*columns)))
+
+    # the ratings that changed in tournament, as of its end
+    def write_snapshot(self, tournament: str, changed_ratings: dict):
+        if not changed_ratings:
+            return
+        player_ids = self.ids('players')
+        with self.connection:
+            tournament_id, = self.connection.execute('SELECT id FROM tournaments WHERE name = ?',
+                                                     (tournament,)).fetchone()
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO snapshots (tournament_id, player_id, mu, sigma) VALUES (?, ?, ?, ?)',
+                ((tournament_id, player_ids[player], rating.mu, rating.sigma)
+                 for player, rating in changed_ratings.items()))
+
+    # (time, tournament, bracket, team, opponent team, old mu, old sigma, new mu, new sigma, wins, losses) for
+    # every match player played, oldest first
+    def player_history(self, player: str) -> [tuple]:
+        return self.connection.execute(
+            'SELECT time, tournaments.name, bracket, teams.name, opponents.name, old_mu, old_sigma, new_mu, '
+            'new_sigma, wins, losses FROM rating_events '
+            'JOIN players ON player_id = players.id JOIN tournaments ON rating_events.tournament_id = tournaments.id '
+            'JOIN teams ON team_id = teams.id JOIN teams AS opponents ON opponent_team_id = opponents.id '
+            'WHERE players.name = ? ORDER BY time, rating_events.id', (player,)).fetchall()
+
+    # (player, team, bracket, time, old mu, new mu, ...) for every rating change in a tournament, in replay order
+    def tournament_history(self, tournament: str) -> [tuple]:
+        return self.connection.execute(
+            'SELECT players.name, teams.name, bracket, time, old_mu, old_sigma, new_mu, new_sigma, wins, losses '
+            'FROM rating_events JOIN tournaments ON rating_events.tournament_id = tournaments.id '
+            'JOIN players ON player_id = players.id JOIN teams ON team_id = teams.id '
+            'WHERE tournaments.name = ? ORDER BY time, rating_events.id', (tournament,)).fetchall()
+
+    # (tournament, mu, sigma) at the end of every tournament player's rating changed in, oldest first
+    def player_snapshots(self, player: str) -> [tuple]:
+        return self.connection.execute(
+            'SELECT tournaments.name, mu, sigma FROM snapshots JOIN players ON player_id = players.id '
+            'JOIN tournaments ON tournament_id = tournaments.id WHERE players.name = ? ORDER BY tournaments.date',
+            (player,)).fetchall()
+
+    # {team: [players]} for a tournament
+    def tournament_rosters(self, tournament: str) -> {str: [str]}:
+        rosters = {}
+        for team, player in self.connection.execute(
+                'SELECT teams.name, players.name FROM teams JOIN tournaments ON tournament_id = tournaments.id '
+                'JOIN rosters ON team_id = teams.id JOIN players ON player_id = players.id '
+                'WHERE tournaments.name = ? ORDER BY teams.name, players.name', (tournament,)):
+            rosters.setdefault(team, []).append(player)
+        return rosters
+
+    # (time, bracket, team 1, team 2, team 1 wins, team 2 wins) for every match a team played, in order
+    def team_matches(self, tournament: str, team: str) -> [tuple]:
+        return self.connection.execute(
+            'SELECT time, bracket, team1.name, team2.name, team1wins, team2wins FROM matches '
+            'JOIN teams AS team1 ON team1_id = team1.id JOIN teams AS team2 ON team2_id = team2.id '
+            'JOIN tournaments ON matches.tournament_id = tournaments.id '
+            'WHERE tournaments.name = ? AND ? IN (team1.name, team2.name) ORDER BY time',
+            (tournament, team)).fetchall()
+
+
+def main():
+    # usage: store.py [database] [player]
+    # replays the approved datasets into the database, then prints a player's history from it
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'ratings.db'
+    player = sys.argv[2] if len(sys.argv) > 2 else 'Dan Shupp'
+    store = RatingStore(filename)
+    history = KQTrueSkill(store=store)
+    history.ensure_rated()
+    for time, tournament, bracket, team, opponents, old_mu, old_sigma, new_mu, new_sigma, wins, losses in \
+            store.player_history(player):
+        print(f"{datetime.datetime.fromtimestamp(time, datetime.timezone.utc):%Y-%m-%d} {tournament} {bracket} "
+              f"{team} vs {opponents} {wins}-{losses}: {old_mu:.2f} -> {new_mu:.2f} +- {new_sigma:.2f}")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
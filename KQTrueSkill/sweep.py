@@ -0,0 +1,89 @@
+import concurrent.futures
+import csv
+import itertools
+import os
+
+import trueskill
+from trueskill import Rating
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill
+from KQTrueSkill.diagnostics import Diagnostics
+from KQTrueSkill.predictions import PredictivePowerHarness
+
+# settings a sweep can vary, and their defaults
+SWEEP_DEFAULTS = {'mu': trueskill.MU,
+                  'sigma': trueskill.SIGMA,
+                  'beta': trueskill.BETA,
+                  'tau': trueskill.TAU,
+                  'bot_mu': 5.0,
+                  'bot_sigma': 2.0}
+
+# parsed datasets, handed to each worker process once by init_worker
+worker_ingested: dict = None
+
+
+def init_worker(ingested: dict):
+    global worker_ingested
+    worker_ingested = ingested
+
+
+# replays the whole history under one configuration and returns it with its predictive scores
+def replay_configuration(config: dict, backend: str = 'numpy') -> dict:
+    env = trueskill.TrueSkill(config['mu'], config['sigma'], config['beta'], config['tau'], draw_probability=0)
+    harness = PredictivePowerHarness(env)
+    # every worker replays dozens of histories, don't print each one's progress
+    KQTrueSkill(backend=backend, env=env, bot_rating=Rating(config['bot_mu'], config['bot_sigma']),
+                ingested=worker_ingested, match_observers=[harness],
+                diagnostics=Diagnostics('warning')).ensure_rated()
+    overall = harness.overall.report()
+    return {**config, 'games': overall['games'], 'log_loss': overall['log_loss'], 'brier': overall['brier'],
+            'accuracy': overall['accuracy']}
+
+
+# every combination of the values in grid, e.g. {'beta': [2, 4, 6], 'bot_mu': [0, 5]}; anything left out
+# of the grid stays at its SWEEP_DEFAULTS value
+def sweep_configurations(grid: dict) -> [dict]:
+    for setting in grid.keys():
+        if setting not in SWEEP_DEFAULTS:
+            raise Exception(f"can't sweep {setting}, expected one of {list(SWEEP_DEFAULTS.keys())}")
+    settings = list(grid.keys())
+    configs = []
+    for values in itertools.product(*(grid[setting] for setting in settings)):
+        config = dict(SWEEP_DEFAULTS)
+        config.update(zip(settings, values))
+        configs.append(config)
+    return configs
+
+
+# parses the datasets once, then replays history for every configuration in a process pool
+def run_sweep(grid: dict, history: KQTrueSkill = None, processes: int = None) -> [dict]:
+    if history is None:
+        history = KQTrueSkill(players_only=True)
+    configs = sweep_configurations(grid)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                                initargs=(history.get_ingested_data(),)) as pool:
+        return list(pool.map(replay_configuration, configs))
+
+
+def write_sweep_results(results: [dict], filename: str = 'sweep.csv'):
+    with open(filename, mode='w') as sweep_file:
+        sweep_writer = csv.DictWriter(sweep_file, fieldnames=list(results[0].keys()))
+        sweep_writer.writeheader()
+        for result in sorted(results, key=lambda r: r['log_loss']):
+            sweep_writer.writerow(result)
+
+
+def main():
+    # how do beta and the way bots are modeled change predictiveness?
+    grid = {'beta': [trueskill.BETA / 2, trueskill.BETA, trueskill.BETA * 1.5, trueskill.BETA * 2],
+            'tau': [trueskill.TAU, trueskill.TAU * 2],
+            'bot_mu': [0.0, 5.0, 10.0]}
+    results = run_sweep(grid, processes=os.cpu_count())
+    for r in sorted(results, key=lambda r: r['log_loss']):
+        print(f"beta {r['beta']:.3f}, tau {r['tau']:.3f}, bot {r['bot_mu']:.1f}/{r['bot_sigma']:.1f}: "
+              f"log loss {r['log_loss']:.4f}, brier {r['brier']:.4f}, accuracy {r['accuracy']:.3f}")
+    write_sweep_results(results)
+
+
+if __name__ == '__main__':
+    main()
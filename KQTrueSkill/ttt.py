@@ -0,0 +1,321 @@
+import collections
+import math
+import sys
+import time
+
+import numpy as np
+import trueskill
+from trueskill import Rating
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, TEAM_SIZE
+from KQTrueSkill.twoteam import v_win
+
+# drift defaults to the dynamics online trueskill adds over this many games, about one tournament's worth
+GAMES_PER_TOURNAMENT = 20
+
+
+# adds variance to gaussians in natural parameters.  pi = 0 (no information) stays 0
+def drift_natural(pi: np.ndarray, tau: np.ndarray, variance: float) -> (np.ndarray, np.ndarray):
+    scale = 1 / (1 + pi * variance)
+    return pi * scale, tau * scale
+
+
+class TrueSkillThroughTime:
+    '''Smoothed ratings for every player at every tournament they played, from all of history at once instead of
+    one match at a time, so early tournaments' ratings also learn from what happened later.
+
+    Each player has one skill per tournament they played, held constant within the tournament and drifting by
+    drift^2 of variance between one of their tournaments and the next.  Messages are stored sparsely, one slot
+    per (player, tournament) played, kept contiguous per player in tournament order:
+    forward[slot]  what the player's earlier tournaments (and the prior) say about this one
+    backward[slot] what their later tournaments say
+    likelihood[slot] the product of the messages from every game they played in this tournament
+    and one entry per player per factor.  A factor is the games of a set that went one way: the games of a set
+    are exchangeable, so a set has one factor for the games team 1 won and one for the games it lost, and each
+    factor's message is counted once per game.
+
+    An iteration sweeps forward through the tournaments, refreshing each one's forward messages and then its
+    game messages (expectation propagation: each game against its cavity, the marginal without that game's own
+    message), then sweeps backward doing the same with backward messages.  The first forward sweep is online
+    trueskill with one rating per tournament.  Iterations stop when no rating moves more than tolerance, and
+    tournaments whose ratings have settled are skipped until their neighbours move them again.
+
+    Within a tournament, factors are updated in levels: a factor's level is one past the highest level of an
+    earlier factor sharing a player with it.  Factors in a level share no players, so updating a level at once
+    with numpy is the same as updating its factors one at a time, and there are only as many levels as the
+    most factors anyone played in the tournament.  Updating every factor at once instead overshoots and
+    diverges.'''
+
+    def __init__(self, history: KQTrueSkill, drift: float = None, env: trueskill.TrueSkill = None):
+        if env is None:
+            env = history.env
+        self.prior = Rating(env.mu, env.sigma)
+        self.beta = env.beta
+        self.drift = drift if drift is not None else env.tau * math.sqrt(GAMES_PER_TOURNAMENT)
+        bot = history.bot_rating
+
+        # tournaments in the order their first match was played
+        self.tournaments = []
+        tournament_index = {}
+        self.players = []
+        self.player_index = {}
+        entry_players, entry_factors, entry_signs = [], [], []
+        factor_tournaments, factor_counts, factor_bot_mu, factor_variance = [], [], [], []
+        for m in history.matches:
+            if m['tournament'] not in tournament_index:
+                tournament_index[m['tournament']] = len(self.tournaments)
+                self.tournaments.append(m['tournament'])
+            teams = history.teams[m['tournament']]
+            team1, team2 = teams[m['team1name']], teams[m['team2name']]
+            players = [(player, 1) for player in team1] + [(player, -1) for player in team2]
+            # teams with < 5 players are padded with bots, which keep the bot rating
+            bots1, bots2 = max(TEAM_SIZE - len(team1), 0), max(TEAM_SIZE - len(team2), 0)
+            performers = len(players) + bots1 + bots2
+            for outcome, count in ((1, m['team1wins']), (-1, m['team2wins'])):
+                if count == 0:
+                    continue
+                for player, sign in players:
+                    if player not in self.player_index:
+                        self.player_index[player] = len(self.players)
+                        self.players.append(player)
+                    entry_players.append(self.player_index[player])
+                    entry_factors.append(len(factor_counts))
+                    entry_signs.append(outcome * sign)
+                factor_tournaments.append(tournament_index[m['tournament']])
+                factor_counts.append(count)
+                factor_bot_mu.append(outcome * (bots1 - bots2) * bot.mu)
+                factor_variance.append((bots1 + bots2) * bot.sigma ** 2 + performers * self.beta ** 2)
+
+        self.entry_factors = np.array(entry_factors, dtype=np.int64)
+        self.entry_signs = np.array(entry_signs, dtype=np.float64)  # +1 for players on the team that won
+        self.factor_tournaments = np.array(factor_tournaments, dtype=np.int64)
+        self.factor_counts = np.array(factor_counts, dtype=np.float64)
+        self.factor_bot_mu = np.array(factor_bot_mu, dtype=np.float64)  # bots' share of the winners' lead
+        self.factor_variance = np.array(factor_variance, dtype=np.float64)  # bots' variance and everyone's beta^2
+
+        # one slot per (player, tournament) played, sorted by player then tournament, so a player's previous
+        # tournament is the slot before
+        tournament_count = max(len(self.tournaments), 1)
+        entry_keys = np.array(entry_players, dtype=np.int64) * tournament_count + \
+            self.factor_tournaments[self.entry_factors]
+        slot_keys = np.unique(entry_keys)
+        self.slot_players = slot_keys // tournament_count
+        self.slot_tournaments = slot_keys % tournament_count
+        self.slot_lookup = {key: slot for slot, key in enumerate(slot_keys.tolist())}
+        self.entry_slots = np.searchsorted(slot_keys, entry_keys)
+        slot_count = len(slot_keys)
+        self.first = np.ones(slot_count, dtype=bool)  # first tournament each player played
+        self.first[1:] = self.slot_players[1:] != self.slot_players[:-1]
+        self.last = np.append(self.first[1:], True)  # last tournament each player played
+        order = np.argsort(self.slot_tournaments, kind='stable')
+        self.tournament_slots = np.split(order, np.cumsum(np.bincount(self.slot_tournaments,
+                                                                      minlength=len(self.tournaments)))[:-1])
+        self.order_by_level()
+
+        self.forward_pi = np.zeros(slot_count)
+        self.forward_tau = np.zeros(slot_count)
+        self.backward_pi = np.zeros(slot_count)
+        self.backward_tau = np.zeros(slot_count)
+        self.likelihood_pi = np.zeros(slot_count)
+        self.likelihood_tau = np.zeros(slot_count)
+        self.marginal_pi = np.zeros(slot_count)  # forward + likelihood + backward, kept up to date
+        self.marginal_tau = np.zeros(slot_count)
+        self.message_pi = np.zeros(len(self.entry_slots))  # each entry's message from one game of its factor
+        self.message_tau = np.zeros(len(self.entry_slots))
+        self.settled_mu = np.full(slot_count, np.inf)  # ratings after their tournament's games last ran
+        self.tournament_moved = np.full(len(self.tournaments), np.inf)  # how much that moved them
+        self.tournament_updates = 0
+        self.iterations = 0
+        self.converged = False
+
+    # renumbers factors so each tournament's levels, and their entries, are contiguous, and keeps what
+    # update_level needs for each in self.levels[tournament]
+    def order_by_level(self):
+        factor_count = len(self.factor_tournaments)
+        factor_offsets = np.searchsorted(self.entry_factors, np.arange(factor_count + 1))
+        entry_slots = self.entry_slots.tolist()
+        next_level = collections.defaultdict(int)  # next_level[slot] = lowest level its next factor can go in
+        level = []
+        for f in range(factor_count):
+            slots = entry_slots[factor_offsets[f]:factor_offsets[f + 1]]
+            factor_level = max((next_level[slot] for slot in slots), default=0)
+            for slot in slots:
+                next_level[slot] = factor_level + 1
+            level.append(factor_level)
+        level = np.array(level, dtype=np.int64)
+
+        factor_order = np.lexsort((level, self.factor_tournaments))
+        renumbered = np.empty(factor_count, dtype=np.int64)
+        renumbered[factor_order] = np.arange(factor_count)
+        entry_order = np.argsort(renumbered[self.entry_factors], kind='stable')
+        self.entry_slots = self.entry_slots[entry_order]
+        self.entry_signs = self.entry_signs[entry_order]
+        self.entry_factors = renumbered[self.entry_factors][entry_order]
+        for name in ['factor_tournaments', 'factor_counts', 'factor_bot_mu', 'factor_variance']:
+            setattr(self, name, getattr(self, name)[factor_order])
+        level = level[factor_order]
+
+        self.levels = [[] for _ in self.tournaments]
+        starts = np.flatnonzero(np.diff(self.factor_tournaments * (level.max(initial=0) + 1) + level, prepend=-1))
+        ends = np.append(starts[1:], factor_count)
+        entry_starts = np.searchsorted(self.entry_factors, starts)
+        entry_ends = np.searchsorted(self.entry_factors, ends)
+        for start, end, entry_start, entry_end in zip(starts.tolist(), ends.tolist(), entry_starts.tolist(),
+                                                      entry_ends.tolist()):
+            slots = self.entry_slots[entry_start:entry_end]
+            factors = self.entry_factors[entry_start:entry_end]
+            self.levels[self.factor_tournaments[start]].append((
+                entry_start, entry_end, slots, factors - start, self.entry_signs[entry_start:entry_end],
+                self.factor_counts[factors], self.factor_bot_mu[start:end], self.factor_variance[start:end],
+                len(np.unique(slots)) == len(slots)))
+
+    def marginals(self) -> (np.ndarray, np.ndarray):
+        return self.marginal_pi, self.marginal_tau
+
+    # updates the messages from one game of each factor in a level, and the likelihoods they're part of
+    def update_level(self, level: tuple):
+        first_entry, end_entry, slots, factors, signs, counts, bot_mu, fixed_variance, unique = level
+        old_pi, old_tau = self.message_pi[first_entry:end_entry], self.message_tau[first_entry:end_entry]
+        cavity_pi = self.marginal_pi[slots] - old_pi
+        cavity_tau = self.marginal_tau[slots] - old_tau
+        variance = 1 / cavity_pi
+        mu = cavity_tau * variance
+        c_squared = np.bincount(factors, weights=variance, minlength=len(bot_mu)) + fixed_variance
+        c = np.sqrt(c_squared)
+        t = (np.bincount(factors, weights=signs * mu, minlength=len(bot_mu)) + bot_mu) / c
+        # a handful of factors per level, cheaper one at a time than as numpy arrays
+        v = np.array([v_win(x) for x in t.tolist()])
+        w = v * (v + t)
+        new_variance = variance * (1 - variance * (w / c_squared)[factors])
+        new_mu = mu + signs * variance * (v / c)[factors]
+        new_pi = 1 / new_variance - cavity_pi
+        new_tau = new_mu / new_variance - cavity_tau
+
+        change_pi = counts * (new_pi - old_pi)
+        change_tau = counts * (new_tau - old_tau)
+        if unique:
+            self.likelihood_pi[slots] += change_pi
+            self.likelihood_tau[slots] += change_tau
+            self.marginal_pi[slots] += change_pi
+            self.marginal_tau[slots] += change_tau
+        else:
+            # a few sets list a player on both teams, so their slot comes up twice
+            np.add.at(self.likelihood_pi, slots, change_pi)
+            np.add.at(self.likelihood_tau, slots, change_tau)
+            np.add.at(self.marginal_pi, slots, change_pi)
+            np.add.at(self.marginal_tau, slots, change_tau)
+        self.message_pi[first_entry:end_entry] = new_pi
+        self.message_tau[first_entry:end_entry] = new_tau
+
+    # reruns the games of a tournament, unless neither its forward and backward messages nor its own games last
+    # time moved any of its ratings more than settled
+    def update_tournament(self, tournament: int, settled: float):
+        slots = self.tournament_slots[tournament]
+        self.marginal_pi[slots] = self.forward_pi[slots] + self.likelihood_pi[slots] + self.backward_pi[slots]
+        self.marginal_tau[slots] = self.forward_tau[slots] + self.likelihood_tau[slots] + self.backward_tau[slots]
+        before = self.marginal_tau[slots] / self.marginal_pi[slots]
+        if self.tournament_moved[tournament] <= settled and \
+                np.abs(before - self.settled_mu[slots]).max(initial=0) <= settled:
+            return
+        for level in self.levels[tournament]:
+            self.update_level(level)
+        self.settled_mu[slots] = self.marginal_tau[slots] / self.marginal_pi[slots]
+        self.tournament_moved[tournament] = np.abs(self.settled_mu[slots] - before).max(initial=0)
+        self.tournament_updates += 1
+
+    # one forward and one backward sweep, returns how far the furthest rating mean moved.  settled: see
+    # update_tournament, 0 reruns every tournament
+    def iterate(self, settled: float = 0.0) -> float:
+        slot_count = len(self.slot_players)
+        if slot_count == 0:
+            return 0.0
+        old_mu = self.marginal_tau / np.where(self.marginal_pi > 0, self.marginal_pi, 1)
+        drift_variance = self.drift ** 2
+        prior_pi = 1 / self.prior.sigma ** 2
+
+        for tournament, slots in enumerate(self.tournament_slots):
+            # from the player's previous tournament, or the prior for their first.  slot - 1 of a first slot is
+            # someone else's (or wraps around), it's computed and thrown away
+            first = self.first[slots]
+            previous_pi, previous_tau = drift_natural(self.forward_pi[slots - 1] + self.likelihood_pi[slots - 1],
+                                                      self.forward_tau[slots - 1] + self.likelihood_tau[slots - 1],
+                                                      drift_variance)
+            self.forward_pi[slots] = np.where(first, prior_pi, previous_pi)
+            self.forward_tau[slots] = np.where(first, prior_pi * self.prior.mu, previous_tau)
+            self.update_tournament(tournament, settled)
+
+        for tournament in reversed(range(len(self.tournaments))):
+            slots = self.tournament_slots[tournament]
+            following = np.minimum(slots + 1, slot_count - 1)
+            next_pi, next_tau = drift_natural(self.likelihood_pi[following] + self.backward_pi[following],
+                                              self.likelihood_tau[following] + self.backward_tau[following],
+                                              drift_variance)
+            self.backward_pi[slots] = np.where(self.last[slots], 0, next_pi)
+            self.backward_tau[slots] = np.where(self.last[slots], 0, next_tau)
+            self.update_tournament(tournament, settled)
+
+        self.iterations += 1
+        return float(np.abs(self.marginal_tau / self.marginal_pi - old_mu).max())
+
+    # iterate until no rating mean moves more than tolerance, returns whether that happened in max_iterations
+    def run(self, tolerance: float = 1e-3, max_iterations: int = 200) -> bool:
+        while self.iterations < max_iterations:
+            if self.iterate(tolerance / 10) < tolerance:
+                self.converged = True
+                break
+        return self.converged
+
+    def slot_rating(self, slot: int) -> Rating:
+        pi, tau = float(self.marginal_pi[slot]), float(self.marginal_tau[slot])
+        return Rating(tau / pi, math.sqrt(1 / pi))
+
+    # smoothed rating of player during tournament
+    def rating(self, player: str, tournament: str) -> Rating:
+        if player in self.player_index and tournament in self.tournaments:
+            key = self.player_index[player] * len(self.tournaments) + self.tournaments.index(tournament)
+            if key in self.slot_lookup:
+                return self.slot_rating(self.slot_lookup[key])
+        raise Exception(f"{player} didn't play in {tournament}")
+
+    # [(tournament, smoothed rating)...] for every tournament player played, in order
+    def player_history(self, player: str) -> [(str, Rating)]:
+        if player not in self.player_index:
+            raise Exception(f"{player} never played a match")
+        slots = np.flatnonzero(self.slot_players == self.player_index[player]).tolist()
+        return [(self.tournaments[self.slot_tournaments[slot]], self.slot_rating(slot)) for slot in slots]
+
+    # {player: smoothed rating at their last tournament}
+    def latest_ratings(self) -> {str: Rating}:
+        return {self.players[self.slot_players[slot]]: self.slot_rating(slot)
+                for slot in np.flatnonzero(self.last).tolist()}
+
+
+# smoothed ratings for every player at every tournament, see TrueSkillThroughTime
+def smooth_history(history: KQTrueSkill, drift: float = None, tolerance: float = 1e-3,
+                   max_iterations: int = 200) -> TrueSkillThroughTime:
+    with history.diagnostics.timer('smoothing'):
+        smoothed = TrueSkillThroughTime(history, drift)
+        converged = smoothed.run(tolerance, max_iterations)
+    history.diagnostics.count('smoothing iterations', smoothed.iterations)
+    history.diagnostics.count('smoothed tournament updates', smoothed.tournament_updates)
+    if not converged:
+        history.diagnostics.warning(f"TrueSkill Through Time didn't converge to {tolerance} in {max_iterations} "
+                                    f"iterations", tolerance=tolerance, iterations=max_iterations)
+    return smoothed
+
+
+def main():
+    # usage: ttt.py [player]
+    player = sys.argv[1] if len(sys.argv) > 1 else 'Dan Shupp'
+    history = KQTrueSkill(players_only=True)
+    start = time.perf_counter()
+    smoothed = smooth_history(history)
+    print(f"smoothed {len(smoothed.players)} players over {len(smoothed.tournaments)} tournaments "
+          f"({len(smoothed.slot_players)} player tournaments) in {smoothed.iterations} iterations, "
+          f"{time.perf_counter() - start:.2f}s")
+    for tournament, rating in smoothed.player_history(player):
+        print(f"{player} at {tournament}: {rating.mu:.2f} +- {rating.sigma:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import math
+import time
+
+import numpy as np
+import trueskill
+from trueskill import Rating
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, series_game_order
+
+
+class TwoTeamEngine:
+    '''Closed form TrueSkill update for one team beating another, on numpy arrays of mu and sigma.
+
+    With two teams and no draws the trueskill factor graph has a single comparison, so its result
+    is the textbook update: every player's mean moves by sigma^2 / c * v and their variance shrinks
+    by a factor of (1 - sigma^2 / c^2 * w), where c is the spread of the team performance difference.'''
+
+    def __init__(self, env: trueskill.TrueSkill = None):
+        if env is None:
+            env = trueskill.global_env()
+        self.beta = env.beta
+        self.tau = env.tau
+
+    # one game without dynamics, returns the new mu and variance.  sign is +1 for players on the winning team,
+    # -1 for the losers
+    def game(self, mu: np.ndarray, variance: np.ndarray, sign: np.ndarray):
+        c = math.sqrt(variance.sum() + len(mu) * self.beta * self.beta)
+        t = float(sign @ mu) / c
+        v = v_win(t)
+        w = v * (v + t)
+        return mu + sign * variance * (v / c), variance * (1 - variance * (w / (c * c)))
+
+    # rates a best of N set where team1 won wins games and lost losses games, see SERIES_ORDERINGS
+    def rate_series(self, team1: [Rating], team2: [Rating], wins: int, losses: int, ordering: str = 'wins_first'):
+        ratings = team1 + team2
+        mu, sigma = self.rate_series_arrays(np.array([r.mu for r in ratings]), np.array([r.sigma for r in ratings]),
+                                            len(team1), wins, losses, ordering)
+        new_ratings = [Rating(m, s) for m, s in zip(mu.tolist(), sigma.tolist())]
+        return new_ratings[:len(team1)], new_ratings[len(team1):]
+
+    # rate_series on arrays of mu and sigma, with team 1 in the first team1_size entries
+    def rate_series_arrays(self, mu: np.ndarray, sigma: np.ndarray, team1_size: int, wins: int, losses: int,
+                           ordering: str = 'wins_first'):
+        variance = sigma * sigma
+        sign = np.ones(len(mu))
+        sign[team1_size:] = -1
+        tau_squared = self.tau * self.tau
+
+        if ordering == 'moment_matching':
+            if wins + losses > 0:
+                # every game sees the ratings from before the set, then the per game updates are multiplied
+                # together in natural parameters
+                variance = variance + (wins + losses) * tau_squared
+                won_mu, won_variance = self.game(mu, variance, sign)
+                lost_mu, lost_variance = self.game(mu, variance, -sign)
+                pi = 1 / variance
+                pi_mu = mu * pi
+                new_pi = pi + wins * (1 / won_variance - pi) + losses * (1 / lost_variance - pi)
+                new_pi_mu = pi_mu + wins * (won_mu / won_variance - pi_mu) + losses * (lost_mu / lost_variance - pi_mu)
+                mu, variance = new_pi_mu / new_pi, 1 / new_pi
+        else:
+            for team1_won in series_game_order(wins, losses, ordering):
+                mu, variance = self.game(mu, variance + tau_squared, sign if team1_won else -sign)
+
+        return mu, np.sqrt(variance)
+
+
+def normal_pdf(x: float) -> float:
+    return math.exp(-x * x / 2) / math.sqrt(2 * math.pi)
+
+
+def normal_cdf(x: float) -> float:
+    return math.erfc(-x / math.sqrt(2)) / 2
+
+
+# additive correction to the winning team's mean, see TrueSkill.v_win
+def v_win(t: float) -> float:
+    denom = normal_cdf(t)
+    return (normal_pdf(t) / denom) if denom else -t
+
+
+def compare_backends(tolerance: float = 1e-4):
+    '''Replays the approved datasets with both backends, prints timings and checks the numpy engine
+    ends up within tolerance of the trueskill package for every player.'''
+    history = KQTrueSkill(backend='trueskill')
+
+    start = time.perf_counter()
+    history.calculate_trueskills()
+    reference_seconds = time.perf_counter() - start
+    reference = dict(history.playerratings)
+
+    history.use_backend('numpy')
+    start = time.perf_counter()
+    history.calculate_trueskills()
+    engine_seconds = time.perf_counter() - start
+
+    worst_player, worst_delta = None, 0.0
+    for player, rating in reference.items():
+        delta = max(abs(rating.mu - history.playerratings[player].mu),
+                    abs(rating.sigma - history.playerratings[player].sigma))
+        if delta > worst_delta:
+            worst_player, worst_delta = player, delta
+
+    print(f"replaying {len(history.matches)} matches: trueskill backend {reference_seconds:.2f}s, "
+          f"numpy backend {engine_seconds:.2f}s")
+    print(f"largest difference: {worst_delta:.2e} ({worst_player})")
+    if worst_delta > tolerance:
+        raise Exception(f"numpy backend differs from trueskill by {worst_delta} for {worst_player}, "
+                        f"more than the {tolerance} tolerance")
+
+
+def main():
+    compare_backends()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import csv
+import pickle
+
+import pytest
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill
+from KQTrueSkill.diagnostics import Diagnostics
+
+PLAYERS = [f"Player {i}" for i in range(10)]
+
+
+def write_dataset(directory, tournament: str, teams: {str: [str]}, matches: [tuple]) -> (str, str):
+    player_file, match_file = directory / f"{tournament} players.csv", directory / f"{tournament} results.csv"
+    with open(player_file, mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Tournament', 'Team Name', 'Player', 'Scene'])
+        writer.writerows([tournament, team, player, 'SF'] for team, players in teams.items() for player in players)
+    with open(match_file, mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['tournament', 'bracket', 'team1name', 'team2name', 'team1wins', 'team2wins', 'time'])
+        writer.writerows([tournament, 'KO', *match] for match in matches)
+    return str(player_file), str(match_file)
+
+
+def test_long_export_after_append(tmp_path):
+    first = write_dataset(tmp_path, 'T1', {'A': PLAYERS[:5], 'B': PLAYERS[5:]},
+                          [('A', 'B', 2, 1, '2019-01-01T10:00:00-0800'), ('B', 'A', 2, 0, '2019-01-01T11:00:00-0800')])
+    second = write_dataset(tmp_path, 'T2', {'C': PLAYERS[::2], 'D': PLAYERS[1::2]},
+                           [('C', 'D', 2, 0, '2019-02-01T10:00:00-0800')])
+    history = KQTrueSkill(datasets=[first], diagnostics=Diagnostics(echo=False))
+    history.ensure_rated()
+    history.save_state(str(tmp_path / 'history.state'))
+
+    appended = KQTrueSkill(state_file=str(tmp_path / 'history.state'), diagnostics=Diagnostics(echo=False))
+    appended.append_dataset(*second)
+    filename = appended.write_player_ratings_long(str(tmp_path / 'history.csv'))
+
+    with open(filename, newline='') as f:
+        rows = list(csv.reader(f))[1:]
+    assert {(row[0], row[1]) for row in rows} == {(player, tournament) for player in PLAYERS
+                                                  for tournament in ('T1', 'T2')}
+    assert len(rows) == 2 * len(PLAYERS)
+
+
+def test_unwritable_dataset_cache(tmp_path):
+    dataset = write_dataset(tmp_path, 'T1', {'A': PLAYERS[:5], 'B': PLAYERS[5:]},
+                            [('A', 'B', 2, 1, '2019-01-01T10:00:00-0800')])
+    diagnostics = Diagnostics(echo=False)
+    history = KQTrueSkill(datasets=[dataset], diagnostics=diagnostics)
+    history.dataset_cache_file_name = str(tmp_path / 'missing' / 'parsed.cache')
+    assert len(history.matches) == 1
+    assert [event['level'] for event in diagnostics.events if 'dataset cache' in event['message']] == \
+        ['info', 'warning']
+
+
+def test_bad_append_leaves_history_unchanged(tmp_path):
+    first = write_dataset(tmp_path, 'T1', {'A': PLAYERS[:5], 'B': PLAYERS[5:]},
+                          [('A', 'B', 2, 1, '2019-01-01T10:00:00-0800')])
+    # team E isn't in the player file, and Player 10 would be a new player
+    bad = write_dataset(tmp_path, 'T2', {'C': PLAYERS[:5], 'D': PLAYERS[6:] + ['Player 10']},
+                        [('C', 'D', 2, 0, '2019-02-01T10:00:00-0800'), ('C', 'E', 2, 1, '2019-02-01T11:00:00-0800')])
+    history = KQTrueSkill(datasets=[first], diagnostics=Diagnostics(echo=False))
+    history.ensure_rated()
+    ratings = dict(history.playerratings)
+
+    with pytest.raises(Exception, match='E not found'):
+        history.append_dataset(*bad)
+    assert len(history.matches) == 1
+    assert dict(history.playerratings) == ratings
+    assert history.tournaments == ['T1']
+    assert 'Player 10' not in history.playerteams
+    assert 'T2' not in history.tournamentdates
+
+
+@pytest.mark.parametrize('contents', [b'not a pickle', pickle.dumps(['a', 'list']), pickle.dumps({'key': None}),
+                                      'wrong shape'])
+def test_unusable_dataset_cache(tmp_path, contents):
+    dataset = write_dataset(tmp_path, 'T1', {'A': PLAYERS[:5], 'B': PLAYERS[5:]},
+                            [('A', 'B', 2, 1, '2019-01-01T10:00:00-0800')])
+    cache_file = tmp_path / 'parsed.cache'
+    history = KQTrueSkill(datasets=[dataset], diagnostics=Diagnostics(echo=False))
+    history.dataset_cache_file_name = str(cache_file)
+    if contents == 'wrong shape':
+        contents = pickle.dumps({'key': history.dataset_cache_key([dataset]), 'ingested': {'matches': 5}})
+    cache_file.write_bytes(contents)
+    assert len(history.matches) == 1
+    assert sorted(history.playerteams) == PLAYERS
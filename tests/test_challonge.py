@@ -0,0 +1,97 @@
+import http.server
+import json
+import threading
+
+import pytest
+
+from KQTrueSkill.ingest_tools.challongecache import ChallongeCache
+from KQTrueSkill.ingest_tools.challongeingest import ChallongeAccount
+
+
+class StubChallonge(http.server.ThreadingHTTPServer):
+    '''Answers GETs from a script of (status, headers, body) responses per path, and records every request as
+    (path, headers).  Once a path's script runs out, its last response repeats.'''
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.responses = {}
+        self.requests = []
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def requests_for(self, path: str) -> [dict]:
+        return [headers for request_path, headers in self.requests if request_path == path]
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.partition('?')[0].lstrip('/')
+        self.server.requests.append((path, dict(self.headers)))
+        script = self.server.responses[path]
+        status, headers, body = script.pop(0) if len(script) > 1 else script[0]
+        if callable(status):
+            status, headers, body = status(self.headers)
+        encoded = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = StubChallonge()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_rate_limits_and_server_errors(stub):
+    tournaments = [{'tournament': {'name': 'KQXX', 'id': 1}}]
+    stub.responses['tournaments.json'] = [(429, {}, None), (500, {}, None), (200, {}, tournaments)]
+    account = ChallongeAccount('key', None, api_url=stub.api_url, max_workers=2, retries=4, backoff=0)
+    assert account.get_tourney_list() == tournaments
+    assert len(stub.requests_for('tournaments.json')) == 3
+
+
+def test_gives_up_after_retries(stub):
+    stub.responses['tournaments.json'] = [(503, {}, None)]
+    account = ChallongeAccount('key', None, api_url=stub.api_url, max_workers=2, retries=2, backoff=0)
+    with pytest.raises(Exception, match='GET /index/ 503'):
+        account.get_tourney_list()
+    assert len(stub.requests_for('tournaments.json')) == 3
+
+
+def test_cache_revalidates_with_etag(stub, tmp_path):
+    path = 'tournaments/kqxx.json'
+    underway = {'tournament': {'name': 'KQXX', 'state': 'underway'}}
+    complete = {'tournament': {'name': 'KQXX', 'state': 'complete'}}
+
+    def not_modified(headers):
+        if headers.get('If-None-Match') == '"v1"':
+            return 304, {'ETag': '"v1"'}, None
+        return 200, {'ETag': '"v1"'}, {'tournament': {'state': 'refetched'}}
+
+    stub.responses[path] = [(200, {'ETag': '"v1"'}, underway), (not_modified, None, None),
+                            (200, {'ETag': '"v2"'}, complete)]
+    account = ChallongeAccount('key', None, api_url=stub.api_url, max_workers=2, retries=0, backoff=0,
+                               cache=ChallongeCache(str(tmp_path / 'challonge_cache')))
+
+    assert account.get_json(path, 'show', path) == underway
+    # still running, so it's revalidated and the 304 answers from the cache
+    assert account.get_json(path, 'show', path) == underway
+    assert stub.requests_for(path)[1].get('If-None-Match') == '"v1"'
+    assert account.get_json(path, 'show', path) == complete
+    # finished tournaments never go back to the server
+    assert account.get_json(path, 'show', path) == complete
+    assert len(stub.requests_for(path)) == 3
@@ -0,0 +1,21 @@
+import copy
+
+import pytest
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill
+from KQTrueSkill.diagnostics import Diagnostics
+
+from test_append_dataset import PLAYERS, write_dataset
+
+
+def test_players_only_has_no_rating_attributes(tmp_path):
+    dataset = write_dataset(tmp_path, 'T1', {'A': PLAYERS[:5], 'B': PLAYERS[5:]},
+                            [('A', 'B', 2, 1, '2019-01-01T10:00:00-0800')])
+    history = KQTrueSkill(datasets=[dataset], players_only=True, diagnostics=Diagnostics(echo=False))
+    assert sorted(history.playerteams) == PLAYERS
+    assert not hasattr(history, 'playerratings')
+    assert getattr(history, 'timeline', None) is None
+    with pytest.raises(AttributeError, match='players_only=True'):
+        history.playerratings
+    assert copy.copy(history).playerteams == history.playerteams
+    assert copy.deepcopy(history).matches == history.matches
@@ -0,0 +1,23 @@
+import asyncio
+import functools
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill
+from KQTrueSkill.diagnostics import Diagnostics
+from KQTrueSkill.service import RatingService
+
+from test_append_dataset import PLAYERS, write_dataset
+
+
+def test_reload_counters_dont_accumulate(tmp_path):
+    dataset = write_dataset(tmp_path, 'T1', {'A': PLAYERS[:5], 'B': PLAYERS[5:]},
+                            [('A', 'B', 2, 1, '2019-01-01T10:00:00-0800'), ('B', 'A', 2, 0, '2019-01-01T11:00:00-0800')])
+    service = RatingService(build_history=functools.partial(KQTrueSkill, datasets=[dataset]),
+                            diagnostics=Diagnostics(echo=False))
+    first = service.version_info()
+    assert first['load']['counters']['rate calls'] == 5
+
+    reloaded = asyncio.run(service.reload())
+    assert reloaded['version'] == 2
+    assert reloaded['load']['counters'] == first['load']['counters']
+    assert reloaded['load']['timers']['service load'] > 0
+    assert service.history.diagnostics.timer_calls['service load'] == 1
@@ -0,0 +1,50 @@
+import pytest
+import trueskill
+from trueskill import Rating
+
+from KQTrueSkill.KQtrueskill import KQTrueSkill, SERIES_ORDERINGS
+from KQTrueSkill.diagnostics import Diagnostics
+from KQTrueSkill.twoteam import TwoTeamEngine
+
+from test_append_dataset import PLAYERS, write_dataset
+
+TOLERANCE = 1e-4
+
+TEAM1 = [Rating(30, 4), Rating(25, 8.333), Rating(22, 2), Rating(35, 6), Rating(18, 3)]
+TEAM2 = [Rating(28, 5), Rating(27, 1.5), Rating(24, 7), Rating(20, 8.333), Rating(31, 2.5)]
+
+
+def assert_close(expected: [Rating], actual: [Rating]):
+    for want, got in zip(expected, actual, strict=True):
+        assert abs(want.mu - got.mu) < TOLERANCE
+        assert abs(want.sigma - got.sigma) < TOLERANCE
+
+
+def test_game_matches_trueskill():
+    env = trueskill.TrueSkill(draw_probability=0)
+    engine = TwoTeamEngine(env)
+    for winners, losers in ((TEAM1, TEAM2), (TEAM2, TEAM1)):
+        expected_winners, expected_losers = env.rate([winners, losers], ranks=[0, 1])
+        new_winners, new_losers = engine.rate_series(winners, losers, 1, 0)
+        assert_close(expected_winners, new_winners)
+        assert_close(expected_losers, new_losers)
+
+
+@pytest.mark.parametrize('ordering', SERIES_ORDERINGS)
+def test_backends_agree(tmp_path, ordering):
+    teams = {'A': PLAYERS[:5], 'B': PLAYERS[5:], 'C': PLAYERS[::2], 'D': PLAYERS[1::2]}
+    first = write_dataset(tmp_path, 'T1', teams,
+                          [('A', 'B', 2, 1, '2019-01-01T10:00:00-0800'), ('B', 'A', 3, 2, '2019-01-01T11:00:00-0800'),
+                           ('C', 'D', 2, 0, '2019-01-01T12:00:00-0800')])
+    second = write_dataset(tmp_path, 'T2', teams,
+                           [('D', 'C', 3, 1, '2019-02-01T10:00:00-0800'), ('A', 'B', 0, 2, '2019-02-01T11:00:00-0800'),
+                            ('A', 'D', 1, 1, '2019-02-01T12:00:00-0800')])
+    reference = KQTrueSkill(datasets=[first, second], backend='trueskill', series_ordering=ordering,
+                            diagnostics=Diagnostics(echo=False))
+    history = KQTrueSkill(datasets=[first, second], backend='numpy', series_ordering=ordering,
+                          diagnostics=Diagnostics(echo=False))
+    players = sorted(reference.playerratings)
+    assert players == PLAYERS
+    assert_close([reference.playerratings[player] for player in players],
+                 [history.playerratings[player] for player in players])
+    assert reference.diagnostics.counters['rate calls'] == history.diagnostics.counters['rate calls'] > 0